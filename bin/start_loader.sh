@@ -1,4 +1,7 @@
 #!/bin/sh
 
 cd /opt/ori
-celery --app=ocd_backend.app:celery_app --quiet worker --loglevel=info -Q loaders --concurrency=1 --without-gossip >> /opt/ori/data/ori.log 2>&1
+# The extractors (setup_pipeline) run in a separate worker, so the loaders keep draining
+# chains while an extractor pauses for backpressure
+celery --app=ocd_backend.app:celery_app --quiet worker --loglevel=info -Q pipeline --concurrency=1 -n pipeline@%h --without-gossip >> /opt/ori/data/ori.log 2>&1 &
+celery --app=ocd_backend.app:celery_app --quiet worker --loglevel=info -Q loaders --concurrency=1 -n loaders@%h --without-gossip >> /opt/ori/data/ori.log 2>&1
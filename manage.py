@@ -22,7 +22,8 @@ from ocd_backend.es import setup_elasticsearch
 from ocd_backend.models.postgres_database import PostgresDatabase
 from ocd_backend.models.postgres_models import ItemHash, Property, Resource, Source, StoredDocument
 from ocd_backend.models.serializers import PostgresSerializer
-from ocd_backend.pipeline import setup_pipeline
+from ocd_backend.local_pipeline import run_local_pipeline
+from ocd_backend.pipeline import setup_pipeline, start_source_run
 from ocd_backend.settings import SOURCES_CONFIG_FILE, \
     DEFAULT_INDEX_PREFIX, DUMPS_DIR, REDIS_HOST, REDIS_PORT
 from ocd_backend.utils.indexed_file import IndexedFile
@@ -338,7 +339,8 @@ def extract_list_sources(sources_config):
 @click.argument('source_id')
 @click.option('--subitem', '-s', multiple=True)
 @click.option('--entiteit', '-e', multiple=True)
-def extract_start(source_id, subitem, entiteit, sources_config):
+@click.option('--replay', is_flag=True, help='Use the archived responses of the source instead of fetching them')
+def extract_start(source_id, subitem, entiteit, replay, sources_config):
     """
     Start extraction for a pipeline specified by ``source_id`` defined in
     ``--sources-config``. ``--sources-config defaults to ``settings.SOURCES_CONFIG_FILE``.
@@ -351,10 +353,14 @@ def extract_start(source_id, subitem, entiteit, sources_config):
 
     Note: ``--subitem`` and ``--entiteit`` only work in new-style yaml configurations.
 
+    With ``--replay`` the extractors are served from the response archive, without network I/O,
+    and all items are transformed and loaded again. See ``ocd_backend.utils.response_archive``.
+
     :param sources_config: Path to file containing pipeline definitions. Defaults to the value of ``settings.SOURCES_CONFIG_FILE``
     :param source_id: identifier used in ``--sources_config`` to describe pipeline
     :param subitem: one ore more items under the parent `source_id`` to specify which subitems should be run
     :param entiteit: one ore more entity arguments to specify which entities should be run
+    :param replay: if set, run the pipelines from the response archive
     """
 
     sources = load_sources_config(sources_config)
@@ -370,6 +376,8 @@ def extract_start(source_id, subitem, entiteit, sources_config):
 
     # Check for old-style json sources
     if 'id' in source:
+        if replay:
+            source['replay'] = '1'
         setup_pipeline.delay(source, uuid4().hex)
         return
 
@@ -393,17 +401,84 @@ def extract_start(source_id, subitem, entiteit, sources_config):
         source_run_uuid = uuid4().hex
 
         selected_entities = []
+        new_sources = []
         for item in source.get('entities'):
             if (not entiteit and item) or (entiteit and item.get('entity') in entiteit):
                 selected_entities.append(item.get('entity'))
 
                 new_source = deepcopy(source)
                 new_source.update(item)
-                setup_pipeline.delay(new_source, source_run_uuid)
+                if replay:
+                    new_source['replay'] = '1'
+                new_sources.append(new_source)
+
+        start_source_run(new_sources, source_run_uuid)
 
         click.echo('[%s] Processed pipelines: %s' % (source_id, ', '.join(selected_entities)))
 
 
+@click.command('run_local')
+@click.option('--sources_config', default=SOURCES_CONFIG_FILE)
+@click.argument('source_id')
+@click.option('--subitem', '-s', multiple=True)
+@click.option('--entiteit', '-e', multiple=True)
+@click.option('--workers', default=4, help='Number of worker processes')
+@click.option('--start_date', default=None)
+@click.option('--end_date', default=None)
+@click.option('--replay', is_flag=True, help='Use the archived responses of the source instead of fetching them')
+def extract_run_local(source_id, subitem, entiteit, workers, start_date, end_date, replay, sources_config):
+    """
+    Run the pipeline for ``source_id`` in-process, without a broker or Celery workers.
+    Items are processed by ``--workers`` processes and the throughput per stage is
+    reported at the end. Sources are selected like in ``extract start``.
+
+    :param sources_config: Path to file containing pipeline definitions. Defaults to the value of ``settings.SOURCES_CONFIG_FILE``
+    :param source_id: identifier used in ``--sources_config`` to describe pipeline
+    :param subitem: one ore more items under the parent `source_id`` to specify which subitems should be run
+    :param entiteit: one ore more entity arguments to specify which entities should be run
+    :param workers: number of worker processes used for transforming, enriching and loading
+    :param start_date: If passed, use this start_date for the run
+    :param end_date: If passed, use this end_date for the run
+    :param replay: if set, run the pipelines from the response archive
+    """
+    sources = load_sources_config(sources_config)
+
+    source = sources.get(source_id)
+    if not source:
+        click.echo('Error: unable to find source with id "%s" in sources '
+                   'config' % source_id)
+        return
+
+    settings = {}
+    if start_date is not None:
+        settings['start_date'] = start_date
+    if end_date is not None:
+        settings['end_date'] = end_date
+    if replay:
+        settings['replay'] = '1'
+
+    if 'id' in source or 'entities' in source:
+        selected_sources = {source_id: source}
+    elif subitem:
+        selected_sources = {s: source[s] for s in subitem}
+    else:
+        selected_sources = source
+
+    for source_id, source in selected_sources.items():
+        entities = source.get('entities') or [{}]
+        for item in entities:
+            if entiteit and item.get('entity') not in entiteit:
+                continue
+
+            new_source = deepcopy(source)
+            new_source.update(item)
+            new_source.update(settings)
+
+            click.echo('[%s] Running %s locally with %d workers' % (source_id, new_source.get('id'), workers))
+            statistics = run_local_pipeline(new_source, workers=workers)
+            click.echo(statistics.report())
+
+
 @click.command('load_redis')
 @click.argument('modus')
 @click.option('--source_path', default='*')
@@ -516,6 +591,7 @@ def extract_process(modus, source_path, sources_config, start_date, end_date, lo
             IndexedFile(settings.get('indexed_filename')).signal_start(source_name)
 
             selected_entities = []
+            new_sources = []
             for entity in available_source.get('entities', []):
                 if not enabled_entities or entity.get('entity') in enabled_entities:
                     selected_entities.append(entity.get('entity'))
@@ -524,8 +600,9 @@ def extract_process(modus, source_path, sources_config, start_date, end_date, lo
                     new_source = deepcopy(settings)
                     new_source.update(deepcopy(available_source))
                     new_source.update(entity)
+                    new_sources.append(new_source)
 
-                    setup_pipeline.delay(new_source, source_run_uuid)
+            start_source_run(new_sources, source_run_uuid)
 
             click.echo('[%s] Started pipelines: %s' % (source_name, ', '.join(selected_entities)))
         except ValueError:
@@ -602,6 +679,13 @@ def developers_purge_dbs(ctx):
     except Exception as e:
         print(f'Error purging redis database 1: {e}')
 
+    # Caches and rate limiter buckets shared by the workers
+    try:
+        redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=2, decode_responses=True)
+        redis_client.flushdb()
+    except Exception as e:
+        print(f'Error purging redis database 2: {e}')
+
     # Elastic Search
     try:
         indices = ctx.invoke(available_indices)
@@ -656,6 +740,7 @@ extract.add_command(extract_list_sources)
 extract.add_command(extract_start)
 extract.add_command(extract_process)
 extract.add_command(extract_load_redis)
+extract.add_command(extract_run_local)
 
 developers.add_command(developers_purge_dbs)
 developers.add_command(developers_process_pdfs)
@@ -0,0 +1,30 @@
+"""Add provider, site_name and item_type columns to item_hash
+
+Revision ID: 5e1f0c7d2b9a
+Revises: a9767ffe85e4
+Create Date: 2026-10-18 17:30:12.418207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e1f0c7d2b9a'
+down_revision = 'a9767ffe85e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('item_hash', sa.Column('provider', sa.String(), nullable=True))
+    op.add_column('item_hash', sa.Column('site_name', sa.String(), nullable=True))
+    op.add_column('item_hash', sa.Column('item_type', sa.String(), nullable=True))
+    op.create_index('ix_item_hash_provider_site_name_item_type', 'item_hash', ['provider', 'site_name', 'item_type'])
+
+
+def downgrade():
+    op.drop_index('ix_item_hash_provider_site_name_item_type', table_name='item_hash')
+    op.drop_column('item_hash', 'item_type')
+    op.drop_column('item_hash', 'site_name')
+    op.drop_column('item_hash', 'provider')
@@ -0,0 +1,33 @@
+"""Add unique index on resource, iri and canonical_id to source
+
+Revision ID: c3a8e4f19d62
+Revises: 5e1f0c7d2b9a
+Create Date: 2026-10-18 19:05:41.730164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a8e4f19d62'
+down_revision = '5e1f0c7d2b9a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Concurrent updates could create the same Source more than once, keep the oldest
+    op.execute(
+        'DELETE FROM source USING source AS original '
+        'WHERE source.resource_ori_id = original.resource_ori_id '
+        'AND source.iri = original.iri '
+        'AND source.canonical_id = original.canonical_id '
+        'AND source.id > original.id'
+    )
+    op.create_index('ix_source_resource_ori_id_iri_canonical_id', 'source',
+                    ['resource_ori_id', 'iri', 'canonical_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_source_resource_ori_id_iri_canonical_id', table_name='source')
@@ -0,0 +1,27 @@
+"""Increment ori_id_seq by 1000 to reserve ORI ids in blocks
+
+Revision ID: f47b2d9e0a15
+Revises: c3a8e4f19d62
+Create Date: 2026-10-18 19:48:26.093518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f47b2d9e0a15'
+down_revision = 'c3a8e4f19d62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Each value of the sequence now reserves the ids up to the next value
+    op.execute('ALTER SEQUENCE ori_id_seq INCREMENT BY 1000')
+
+
+def downgrade():
+    # Values handed out after the last nextval are still in use, skip past them
+    op.execute("SELECT setval('ori_id_seq', nextval('ori_id_seq') + 1000)")
+    op.execute('ALTER SEQUENCE ori_id_seq INCREMENT BY 1')
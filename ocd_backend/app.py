@@ -32,6 +32,22 @@ celery_app = Celery('ocd_backend', include=[
 
 celery_app.conf.update(**CELERY_CONFIG)
 
+
+@signals.celeryd_init.connect
+def preload_wsdl(options=None, **_kwargs):
+    # The iBabs extractors run in setup_pipeline, workers that do not consume its queue
+    # do not need the WSDL
+    queues = (options or {}).get('queues') or []
+    if isinstance(queues, str):
+        queues = queues.split(',')
+    if queues and CELERY_CONFIG['task_routes']['ocd_backend.pipeline.*']['queue'] not in queues:
+        return
+
+    # Parsed once in the main process, the pool processes inherit the parsed WSDL
+    from ocd_backend.extractors.ibabs import preload_wsdl
+    preload_wsdl()
+
+
 #@signals.worker_init.connect
 # @signals.celeryd_init.connect
 # def init_sentry(**_kwargs):
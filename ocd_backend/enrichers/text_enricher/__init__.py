@@ -2,7 +2,6 @@ import sys
 import os
 from urllib3.exceptions import LocationParseError
 from urllib import parse
-from tempfile import NamedTemporaryFile
 
 import requests
 import sqlalchemy as sa
@@ -14,6 +13,7 @@ from ocd_backend.log import get_source_logger
 from ocd_backend.settings import RESOLVER_BASE_URL, RETRY_MAX_RETRIES, OCR_VERSION, MARKDOWN_VERSION
 from ocd_backend.models.postgres_database import PostgresDatabase
 from ocd_backend.models.serializers import PostgresSerializer
+from ocd_backend.utils import claim_check
 from ocd_backend.utils.file_parsing import file_parser, make_temp_pdf_fname, md_file_parser, md_file_parser_using_ocr, parse_result_is_empty, rewrite_problematic_pdfs, force_ocr
 from ocd_backend.utils.http import HttpRequestSimple
 from ocd_backend.utils.misc import strip_scheme
@@ -115,14 +115,13 @@ class TextEnricher(BaseEnricher):
                 item.content_type = resource.content_type
                 item.size_in_bytes = resource.file_size
 
-                # Make sure file_object is actually on the disk for pdf parsing
-                # Pass delete=False, since we keep the file
-                temporary_file = NamedTemporaryFile(delete=False)
-                temporary_file.write(resource.read())
-                temporary_file.close()
+                # Make sure file_object is actually on the disk for pdf parsing,
+                # the file is kept since it is moved to the document storage
+                temporary_path = resource.to_path()
+                resource.media_file.close()
 
-                if os.path.exists(temporary_file.name):
-                    path = os.path.realpath(temporary_file.name)
+                if os.path.exists(temporary_path):
+                    path = os.path.realpath(temporary_path)
                     item.text = file_parser(path, item.original_url, max_pages=100)
 
                     # Now get the markdown using pymupdf4llm. If there are pages with many bboxes, force OCR otherwise
@@ -175,6 +174,9 @@ class TextEnricher(BaseEnricher):
 
         item.db.save(item)
 
+        # Keep the large texts out of the broker on the way to the loaders
+        claim_check.check_in(item)
+
     def exclude_from_ocr(self, url):
         # Some files lead to an OOM every time they are processed. Exclude them
         oom_pdfs = [
@@ -42,3 +42,8 @@ class InvalidDatetime(ValueError):
 class InvalidFile(OSError):
     """Exception thrown when a file on the filesystem is corrupted
     or does not seem correct"""
+
+
+class ResponseNotArchived(Exception):
+    """Thrown when a source is replayed and the response to a request
+    is not in the response archive."""
@@ -6,12 +6,14 @@ from hashlib import sha1
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 
-from ocd_backend.hash_for_item import HashForItem
+from ocd_backend.hash_for_item import HashForItem, set_item_scope, set_processed
 from ocd_backend.log import get_source_logger
 from ocd_backend.models.model import PostgresDatabase
 from ocd_backend.models.serializers import PostgresSerializer
 from ocd_backend.models.postgres_models import ItemHash
+from ocd_backend.settings import HASH_EXCLUDED_FIELDS
 from ocd_backend.utils.misc import hash_utils, json_encoder
+from ocd_backend.utils.response_archive import is_replay
 
 log = get_source_logger('extractor')
 
@@ -29,11 +31,27 @@ class BaseExtractor:
         database = PostgresDatabase(serializer=PostgresSerializer)
         self.session = database.Session()
 
-    def _make_hash(self, report_dict):
+        # The checkpoint describes which units of work (e.g. pages or date intervals)
+        # were completed. setup_pipeline stores it, and sets resume_checkpoint to the
+        # stored value when a run is retried so the extractor can skip those units.
+        self.checkpoint = {}
+        self.resume_checkpoint = {}
+
+        # Stored item hashes by provider, site and item type, see stored_item_hashes
+        self.item_hashes = {}
+        # Stored item hashes without provider, site and item type, see unscoped_item_hashes
+        self.legacy_item_hashes = None
+
+    def _make_hash(self, report_dict, item_type=None):
         """
-        Make a hash value for a dict. This can be usedc to compare dicts to an
-        earlier stored hash vlue to see if things changed.
+        Make a hash value for a dict. This can be used to compare dicts to an
+        earlier stored hash value to see if things changed.
         """
+        excluded_fields = self.source_definition.get('hash_excluded_fields', HASH_EXCLUDED_FIELDS).get(item_type)
+        return hash_utils.fingerprint(report_dict, excluded_fields)
+
+    def _make_legacy_hash(self, report_dict):
+        """The hash value that was used before fingerprints were versioned"""
         if isinstance(report_dict, dict):
             obj = OrderedDict(report_dict.items())
         else:
@@ -45,24 +63,75 @@ class BaseExtractor:
     def hash_for_item(self, provider, site_name, item_type, id, report_dict):
         """
         Determine hash value for report_dict.
-        Return the value (HashForItem object) if item has not been processed before or if force == 1
+        Return the value (HashForItem object) if item has not been processed before or if force == 1.
+        A replayed source processes all items again.
         """
         hash_key = hash_utils.create_hash_key(provider, site_name, item_type, id)
-        hash_value = self._make_hash(report_dict)
+        hash_value = self._make_hash(report_dict, item_type)
         hash_for_item = HashForItem(hash_key, hash_value, provider, site_name, item_type, id)
 
-        should_force = (self.source_definition.get('force', '0') == '1')
+        should_force = (self.source_definition.get('force', '0') == '1') or is_replay(self.source_definition)
         if should_force:
             return hash_for_item
 
-        old_item = self.session.query(ItemHash).filter(ItemHash.item_id == hash_key).first()
-        if not old_item:
+        stored_item_hashes = self.stored_item_hashes(provider, site_name, item_type)
+        if hash_key in stored_item_hashes:
+            return self._changed(hash_for_item, stored_item_hashes[hash_key], report_dict)
+
+        unscoped_item_hashes = self.unscoped_item_hashes()
+        if hash_key not in unscoped_item_hashes:
+            # A new item
             return hash_for_item
 
-        if old_item.item_hash == hash_value:
+        # The row gets the provider, site and item type, so it is preloaded from the next run on
+        old_item = self.session.query(ItemHash).filter(ItemHash.item_id == hash_key).first()
+        if old_item is not None and old_item.provider is None:
+            set_item_scope(old_item, hash_for_item)
+            self.session.commit()
+
+        return self._changed(hash_for_item, unscoped_item_hashes.pop(hash_key), report_dict)
+
+    def _changed(self, hash_for_item, stored_hash_value, report_dict):
+        """Returns hash_for_item if the item changed since stored_hash_value was stored, otherwise False"""
+        if stored_hash_value == hash_for_item.hash_value:
             return False
 
-        return hash_for_item
+        if hash_utils.is_current_fingerprint(stored_hash_value) or \
+                stored_hash_value != self._make_legacy_hash(report_dict):
+            return hash_for_item
+
+        # Unchanged since it was stored with the legacy hash, which is replaced so the item
+        # is not processed again
+        set_processed(self.session, hash_for_item)
+        return False
+
+    def stored_item_hashes(self, provider, site_name, item_type):
+        """Returns the stored hash values by hash key for the items of a source, loaded at first use"""
+        scope = (str(provider), str(site_name), str(item_type))
+        try:
+            return self.item_hashes[scope]
+        except KeyError:
+            pass
+
+        query = self.session.query(ItemHash.item_id, ItemHash.item_hash).filter(
+            ItemHash.provider == scope[0],
+            ItemHash.site_name == scope[1],
+            ItemHash.item_type == scope[2],
+        )
+        self.item_hashes[scope] = {item_id: item_hash for item_id, item_hash in query.yield_per(10000)}
+        log.debug(f'[{self.source_definition.get("key")}] Loaded {len(self.item_hashes[scope])} item hashes for {"/".join(scope)}')
+        return self.item_hashes[scope]
+
+    def unscoped_item_hashes(self):
+        """Returns the stored hash values by hash key of the rows that were stored before the
+        provider, site and item type were recorded, loaded at first use. Once these columns
+        have been filled in for all rows, this is an empty dict."""
+        if self.legacy_item_hashes is None:
+            query = self.session.query(ItemHash.item_id, ItemHash.item_hash).filter(ItemHash.provider.is_(None))
+            self.legacy_item_hashes = {item_id: item_hash for item_id, item_hash in query.yield_per(10000)}
+            log.debug(f'[{self.source_definition.get("key")}] Loaded {len(self.legacy_item_hashes)} item hashes '
+                      f'without provider, site and item type')
+        return self.legacy_item_hashes
 
     def run(self):
         """Starts the extraction process.
@@ -81,6 +150,20 @@ class BaseExtractor:
         """
         raise NotImplementedError
 
+    def checkpointed(self, units):
+        """Yields `units` (e.g. date intervals), skipping the ones that were completed
+        before the run was restarted. Every unit before the one that is yielded is
+        recorded as completed in the checkpoint."""
+        resume_index = self.resume_checkpoint.get('unit', 0)
+        if resume_index:
+            log.info(f'[{self.source_definition["key"]}] Resuming extraction at unit {resume_index}')
+
+        for index, unit in enumerate(units):
+            if index < resume_index:
+                continue
+            self.checkpoint = {'unit': index}
+            yield unit
+
     def _interval_delta(self):
         """Returns a datetime delta.
 
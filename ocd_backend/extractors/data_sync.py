@@ -1,3 +1,7 @@
+import heapq
+from itertools import groupby
+from operator import itemgetter
+
 from ocd_backend.extractors import BaseExtractor
 from ocd_backend.log import get_source_logger
 from ocd_backend.utils.misc import load_object, load_sources_config
@@ -5,12 +9,27 @@ from ocd_backend.utils.misc import load_object, load_sources_config
 log = get_source_logger('extractor')
 
 
+class UnsortedInputError(ValueError):
+    """Raised when the items of a dataset that should be sorted are not sorted by key"""
+
+
 class DataSyncBaseExtractor(BaseExtractor):
     """
     A data synchronizer extractor. Takes two (or more) sources, then
     reconciles data.
+
+    When the sources yield their items sorted by `match_key`, set `sorted_inputs`
+    (or `sync_sorted_inputs` in the source definition) to reconcile them while they
+    are extracted. Otherwise all items are collected first and passed to `match_data`.
+
+    Sorted inputs are checked while they are merged. When an input turns out not to be
+    sorted, the sources are extracted again and all items are matched by `match_key`
+    after they have been collected. The items that were yielded before are then yielded
+    again, with the same data for the keys that were matched correctly.
     """
 
+    sorted_inputs = False
+
     def __init__(self, *args, **kwargs):
         super(DataSyncBaseExtractor, self).__init__(*args, **kwargs)
 
@@ -39,6 +58,64 @@ class DataSyncBaseExtractor(BaseExtractor):
         """
         raise NotImplementedError
 
+    def match_key(self, dataset_id, data_item):
+        """
+        Returns the key that identifies `data_item` (a tuple yielded by the extractor of
+        dataset `dataset_id`) across the datasets. Required when the inputs are sorted.
+        """
+        raise NotImplementedError
+
+    def merge_join(self, datasets):
+        """
+        Matches the items of datasets that are sorted by `match_key`, while they are
+        extracted. `datasets` is a list of (dataset id, iterable) tuples. Yields
+        (key, data_items) tuples like the items of `match_data`, as soon as all datasets
+        have advanced past the key, so only one item per dataset is kept in memory.
+        """
+        def keyed(dataset_id, data_items):
+            previous_key = None
+            for data_item in data_items:
+                key = self.match_key(dataset_id, data_item)
+                if previous_key is not None and key < previous_key:
+                    raise UnsortedInputError(f'Items of dataset {dataset_id} are not sorted by key: '
+                                             f'{key!r} follows {previous_key!r}')
+                previous_key = key
+                yield key, dataset_id, data_item
+
+        merged = heapq.merge(*[keyed(dataset_id, data_items) for dataset_id, data_items in datasets],
+                             key=itemgetter(0))
+        for key, group in groupby(merged, key=itemgetter(0)):
+            data_items = {}
+            for _, dataset_id, data_item in group:
+                self._add_data_item(data_items, key, dataset_id, data_item)
+            yield key, data_items
+
+    def hash_join(self, datasets):
+        """
+        Matches the items of datasets by `match_key` after collecting all of them, for
+        inputs that are not sorted. Takes and returns the same as `merge_join`.
+        """
+        matched = {}
+        for dataset_id, data_items in datasets:
+            for data_item in data_items:
+                key = self.match_key(dataset_id, data_item)
+                self._add_data_item(matched.setdefault(key, {}), key, dataset_id, data_item)
+        return sorted(matched.items(), key=itemgetter(0))
+
+    def _add_data_item(self, data_items, key, dataset_id, data_item):
+        if dataset_id in data_items:
+            data_item = self.merge_duplicates(dataset_id, key, data_items[dataset_id], data_item)
+        data_items[dataset_id] = data_item
+
+    def merge_duplicates(self, dataset_id, key, data_item, duplicate):
+        """
+        Returns the data item to use when dataset `dataset_id` has more than one item with
+        `key`. Keeps the first one by default.
+        """
+        log.warning(f'[{self.source_definition.get("key")}] Dataset {dataset_id} has more than one item with '
+                    f'key {key!r}, the first one is used')
+        return data_item
+
     def select_data_item(self, data_items):
         """
         Selects a data item from a given set of matched data items from different
@@ -48,6 +125,33 @@ class DataSyncBaseExtractor(BaseExtractor):
         raise NotImplementedError
 
     def run(self):
+        if self.source_definition.get('sync_sorted_inputs', self.sorted_inputs):
+            matched_data = self.match_sorted()
+        else:
+            matched_data = self.collect_and_match()
+
+        num_counted = 0
+        num_matched = 0
+        for item_id, data_items in matched_data:
+            num_counted += 1
+            if len(data_items.keys()) > 1:
+                # log.debug((data_items)
+                num_matched += 1
+            content_type, data = self.select_data_item(data_items)
+            yield content_type, data
+        log.info("Matched %d out of %d items." % (num_matched, num_counted,))
+
+    def match_sorted(self):
+        """Matches the sorted datasets while they are extracted, see `merge_join`"""
+        try:
+            yield from self.merge_join([(x.source_definition['id'], x.run() or []) for x in self.extractors])
+        except UnsortedInputError as e:
+            log.warning(f'[{self.source_definition.get("key")}] {e}. All items are matched again after '
+                        f'extracting them.')
+            yield from self.hash_join([(x.source_definition['id'], x.run() or []) for x in self.extractors])
+
+    def collect_and_match(self):
+        """Extracts all datasets before matching them with `match_data`, for unsorted inputs"""
         # list comprehension to activate the generators ...
         datasets = []
         for x in self.extractors:
@@ -64,13 +168,4 @@ class DataSyncBaseExtractor(BaseExtractor):
         # here we need to pair up the datasets (aka matching)
         matched_data = self.match_data(datasets)
         # log.debug(matched_data)
-        num_counted = 0
-        num_matched = 0
-        for item_id, data_items in matched_data.items():
-            num_counted += 1
-            if len(data_items.keys()) > 1:
-                # log.debug((data_items)
-                num_matched += 1
-            content_type, data = self.select_data_item(data_items)
-            yield content_type, data
-        log.info("Matched %d out of %d items." % (num_matched, num_counted,))
+        return matched_data.items()
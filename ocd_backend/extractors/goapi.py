@@ -1,12 +1,17 @@
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
+
+from requests import RequestException
 
 from ocd_backend.extractors import BaseExtractor
 from ocd_backend.hash_for_item import DUMMY_ITEM_HASH
 from ocd_backend.log import get_source_logger
 from ocd_backend.utils.http import HttpRequestMixin
 from ocd_backend.utils.misc import strip_scheme
+from ocd_backend.utils.rate_limiter import RateLimiter
 
 log = get_source_logger('extractor')
 
@@ -16,6 +21,8 @@ class GemeenteOplossingenBaseExtractor(BaseExtractor, HttpRequestMixin):
     A base extractor for the GemeenteOplossingen API. This base extractor just
     configures the base url to use for accessing the API.
     """
+    # Number of date intervals that an extractor retrieves concurrently
+    fetch_workers = 4
 
     def run(self):
         pass
@@ -27,6 +34,49 @@ class GemeenteOplossingenBaseExtractor(BaseExtractor, HttpRequestMixin):
         self.base_url = '%s/%s/' % (
             self.source_definition['base_url'], self.api_version,)
 
+    def fetch_intervals(self, path_for_interval):
+        """
+        Retrieves the date intervals concurrently and yields a (start_date, end_date, path,
+        total, results) tuple for each of them in date order. Results that arrive early
+        wait in a reorder buffer, which holds at most `fetch_workers` intervals.
+
+        A GO host can serve several sources, so the requests are made within the
+        `rate_limit` budget of the host, which is shared by all workers.
+        """
+        fetch_workers = int(self.source_definition.get('fetch_workers', self.fetch_workers))
+        rate_limiter = RateLimiter.for_source(self.source_definition, urlparse(self.base_url).netloc)
+
+        def request(path):
+            rate_limiter.acquire()
+            try:
+                result = self._request(path)
+            except RequestException:
+                rate_limiter.backoff()
+                raise
+            rate_limiter.succeeded()
+            return result
+
+        # Created here, so the threads share a single session
+        self.http_session
+
+        def completed(pending_interval):
+            index, start_date, end_date, path, future = pending_interval
+            total, results = future.result()
+            # Intervals before this one have been yielded
+            self.checkpoint = {'unit': index}
+            return start_date, end_date, path, total, results
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            for index, (start_date, end_date) in self.checkpointed(enumerate(self.interval_generator())):
+                path = path_for_interval(start_date, end_date)
+                pending.append((index, start_date, end_date, path, executor.submit(request, path)))
+                if len(pending) >= fetch_workers:
+                    yield completed(pending.popleft())
+
+            while pending:
+                yield completed(pending.popleft())
+
     def _request(self, path):
         log.debug(f'Now retrieving: {urljoin(self.base_url, path)}')
         resp = self.http_session.get(
@@ -84,24 +134,24 @@ class GemeenteOplossingenMeetingsExtractor(GemeenteOplossingenBaseExtractor):
     Extracts meetings from the GemeenteOplossingen API.
     """
 
+    def meetings_path(self, start_date, end_date):
+        # v2 requires dates in YYYY-MM-DD format, instead of a unix timestamp
+        if self.source_definition.get('api_version') == 'v2':
+            return 'meetings?date_from=%s&date_to=%s' % (
+                start_date.strftime('%Y-%m-%d'),
+                end_date.strftime('%Y-%m-%d')
+            )
+        return 'meetings?date_from=%i&date_to=%i' % (
+            (start_date - datetime(1970, 1, 1)).total_seconds(),
+            (end_date - datetime(1970, 1, 1)).total_seconds()
+        )
+
     def run(self):
         meeting_count = 0
         meetings_skipped = 0
 
-        for start_date, end_date in self.interval_generator():
-            # v2 requires dates in YYYY-MM-DD format, instead of a unix timestamp
-            if self.source_definition.get('api_version') == 'v2':
-                url = 'meetings?date_from=%s&date_to=%s' % (
-                    start_date.strftime('%Y-%m-%d'),
-                    end_date.strftime('%Y-%m-%d')
-                )
-            else:
-                url = 'meetings?date_from=%i&date_to=%i' % (
-                    (start_date - datetime(1970, 1, 1)).total_seconds(),
-                    (end_date - datetime(1970, 1, 1)).total_seconds()
-                )
+        for start_date, end_date, url, total, static_json in self.fetch_intervals(self.meetings_path):
             cached_path = strip_scheme(urljoin(self.base_url, url))
-            total, static_json = self._request(url)
 
             for meeting in static_json:
                 hash_for_item = self.hash_for_item('go', self.source_definition["key"], 'meeting', meeting['id'], meeting)
@@ -164,19 +214,20 @@ class GemeenteOplossingenDocumentsExtractor(GemeenteOplossingenBaseExtractor):
     Extracts documents from the GemeenteOplossingen API.
     """
 
+    @staticmethod
+    def documents_path(start_date, end_date):
+        return 'documents?publicationDate_from=%s&publicationDate_to=%s&limit=50000' % (
+            start_date.isoformat(),
+            end_date.isoformat()
+        )
+
     def run(self):
         document_count = 0
         documents_skipped = 0
 
-        for start_date, end_date in self.interval_generator():
-            url = 'documents?publicationDate_from=%s&publicationDate_to=%s&limit=50000' % (
-                start_date.isoformat(),
-                end_date.isoformat()
-            )
+        for start_date, end_date, url, total, docs in self.fetch_intervals(self.documents_path):
             cached_path = strip_scheme(urljoin(self.base_url, url))
 
-            total, docs = self._request(url)
-
             for doc in docs:
                 api_version = self.source_definition.get('api_version', 'v1')
                 base_url = '%s/%s' % (self.source_definition['base_url'], api_version,)
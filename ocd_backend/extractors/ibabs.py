@@ -1,20 +1,24 @@
 import base64
+import os
 import re
 import json
+import time
 from collections import OrderedDict
 from hashlib import sha1
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 
-from ocd_backend.hash_for_item import DUMMY_ITEM_HASH
+from ocd_backend.hash_for_item import DUMMY_ITEM_HASH, set_processed
 import redis
-from requests import Session
+from requests import Session, RequestException
 
 from zeep.client import Client, Settings
 from zeep.exceptions import Error, Fault
 from zeep.helpers import serialize_object
-from zeep.cache import SqliteCache
+from zeep.cache import Base
 from zeep.transports import Transport
+from zeep.wsdl import Document
 
 import iso8601
 
@@ -23,13 +27,135 @@ from ocd_backend.extractors import BaseExtractor
 from ocd_backend.log import get_source_logger
 from ocd_backend.utils.ibabs import (
     meeting_to_dict, list_entry_response_to_dict, votes_to_dict)
-from ocd_backend.utils.misc import is_valid_date, json_encoder, is_valid_iso8601_date, str_to_datetime
+from ocd_backend.utils.misc import is_valid_date, json_encoder, is_valid_iso8601_date, str_to_datetime, \
+    write_file_atomically
+from ocd_backend.utils import response_archive
+from ocd_backend.utils.rate_limiter import RateLimiter
 from ocd_backend.settings import SOURCES_CONFIG_FILE, \
     DEFAULT_INDEX_PREFIX, DUMPS_DIR, REDIS_HOST, REDIS_PORT
 
 log = get_source_logger('extractor')
 
 
+class RateLimitedTransport(Transport):
+    """
+    A zeep transport that sends SOAP requests within the rate budget of the source,
+    and backs off when iBabs returns a fault or throttles. Only throttling pauses the
+    other iBabs sites as well.
+    """
+
+    def __init__(self, rate_limiter, *args, **kwargs):
+        super(RateLimitedTransport, self).__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    def post(self, address, message, headers):
+        self.rate_limiter.acquire()
+        try:
+            response = super(RateLimitedTransport, self).post(address, message, headers)
+        except RequestException:
+            self.rate_limiter.backoff()
+            raise
+
+        if response.status_code in (429, 503):
+            retry_after = response.headers.get('Retry-After', '')
+            self.rate_limiter.backoff(int(retry_after) if retry_after.isdigit() else None, throttled=True)
+        elif response.status_code >= 500:
+            # SOAP faults are returned with status 500
+            self.rate_limiter.backoff()
+        else:
+            self.rate_limiter.succeeded()
+        return response
+
+
+class WsdlFileCache(Base):
+    """
+    Stores the WSDL and XSD documents as files in WSDL_CACHE_PATH. Unlike the SQLite
+    cache, readers never wait for a lock: files are written to a temporary file first
+    and then renamed. Documents older than `timeout` seconds are downloaded again.
+    """
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+
+    def _path(self, url):
+        return os.path.join(self.path, sha1(url.encode('utf-8')).hexdigest())
+
+    def add(self, url, content):
+        path = self._path(url)
+        os.makedirs(self.path, exist_ok=True)
+        write_file_atomically(path, content)
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if os.path.getmtime(path) < time.time() - self.timeout:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+# Parsed WSDL documents by location, with the hash of the WSDL they were parsed from.
+# Documents parsed by the main worker process (see preload_wsdl) are inherited by all
+# pool processes.
+_wsdl_documents = {}
+
+
+def soap_settings():
+    return Settings(
+        strict=False,
+        xml_huge_tree=True,
+        xsd_ignore_sequence_order=True,
+        extra_http_headers={'User-Agent': settings.USER_AGENT},
+    )
+
+
+def create_session(source_definition=None):
+    session = Session()
+    if settings.PROXY_HOST and settings.PROXY_PORT:
+        session.proxies = {
+            'http': f'socks5://{settings.PROXY_HOST}:{settings.PROXY_PORT}',
+            'https': f'socks5://{settings.PROXY_HOST}:{settings.PROXY_PORT}'
+        }
+    response_archive.mount(session, source_definition)
+    return session
+
+
+def get_wsdl_document(wsdl, session, timeout=300):
+    """
+    Returns the parsed WSDL document at `wsdl`. The document is parsed again only
+    when the WSDL in the file cache differs from the one it was parsed from.
+    Downloads of the documents time out after `timeout` seconds.
+    """
+    transport = Transport(session=session, cache=WsdlFileCache(settings.WSDL_CACHE_PATH, settings.WSDL_CACHE_TIMEOUT),
+                          timeout=timeout)
+    wsdl_hash = sha1(transport.load(wsdl)).hexdigest()
+
+    try:
+        document_hash, document = _wsdl_documents[wsdl]
+        if document_hash == wsdl_hash:
+            return document
+        log.info(f'The WSDL at {wsdl} has changed')
+    except KeyError:
+        pass
+
+    document = Document(wsdl, transport, settings=soap_settings())
+    _wsdl_documents[wsdl] = (wsdl_hash, document)
+    return document
+
+
+def preload_wsdl():
+    """Parses the iBabs WSDL, called in the main worker process before the pool is started"""
+    # The connections of this session must not be shared with the pool processes
+    with create_session() as session:
+        try:
+            get_wsdl_document(settings.IBABS_WSDL, session, timeout=settings.WSDL_PRELOAD_TIMEOUT)
+        except Exception as e:
+            log.warning(f'Unable to preload the iBabs WSDL: {e}')
+
+
 class IBabsBaseExtractor(BaseExtractor):
     """
     A base extractor for the iBabs SOAP service. Instantiates the client
@@ -47,29 +173,18 @@ class IBabsBaseExtractor(BaseExtractor):
         except Exception:
             ibabs_wsdl = settings.IBABS_WSDL
 
-        soap_settings = Settings(
-            strict=False,
-            xml_huge_tree=True,
-            xsd_ignore_sequence_order=True,
-            extra_http_headers={'User-Agent': settings.USER_AGENT},
-        )
-
-        cache = SqliteCache(path='/tmp/sqlite.db', timeout=60)
-
-        if settings.PROXY_HOST and settings.PROXY_PORT:
-            session = Session()
-            session.proxies = {
-                'http': f'socks5://{settings.PROXY_HOST}:{settings.PROXY_PORT}',
-                'https': f'socks5://{settings.PROXY_HOST}:{settings.PROXY_PORT}'
-            }
-            transport=Transport(session=session, cache=cache)
+        session = create_session(self.source_definition)
+        if response_archive.is_replay(self.source_definition):
+            # Responses are served from the archive, so there is no budget to stay within
+            transport = Transport(session=session)
         else:
-            transport = Transport(cache=cache)
+            rate_limiter = RateLimiter.for_source(self.source_definition, self.source_definition['ibabs_sitename'])
+            transport = RateLimitedTransport(rate_limiter, session=session)
 
         try:
-            self.client = Client(ibabs_wsdl,
+            self.client = Client(get_wsdl_document(ibabs_wsdl, session),
                                  port_name='BasicHttpsBinding_IPublic',
-                                 settings=soap_settings, transport=transport)
+                                 settings=soap_settings(), transport=transport)
         except Error as e:
             log.error(f'Unable to instantiate iBabs client: {str(e)}')
             raise e
@@ -133,8 +248,6 @@ class IbabsPersonsExtractor(IBabsBaseExtractor):
             for user in users.Users.iBabsUserBasic:
                 identifier = user['UniqueId']
 
-                sleep(1)
-
                 try:
                     user_details = self.client.service.GetUser(
                         self.source_definition['ibabs_sitename'],
@@ -209,7 +322,7 @@ class IBabsMeetingsExtractor(IBabsBaseExtractor):
         meeting_count = 0
         meetings_skipped = 0
 
-        for start_date, end_date in self.interval_generator():
+        for start_date, end_date in self.checkpointed(self.interval_generator()):
             log.debug(f'[{self.source_definition["key"]}] Now processing meetings from {start_date} to {end_date}')
 
             start_date = start_date.strftime('%Y-%m-%dT%H:%M:%S')
@@ -218,8 +331,6 @@ class IBabsMeetingsExtractor(IBabsBaseExtractor):
             cached_path = 'GetMeetingsByDateRange/Sitename=%s/StartDate=%s/EndDate=%s' % (
                 self.source_definition['ibabs_sitename'], start_date, end_date)
 
-            sleep(1)
-
             meetings = self.client.service.GetMeetingsByDateRange(
                 Sitename=self.source_definition['ibabs_sitename'],
                 StartDate=start_date,
@@ -279,6 +390,8 @@ class IBabsReportsExtractor(IBabsBaseExtractor):
     Extracts reports from the iBabs SOAP Service. The source definition should
     state which kind of reports should be extracted.
     """
+    # Number of threads that retrieve list entries
+    fetch_workers = 4
 
     def run(self):
         try:
@@ -306,9 +419,9 @@ class IBabsReportsExtractor(IBabsBaseExtractor):
 
         start_date, end_date = self.date_interval()
 
+        fetch_workers = self.source_definition.get('fetch_workers', self.fetch_workers)
         total_yield_count = 0
-        for l in selected_lists:
-            sleep(1)
+        for l in self.checkpointed(selected_lists):
             try:
                 reports = self.client.service.GetListReports(Sitename=self.source_definition['ibabs_sitename'], ListId=l.Key)
             except Fault as e:
@@ -335,7 +448,6 @@ class IBabsReportsExtractor(IBabsBaseExtractor):
             total_count = 0
             yield_count = 0
             while (active_page_nr < max_pages) and (result_count == per_page):
-                sleep(1)
                 try:
                     result = self.client.service.GetListReportDataSet(
                         Sitename=self.source_definition['ibabs_sitename'],
@@ -373,41 +485,46 @@ class IBabsReportsExtractor(IBabsBaseExtractor):
                     total_count += per_page
                     continue
 
-                for item in results:
-                    item['_ListName'] = result.ListName
-                    item['_ReportName'] = result.ReportName
-                    sleep(1)
-                    try:
-                        extra_info_item = self.client.service.GetListEntry(
-                            Sitename=self.source_definition['ibabs_sitename'],
-                            ListId=l.Key,
-                            EntryId=item['id']
-                        )
-                        item['_Extra'] = list_entry_response_to_dict(extra_info_item)
-                    except Exception as e:
-                        item['_Extra'] = {}
-
-                    report_dict = serialize_object(item, dict)
-
-                    report_dict['datum'] = self.likely_date(report_dict)
-                    # There used to be a comparison of report_dict['datum'] with start_date and end_date of run.
-                    # The point is that report_dict['datum'] is not really well defined and may be
-                    # in the past for Reports just added to iBabs. Therefore the comparison was removed - if the report
-                    # has already been retrieved before, it will be filtered out due to the hash_for_item check
-                    # datum can sometimes be 'V' -- unsure what it means
-                    hash_for_item = self.hash_for_item('ibabs', self.source_definition['ibabs_sitename'], 'report', item['id'], report_dict)
-                    if hash_for_item:
-                        yield 'application/json', json_encoder.encode(report_dict), None, 'ibabs/' + cached_path, hash_for_item
-                    else:
-                        log.info('Skipped %s because we already have that one in this version' % (item['id'],))
-                    yield_count += 1
-                    total_yield_count += 1
-                    result_count += 1
+                # The list entries of this page are retrieved concurrently, within the rate budget of the site
+                with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+                    extras = executor.map(partial(self.get_list_entry, l.Key), [item['id'] for item in results])
+                    for item, extra in zip(results, extras):
+                        item['_ListName'] = result.ListName
+                        item['_ReportName'] = result.ReportName
+                        item['_Extra'] = extra
+
+                        report_dict = serialize_object(item, dict)
+
+                        report_dict['datum'] = self.likely_date(report_dict)
+                        # There used to be a comparison of report_dict['datum'] with start_date and end_date of run.
+                        # The point is that report_dict['datum'] is not really well defined and may be
+                        # in the past for Reports just added to iBabs. Therefore the comparison was removed - if the report
+                        # has already been retrieved before, it will be filtered out due to the hash_for_item check
+                        # datum can sometimes be 'V' -- unsure what it means
+                        hash_for_item = self.hash_for_item('ibabs', self.source_definition['ibabs_sitename'], 'report', item['id'], report_dict)
+                        if hash_for_item:
+                            yield 'application/json', json_encoder.encode(report_dict), None, 'ibabs/' + cached_path, hash_for_item
+                        else:
+                            log.info('Skipped %s because we already have that one in this version' % (item['id'],))
+                        yield_count += 1
+                        total_yield_count += 1
+                        result_count += 1
                 total_count += result_count
             log.debug(f'[{self.source_definition["key"]}] Report: {l.Value} -- total {total_count}, yielded {total_yield_count}')
 
         log.info(f'[{self.source_definition["key"]}] Extracted total of {total_yield_count} ibabs reports within {start_date:%Y-%m-%d} and {end_date:%Y-%m-%d}')
 
+    def get_list_entry(self, list_id, entry_id):
+        try:
+            extra_info_item = self.client.service.GetListEntry(
+                Sitename=self.source_definition['ibabs_sitename'],
+                ListId=list_id,
+                EntryId=entry_id
+            )
+            return list_entry_response_to_dict(extra_info_item)
+        except Exception:
+            return {}
+
     def likely_date(self, report_dict):
         # Usually the date is contained in `registrationdate` in iso8601 format.
         # If not, try to get one of the other known date locations
@@ -512,11 +629,11 @@ class IBabsVotesMeetingsExtractor(IBabsBaseExtractor):
             dates.reverse()
 
         meeting_count = 0
+        meetings_skipped = 0
         vote_count = 0
         passed_vote_count = 0
 
-        for start_date, end_date in dates:
-            sleep(1)
+        for start_date, end_date in self.checkpointed(dates):
             meetings = self.client.service.GetMeetingsByDateRange(
                 Sitename=self.source_definition['ibabs_sitename'],
                 StartDate=start_date,
@@ -534,6 +651,7 @@ class IBabsVotesMeetingsExtractor(IBabsBaseExtractor):
             else:
                 sorted_meetings = []
 
+            # The watermark of each meeting with its processed votes
             processed = []
             for meeting in sorted_meetings:
                 meeting_dict = meeting_to_dict(meeting)
@@ -542,6 +660,15 @@ class IBabsVotesMeetingsExtractor(IBabsBaseExtractor):
                 meeting_dict['Meetingtype'] = meeting_types[
                     meeting_dict['MeetingtypeId']]
 
+                # The meeting includes its items and list entries with the vote result and the
+                # number of votes in favour and against (see list_entry_to_dict), but not the votes
+                # per member that GetListEntryVotes returns. The votes of a meeting with the same
+                # fingerprint as before are not retrieved again.
+                meeting_hash_for_item = self.hash_for_item('ibabs', self.source_definition['ibabs_sitename'], 'voting_meeting', meeting_dict['Id'], meeting_dict)
+                if not meeting_hash_for_item:
+                    meetings_skipped += 1
+                    continue
+
                 kv = self.client.factory.create('ns0:iBabsKeyValue')  # pylint: disable=no-member
                 kv.Key = 'IncludeMeetingItems'
                 kv.Value = True
@@ -559,22 +686,20 @@ class IBabsVotesMeetingsExtractor(IBabsBaseExtractor):
                 params.iBabsKeyValue.append(kv2)
                 params.iBabsKeyValue.append(kv3)
 
-                sleep(1)
-
                 vote_meeting = self.client.service.GetMeetingWithOptions(
                     Sitename=self.source_definition['ibabs_sitename'],
                     MeetingId=meeting_dict['Id'],
                     Options=params)
                 meeting_dict_short = meeting_to_dict(vote_meeting.Meeting)
                 # log.debug(meeting_dict_short['MeetingDate'])
+                meeting_results = []
+                processed.append((meeting_hash_for_item, meeting_results))
                 if meeting_dict_short['MeetingItems'] is None:
                     continue
                 for mi in meeting_dict_short['MeetingItems']:
                     if mi['ListEntries'] is None:
                         continue
                     for le in mi['ListEntries']:
-                        sleep(1)
-
                         votes = self.client.service.GetListEntryVotes(
                             Sitename=self.source_definition['ibabs_sitename'],
                             EntryId=le['EntryId'])
@@ -590,19 +715,34 @@ class IBabsVotesMeetingsExtractor(IBabsBaseExtractor):
                         }
                         vote_count += 1
                         if self.valid_meeting(result):
-                            processed += self.process_meeting(result)
+                            meeting_results += self.process_meeting(result)
                 meeting_count += 1
 
             # log.debug(processed)
-            for result in processed:
-                hash_for_item = self.hash_for_item('ibabs', self.source_definition['ibabs_sitename'], 'voting', result['meeting']['Id'], result)
-                if hash_for_item:
+            for meeting_hash_for_item, meeting_results in processed:
+                changed = []
+                for result in meeting_results:
+                    hash_for_item = self.hash_for_item('ibabs', self.source_definition['ibabs_sitename'], 'voting', result['meeting']['Id'], result)
+                    if hash_for_item:
+                        changed.append((result, hash_for_item))
+                    passed_vote_count += 1
+
+                if not changed:
+                    # No votes of the meeting are passed on, so there is nothing to wait for
+                    set_processed(self.session, meeting_hash_for_item)
+                    continue
+
+                # The finalizer of the last vote of the meeting stores the watermark of the
+                # meeting, so the votes are retrieved again when the pipeline stops before that
+                for result, hash_for_item in changed[:-1]:
                     yield 'application/json', json.dumps(result), None, None, hash_for_item
-                passed_vote_count += 1
+                result, hash_for_item = changed[-1]
+                yield 'application/json', json.dumps(result), None, None, [hash_for_item, meeting_hash_for_item]
             log.debug(f'[{self.source_definition["key"]}] Now processing meetings from {start_date} to {end_date}')
 
         log.info(f'[{self.source_definition["key"]}] Extracted total of {meeting_count} ibabs meetings and passed '
-                 f'{passed_vote_count} out of {vote_count} voting rounds.')
+                 f'{passed_vote_count} out of {vote_count} voting rounds. Also skipped {meetings_skipped} unchanged '
+                 f'ibabs meetings.')
 
 
 # Needs to be re-written without using FrontendAPIMixin which has been removed
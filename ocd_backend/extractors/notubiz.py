@@ -1,16 +1,71 @@
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
 
+import redis
 from requests.exceptions import HTTPError, RetryError, ConnectionError
 
 from ocd_backend.extractors import BaseExtractor
 from ocd_backend.hash_for_item import DUMMY_ITEM_HASH
 from ocd_backend.log import get_source_logger
+from ocd_backend.settings import REDIS_HOST, REDIS_PORT, NOTUBIZ_ORGANIZATIONS_CACHE_TTL, \
+    NOTUBIZ_ORGANIZATIONS_CACHE_MAX_AGE
 from ocd_backend.utils.http import HttpRequestMixin
 from ocd_backend.utils.retry_utils import is_retryable_error
 
 log = get_source_logger('extractor')
 
+# Parsed organisation metadata, shared by the extractors through Redis and kept in memory
+# by each worker process
+redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=2, decode_responses=True)
+_organizations_cache = {}
+
+
+def _redis_key(cache_key):
+    return f'ori_notubiz_{cache_key}'
+
+
+def _get_cached(cache_key):
+    cached = _organizations_cache.get(cache_key)
+    if cached and cached['expires'] > time.time():
+        return cached
+
+    try:
+        value = redis_client.get(_redis_key(cache_key))
+    except redis.RedisError as e:
+        log.warning(f'Unable to read Notubiz {cache_key} from Redis: {e}')
+        return cached
+
+    if value:
+        cached = json.loads(value)
+        _organizations_cache[cache_key] = cached
+    return cached
+
+
+def _set_cached(cache_key, cached):
+    _organizations_cache[cache_key] = cached
+    try:
+        # Expired entries are kept for a while, so they can be revalidated
+        redis_client.set(_redis_key(cache_key), json.dumps(cached), ex=NOTUBIZ_ORGANIZATIONS_CACHE_MAX_AGE)
+    except redis.RedisError as e:
+        log.warning(f'Unable to store Notubiz {cache_key} in Redis: {e}')
+
+
+def _encode_organizations(organizations):
+    # JSON objects only have string keys, so the ids are stored in lists to keep their type
+    return [[organization_id, organization.get('logo'), list(organization['attributes'].items())]
+            for organization_id, organization in organizations.items()]
+
+
+def _decode_organizations(value):
+    organizations = dict()
+    for organization_id, logo, attributes in value:
+        organizations[organization_id] = {'attributes': dict(attributes)}
+        if logo is not None:
+            organizations[organization_id]['logo'] = logo
+    return organizations
+
 
 class NotubizBaseExtractor(BaseExtractor, HttpRequestMixin):
     """
@@ -28,30 +83,68 @@ class NotubizBaseExtractor(BaseExtractor, HttpRequestMixin):
     def __init__(self, *args, **kwargs):
         super(NotubizBaseExtractor, self).__init__(*args, **kwargs)
 
+        # Create a dictionary of Notubiz organizations. Some child classes need information
+        # from this dictionary.
+        self.organizations = self.get_organizations()
+
+    def get_organizations(self):
+        """
+        Returns the logo and field_id <-> label definitions of all Notubiz organizations.
+        The /organisations document is large, so the parsed result is shared between
+        extractors for NOTUBIZ_ORGANIZATIONS_CACHE_TTL seconds. After that the cached copy
+        is revalidated with a conditional request.
+        """
+        cache_key = 'organisations_%s' % self.default_query_params
+        cached = _get_cached(cache_key)
+        if cached and cached['expires'] > time.time():
+            return _decode_organizations(cached['value'])
+
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
         response = self.http_session.get(
             "%s/organisations?%s" % (self.base_url, self.default_query_params),
+            headers=headers,
             timeout=(self.connect_timeout, 15)
         )
 
+        if cached and response.status_code == 304:
+            log.debug(f'[{self.source_definition["key"]}] Notubiz organisations not modified')
+            cached['expires'] = time.time() + NOTUBIZ_ORGANIZATIONS_CACHE_TTL
+            _set_cached(cache_key, cached)
+            return _decode_organizations(cached['value'])
+
         try:
             response.raise_for_status()
         except (HTTPError, RetryError, ConnectionError) as e:
             log.warning(f'[{self.source_definition["key"]}] {str(e)}: {response.request.url}')
+            if cached:
+                log.info(f'[{self.source_definition["key"]}] Using the expired cached Notubiz organisations')
+                return _decode_organizations(cached['value'])
             if is_retryable_error(e):
                 raise
 
-        # Create a dictionary of Notubiz organizations. Some child classes need information
-        # from this dictionary.
-        self.organizations = dict()
+        organizations = dict()
         for organization in response.json()['organisations']['organisation']:
             attributes = dict()
             for field in organization['settings']['folder']['fields']['field']:
                 attributes[field['@attributes']['id']] = field['label']
-            self.organizations[organization['@attributes']['id']] = {
+            organizations[organization['@attributes']['id']] = {
                 'logo': organization['logo'],
                 'attributes': attributes,
             }
 
+        _set_cached(cache_key, {
+            'expires': time.time() + NOTUBIZ_ORGANIZATIONS_CACHE_TTL,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'value': _encode_organizations(organizations),
+        })
+        return organizations
+
 
 class NotubizCommitteesExtractor(NotubizBaseExtractor):
     """
@@ -90,6 +183,8 @@ class NotubizMeetingsExtractor(NotubizBaseExtractor):
     """
     Extracts meetings from Notubiz.
     """
+    # Number of threads that retrieve meetings and module items
+    fetch_workers = 4
 
     def run(self):
         meeting_count = 0
@@ -100,137 +195,179 @@ class NotubizMeetingsExtractor(NotubizBaseExtractor):
 
         log.debug(f'[{self.source_definition["key"]}] Now processing first page meeting(items) from {start_date} to {end_date}')
 
-        page = 1
-        while True:
-            url = "%s/events?organisation_id=%i&date_from=%s&date_to=%s&page=%i&%s" % (
-                        self.base_url,
-                        self.source_definition['notubiz_organization_id'],
-                        start_date.strftime("%Y-%m-%d %H:%M:%S"),
-                        end_date.strftime("%Y-%m-%d %H:%M:%S"),
-                        page,
-                        self.default_query_params,
-                    )
-            try:
-                response = self.http_session.get(url, timeout=(self.connect_timeout, 15))
-            except (HTTPError, RetryError, ConnectionError) as e:
-                log.warning(f'[{self.source_definition["key"]}] error retrieving notubiz meeting {str(e)}: {parse.quote(url)}')
-                meetings_error += 1
-                if is_retryable_error(e):
-                    raise
-
-            try:
-                response.raise_for_status()
-            except (HTTPError, RetryError, ConnectionError) as e:
-                log.warning(f'[{self.source_definition["key"]}] error retrieving notubiz meeting {str(e)}: {response.request.url}')
-                meetings_error += 1
-                if is_retryable_error(e):
-                    raise
-
-            event_json = response.json()
-
-            if not event_json[self.source_definition['doc_type']]:
-                break
-
-            if page > 1:
-                log.debug(f'[{self.source_definition["key"]}] Processing events page {page}')
-
-            for item in event_json[self.source_definition['doc_type']]:
-                # Skip meetings that are not public
-                if item['permission_group'] != 'public':
-                    meetings_skipped += 1
-                    continue
-
-                meeting_url = "%s/events/meetings/%i?%s" % (
-                    self.base_url,
-                    item['id'],
-                    self.default_query_params
-                )
-                cached_path = "events/meetings/%i" % item['id']
+        page = self.resume_checkpoint.get('page', 1)
+        if page > 1:
+            log.info(f'[{self.source_definition["key"]}] Resuming extraction at events page {page}')
+
+        # The session is shared by the fetch threads, its connection pool limits the number
+        # of concurrent connections to the Notubiz API
+        fetch_workers = self.source_definition.get('fetch_workers', self.fetch_workers)
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            while True:
+                # Pages before this one are completed
+                self.checkpoint = {'page': page}
+                url = "%s/events?organisation_id=%i&date_from=%s&date_to=%s&page=%i&%s" % (
+                            self.base_url,
+                            self.source_definition['notubiz_organization_id'],
+                            start_date.strftime("%Y-%m-%d %H:%M:%S"),
+                            end_date.strftime("%Y-%m-%d %H:%M:%S"),
+                            page,
+                            self.default_query_params,
+                        )
                 try:
-                    resource = self.fetch(meeting_url, cached_path)
-                    meeting_json = json.load(resource.media_file)['meeting']
+                    response = self.http_session.get(url, timeout=(self.connect_timeout, 15))
                 except (HTTPError, RetryError, ConnectionError) as e:
-                    log.info(f'[{self.source_definition["key"]}] error occurred: {e.__class__.__name__} {str(e)}: {meeting_url}')
-                    try:
-                        error_json = e.response.json()
-                        if error_json.get('message') == 'No rights to see this meeting':
-                            log.info(f'[{self.source_definition["key"]}] No rights to view: {meeting_url}')
-                            meetings_skipped += 1
-                            break
-                    except Exception as e_inside:
-                        log.info(f'[{self.source_definition["key"]}] exception when accessing json {e_inside.__class__.__name__} {str(e_inside)}: {meeting_url}')
-
-                    # Reraise all other HTTP errors
+                    log.warning(f'[{self.source_definition["key"]}] error retrieving notubiz meeting {str(e)}: {parse.quote(url)}')
+                    meetings_error += 1
                     if is_retryable_error(e):
                         raise
-                    else:
-                        break
-                except Exception as e:
+
+                try:
+                    response.raise_for_status()
+                except (HTTPError, RetryError, ConnectionError) as e:
+                    log.warning(f'[{self.source_definition["key"]}] error retrieving notubiz meeting {str(e)}: {response.request.url}')
                     meetings_error += 1
-                    log.warning(f'[{self.source_definition["key"]}] {str(e)}: {meeting_url}')
                     if is_retryable_error(e):
                         raise
-                    else:
+
+                event_json = response.json()
+
+                if not event_json[self.source_definition['doc_type']]:
+                    break
+
+                if page > 1:
+                    log.debug(f'[{self.source_definition["key"]}] Processing events page {page}')
+
+                # The meetings on this page and their module items are retrieved concurrently,
+                # but processed and yielded in the order of the events listing
+                meetings = []
+                for item in event_json[self.source_definition['doc_type']]:
+                    # Skip meetings that are not public
+                    if item['permission_group'] != 'public':
+                        meetings_skipped += 1
+                        continue
+
+                    # If the events listing contains the modification time, unchanged meetings are
+                    # skipped without retrieving the meeting and its module items
+                    listing_hash_for_item = None
+                    if item.get('last_modified'):
+                        listing_hash_for_item = self.meeting_hash_for_item(item['id'], item['last_modified'])
+                        if not listing_hash_for_item:
+                            log.info('Skipped notubiz meeting(item) %s because we have it already' % (item['id']))
+                            meetings_skipped += 1
+                            continue
+
+                    meeting_url = "%s/events/meetings/%i?%s" % (
+                        self.base_url,
+                        item['id'],
+                        self.default_query_params
+                    )
+                    meetings.append((item, listing_hash_for_item, meeting_url,
+                                     executor.submit(self.fetch_json, meeting_url, "events/meetings/%i" % item['id'], 'meeting')))
+
+                changed_meetings = []
+                # An error that must be reraised after the preceding meetings have been yielded
+                pending_error = None
+                for item, listing_hash_for_item, meeting_url, meeting_future in meetings:
+                    try:
+                        meeting_json = meeting_future.result()
+                    except (HTTPError, RetryError, ConnectionError) as e:
+                        log.info(f'[{self.source_definition["key"]}] error occurred: {e.__class__.__name__} {str(e)}: {meeting_url}')
+                        try:
+                            error_json = e.response.json()
+                            if error_json.get('message') == 'No rights to see this meeting':
+                                log.info(f'[{self.source_definition["key"]}] No rights to view: {meeting_url}')
+                                meetings_skipped += 1
+                                break
+                        except Exception as e_inside:
+                            log.info(f'[{self.source_definition["key"]}] exception when accessing json {e_inside.__class__.__name__} {str(e_inside)}: {meeting_url}')
+
+                        # Reraise all other HTTP errors
+                        if is_retryable_error(e):
+                            pending_error = e
+                        break
+                    except Exception as e:
+                        meetings_error += 1
+                        log.warning(f'[{self.source_definition["key"]}] {str(e)}: {meeting_url}')
+                        if is_retryable_error(e):
+                            pending_error = e
                         break
 
-                try:
-                    organization = self.organizations[self.source_definition['notubiz_organization_id']]
-                except KeyError as e:
-                    log.info(f"Organization {self.source_definition['notubiz_organization_id']} was not present in organizations, will be retrieved directly")
-                    organization = self.get_organization_directly()
-                    self.organizations[self.source_definition['notubiz_organization_id']] = organization
-
-                attributes = {}
-                for meeting_attributes in meeting_json['attributes']:
+                    # Check for changes before retrieving the module items
+                    if listing_hash_for_item and item['last_modified'] == meeting_json['last_modified']:
+                        hash_for_item = listing_hash_for_item
+                    else:
+                        hash_for_item = self.meeting_hash_for_item(meeting_json['id'], meeting_json['last_modified'])
+                    if not hash_for_item:
+                        log.info('Skipped notubiz meeting(item) %s because we have it already' % (meeting_json['id']))
+                        meetings_skipped += 1
+                        continue
+
                     try:
-                        attributes[organization['attributes'][meeting_attributes['id']]] = meeting_attributes['value']
-                    except KeyError:
-                        pass
-                meeting_json['attributes'] = attributes
-
-                # agenda_items may themselves contain agenda_items, recursively add them
-                main_agenda_items = meeting_json.get('agenda_items', [])
-                all_child_agenda_items = []
-                for agenda_item in main_agenda_items:
-                    self.add_child_agenda_items(agenda_item, all_child_agenda_items)
-                meeting_json['agenda_items'] = main_agenda_items + all_child_agenda_items
-
-                # agenda_items may have module_items that in turn may contain documents
-                for agenda_item in meeting_json['agenda_items']:
-                    agenda_item['module_item_contents'] = []
-                    for module_item in agenda_item.get("module_items", []):
+                        organization = self.organizations[self.source_definition['notubiz_organization_id']]
+                    except KeyError as e:
+                        log.info(f"Organization {self.source_definition['notubiz_organization_id']} was not present in organizations, will be retrieved directly")
+                        organization = self.get_organization_directly()
+                        self.organizations[self.source_definition['notubiz_organization_id']] = organization
+
+                    attributes = {}
+                    for meeting_attributes in meeting_json['attributes']:
                         try:
+                            attributes[organization['attributes'][meeting_attributes['id']]] = meeting_attributes['value']
+                        except KeyError:
+                            pass
+                    meeting_json['attributes'] = attributes
+
+                    # agenda_items may themselves contain agenda_items, recursively add them
+                    main_agenda_items = meeting_json.get('agenda_items', [])
+                    all_child_agenda_items = []
+                    for agenda_item in main_agenda_items:
+                        self.add_child_agenda_items(agenda_item, all_child_agenda_items)
+                    meeting_json['agenda_items'] = main_agenda_items + all_child_agenda_items
+
+                    # agenda_items may have module_items that in turn may contain documents
+                    module_item_futures = []
+                    for agenda_item in meeting_json['agenda_items']:
+                        for module_item in agenda_item.get("module_items", []):
                             module_item_url = "https://%s?%s" % (
                                 module_item['self'],
                                 self.default_query_params
                             )
-                            resource = self.fetch(module_item_url, None)
-                            module_item_json = json.load(resource.media_file)['item']
-                            agenda_item['module_item_contents'].append(module_item_json)
+                            module_item_futures.append(
+                                (agenda_item, executor.submit(self.fetch_json, module_item_url, None, 'item')))
+
+                    changed_meetings.append((meeting_json, meeting_url, item['id'], hash_for_item, module_item_futures))
+
+                # Meetings after an error are not processed
+                for _, _, _, meeting_future in meetings:
+                    meeting_future.cancel()
+
+                for meeting_json, meeting_url, meeting_id, hash_for_item, module_item_futures in changed_meetings:
+                    for agenda_item in meeting_json['agenda_items']:
+                        agenda_item['module_item_contents'] = []
+                    for agenda_item, module_item_future in module_item_futures:
+                        try:
+                            agenda_item['module_item_contents'].append(module_item_future.result())
                         except Exception as e:
                             log.warning(f'[{self.source_definition["key"]}] generic error when retrieving module item {str(e)}, {e.__class__.__name__}: {parse.quote(url)}')
                             if is_retryable_error(e):
                                 raise
 
-                value_to_be_hashed = meeting_json['last_modified']
-                hash_for_item = self.hash_for_item('notubiz', self.source_definition['notubiz_organization_id'], 'meeting', meeting_json['id'], value_to_be_hashed)
-                if hash_for_item:
                     yield 'application/json', \
                           json.dumps(meeting_json), \
                           meeting_url, \
-                          'notubiz/' + cached_path, \
+                          'notubiz/events/meetings/%i' % meeting_id, \
                           hash_for_item
                     meeting_count += 1
-                else:
-                    log.info('Skipped notubiz meeting(item) %s because we have it already' % (meeting_json['id']))
-                    meetings_skipped += 1
 
+                if pending_error:
+                    raise pending_error
 
-            page += 1
+                page += 1
 
-            if not event_json['pagination']['has_more_pages']:
-                log.debug(f'[{self.source_definition["key"]}] Done processing all {page} pages')
-                break
+                if not event_json['pagination']['has_more_pages']:
+                    log.debug(f'[{self.source_definition["key"]}] Done processing all {page} pages')
+                    break
 
         log.info(f'[{self.source_definition["key"]}] Extracted total of {meeting_count} notubiz meeting(items). '
                  f'Also skipped {meetings_skipped} meetings')
@@ -247,6 +384,15 @@ class NotubizMeetingsExtractor(NotubizBaseExtractor):
         if meetings_error > 0:
             log.info(f'[{self.source_definition["key"]}] Also {meetings_error} notubiz meeting(items) encountered an error. ')
 
+    def fetch_json(self, url, path, key):
+        """Retrieves `url` and returns the value of `key` in its JSON body. Used from the fetch threads."""
+        resource = self.fetch(url, path)
+        return json.load(resource.media_file)[key]
+
+    def meeting_hash_for_item(self, meeting_id, last_modified):
+        """A meeting is considered changed when its `last_modified` value changed"""
+        return self.hash_for_item('notubiz', self.source_definition['notubiz_organization_id'], 'meeting', meeting_id, last_modified)
+
     def add_child_agenda_items(self, agenda_item, all_child_agenda_items):
         for child_agenda_item in agenda_item.get('agenda_items', []):
             all_child_agenda_items.append(child_agenda_item)
@@ -257,9 +403,15 @@ class NotubizMeetingsExtractor(NotubizBaseExtractor):
             Some organizations are hidden and not returned by the /organisations request. If not returned, this method
             uses another endpoint to retrieve the field_id <-> label definitions
             """
+            organization_id = self.source_definition['notubiz_organization_id']
+            cache_key = 'organisation_%s_%s' % (organization_id, self.default_query_params)
+            cached = _get_cached(cache_key)
+            if cached and cached['expires'] > time.time():
+                return _decode_organizations(cached['value'])[organization_id]
+
             organization = {'attributes': dict()}
             organization_response = self.http_session.get(
-                "%s/organisations/%s/entity_type_settings?%s" % (self.base_url, self.source_definition['notubiz_organization_id'], self.default_query_params),
+                "%s/organisations/%s/entity_type_settings?%s" % (self.base_url, organization_id, self.default_query_params),
                 timeout=(self.connect_timeout, 15)
             )
             try:
@@ -291,6 +443,11 @@ class NotubizMeetingsExtractor(NotubizBaseExtractor):
                 for field_setting in module_setting.get('fields_settings', {}):
                     organization['attributes'][field_setting['field_id']] = field_setting['label']
 
+            if organization_response.ok:
+                _set_cached(cache_key, {
+                    'expires': time.time() + NOTUBIZ_ORGANIZATIONS_CACHE_TTL,
+                    'value': _encode_organizations({organization_id: organization}),
+                })
             return organization
 
 # class NotubizMeetingItemExtractor(NotubizBaseExtractor):
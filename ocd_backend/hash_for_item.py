@@ -1,3 +1,6 @@
+from ocd_backend.models.postgres_models import ItemHash
+
+
 class HashForItem:
     def __init__(self, hash_key, hash_value, provider, site_name, item_type, item_id):
         self.hash_key = hash_key
@@ -11,3 +14,28 @@ class HashForItem:
         return f"HashForItem('{self.hash_key}', '{self.hash_value}', '{self.provider}', '{self.site_name}', '{self.item_type}', '{self.item_id}')"
 
 DUMMY_ITEM_HASH = HashForItem("a dummy key", "a dummy value", "a dummy provider", "a dummy site", "a dummy item type", -1)
+
+
+def set_processed(session, hash_for_item):
+    """Stores the hash value of an item in the ItemHash table"""
+    old_item = session.query(ItemHash).filter(ItemHash.item_id == hash_for_item.hash_key).first()
+
+    if old_item:
+        if old_item.item_hash != hash_for_item.hash_value or old_item.provider is None:
+            old_item.item_hash = hash_for_item.hash_value
+            set_item_scope(old_item, hash_for_item)
+            session.commit()
+            session.flush()
+    else:
+        new_item = ItemHash(item_id=hash_for_item.hash_key, item_hash=hash_for_item.hash_value)
+        set_item_scope(new_item, hash_for_item)
+        session.add(new_item)
+        session.commit()
+        session.flush()
+
+
+def set_item_scope(item, hash_for_item):
+    """Sets the columns that are used to load all hashes of a source"""
+    item.provider = str(hash_for_item.provider)
+    item.site_name = str(hash_for_item.site_name)
+    item.item_type = str(hash_for_item.item_type)
@@ -8,6 +8,7 @@ from ocd_backend.exceptions import ConfigurationError
 from ocd_backend.loaders import BaseLoader
 from ocd_backend.log import get_source_logger
 from ocd_backend.models.serializers import JsonLDSerializer
+from ocd_backend.utils import claim_check
 from ocd_backend.utils.misc import json_encoder
 from ocd_backend.settings import AUTORETRY_EXCEPTIONS, RETRY_MAX_RETRIES, AUTORETRY_RETRY_BACKOFF, AUTORETRY_RETRY_BACKOFF_MAX
 
@@ -32,6 +33,7 @@ class ElasticsearchBaseLoader(BaseLoader):
 
         # Recursively index associated models like attachments
         for model in doc.traverse():
+            claim_check.check_out(model)
             self.add_metadata(model, doc == model)
             model_body = json_encoder.encode(JsonLDSerializer(loader_class=self).serialize(model))
 
@@ -0,0 +1,183 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from multiprocessing import get_context
+from time import monotonic
+from uuid import uuid4
+
+from ocd_backend.exceptions import ConfigurationError
+from ocd_backend.hash_for_item import DUMMY_ITEM_HASH
+from ocd_backend.log import get_source_logger
+from ocd_backend.models.postgres_database import PostgresDatabase
+from ocd_backend.pipeline import setup_index
+from ocd_backend.utils.misc import load_object
+
+log = get_source_logger('local_pipeline')
+
+# Stages in the order in which they are executed for each item
+STAGES = ['extractor', 'transformer', 'enrichers', 'loaders', 'finalizer']
+
+# The worker processes keep the loaded pipeline tasks in this dict, see `_init_worker`
+_worker_pipeline = {}
+
+
+def _init_worker(pipeline_definition, params):
+    """Loads the transformer, enricher, loader and finalizer tasks once per worker process"""
+    _worker_pipeline['definition'] = pipeline_definition
+    _worker_pipeline['params'] = params
+    _worker_pipeline['transformer'] = load_object(pipeline_definition['transformer'])
+    _worker_pipeline['enrichers'] = [load_object(enricher) for enricher in pipeline_definition.get('enrichers', [])]
+    _worker_pipeline['loaders'] = [load_object(loader) for loader in
+                                   pipeline_definition.get('loaders', None) or [pipeline_definition.get('loader')]
+                                   if loader]
+    _worker_pipeline['finalizer'] = load_object(pipeline_definition['finalizer']) \
+        if pipeline_definition.get('finalizer') else None
+
+
+def _process_item(item, hash_for_item):
+    """
+    Runs a single extracted item through the transformer, enrichers, loaders and finalizer
+    of the pipeline. The tasks are called directly, so they run in this process instead of
+    being sent to the broker.
+
+    :return: a dict with the number of seconds spent in each stage, and a dict with the
+        hits and misses of the ORI id cache of the worker for this item
+    """
+    pipeline_definition = _worker_pipeline['definition']
+    params = dict(_worker_pipeline['params'], chain_id=uuid4().hex, start_time=datetime.now())
+    timings = {}
+
+    start = monotonic()
+    result = _worker_pipeline['transformer'](*item, source_definition=pipeline_definition, **params)
+    timings['transformer'] = monotonic() - start
+
+    if _worker_pipeline['enrichers']:
+        start = monotonic()
+        for enricher_task in _worker_pipeline['enrichers']:
+            result = enricher_task(result, source_definition=pipeline_definition, **params)
+        timings['enrichers'] = monotonic() - start
+
+    start = monotonic()
+    for loader_task in _worker_pipeline['loaders']:
+        loader_task(result, source_definition=pipeline_definition, **params)
+    timings['loaders'] = monotonic() - start
+
+    if _worker_pipeline['finalizer']:
+        start = monotonic()
+        _worker_pipeline['finalizer'](source_definition=pipeline_definition, hash_for_item=hash_for_item, **params)
+        timings['finalizer'] = monotonic() - start
+
+    return timings, PostgresDatabase.ori_id_cache.take_counters()
+
+
+class StageStatistics:
+    """Keeps track of the number of items and the time spent per pipeline stage"""
+
+    def __init__(self):
+        self.items = {stage: 0 for stage in STAGES}
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.failed = 0
+        self.wall_clock_seconds = 0.0
+        self.ori_id_cache = Counter()
+
+    def add(self, stage, seconds):
+        self.items[stage] += 1
+        self.seconds[stage] += seconds
+
+    def report(self):
+        lines = ['%-12s %8s %10s %10s %10s' % ('stage', 'items', 'seconds', 'ms/item', 'items/s')]
+        for stage in STAGES:
+            items = self.items[stage]
+            seconds = self.seconds[stage]
+            lines.append('%-12s %8d %10.1f %10.1f %10.1f' % (
+                stage,
+                items,
+                seconds,
+                (seconds / items * 1000) if items else 0,
+                (items / seconds) if seconds else 0,
+            ))
+        lines.append('Failed items: %d' % self.failed)
+        lines.append('ORI id cache: %d hits, %d hits in Redis, %d misses' % (
+            self.ori_id_cache['hits'], self.ori_id_cache['redis_hits'], self.ori_id_cache['misses']))
+        lines.append('Total wall clock time: %.1f seconds' % self.wall_clock_seconds)
+        return '\n'.join(lines)
+
+
+def run_local_pipeline(source_definition, workers=4, queue_size=None):
+    """
+    Runs the pipeline of a source in-process, without a broker or Celery workers. The
+    extractor runs in the current process and feeds a bounded queue of items that are
+    processed by a pool of `workers` processes. Each worker runs the same transformer,
+    enricher, loader and finalizer classes as `setup_pipeline` does.
+
+    :return: a `StageStatistics` object with the throughput per stage
+    """
+    if 'id' not in source_definition:
+        raise ConfigurationError("Each pipeline must have an id field.")
+
+    current_index_name, new_index_name, index_alias = setup_index(source_definition)
+    params = {
+        'source_run_identifier': 'local_pipeline_{}'.format(uuid4().hex),
+        'run_identifier': 'local_pipeline_{}'.format(uuid4().hex),
+        'current_index_name': current_index_name,
+        'new_index_name': new_index_name,
+        'index_alias': index_alias,
+    }
+
+    queue_size = queue_size or workers * 2
+    statistics = StageStatistics()
+    run_start = monotonic()
+
+    extractor = load_object(source_definition['extractor'])(source_definition=source_definition)
+
+    # Use spawn to give each worker its own database connections instead of inheriting
+    # those of the extractor
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                             initializer=_init_worker, initargs=(source_definition, params)) as executor:
+        pending = set()
+
+        def collect(futures):
+            for future in futures:
+                try:
+                    timings, ori_id_cache_counters = future.result()
+                    for stage, seconds in timings.items():
+                        statistics.add(stage, seconds)
+                    statistics.ori_id_cache.update(ori_id_cache_counters)
+                except Exception as e:
+                    statistics.failed += 1
+                    log.warning(f'[{source_definition["key"]}] Processing item failed ({e.__class__.__name__}): {e}')
+
+        items = iter(extractor.run())
+        while True:
+            start = monotonic()
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            statistics.add('extractor', monotonic() - start)
+
+            if len(item) == 5:
+                hash_for_item = item[-1]
+                item = item[:-1]
+            else:
+                hash_for_item = None
+
+            if hash_for_item == DUMMY_ITEM_HASH:
+                continue
+
+            # The queue between the extractor and the workers is bounded
+            if len(pending) >= queue_size:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(executor.submit(_process_item, item, hash_for_item))
+
+        collect(wait(pending).done)
+
+    if source_definition.get('cleanup'):
+        load_object(source_definition['cleanup']).run_finished(source_definition=source_definition, **params)
+
+    statistics.wall_clock_seconds = monotonic() - run_start
+    log.info(f'[{source_definition["key"]}] Finished local run:\n{statistics.report()}')
+
+    return statistics
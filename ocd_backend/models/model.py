@@ -220,18 +220,28 @@ class Model(object, metaclass=ModelMetaclass):
     def save(self):
         if self.saving_flag:
             return
-        self.saving_flag = True
 
+        models = []
+        self.collect_models(models)
         try:
-            self.db.save(self)  # pylint: disable=no-member
-            # Recursive saving of related models
-            for rel_type, value in self.properties(rels=True, props=False):
-                if isinstance(value, Model):
-                    value.save()
+            # The whole graph is saved at once, instead of with queries per model
+            self.db.save_all(models)  # pylint: disable=no-member
         except:
             log.info(f"Generic error occurred for save in Model, error class is {sys.exc_info()[0]}, {sys.exc_info()[1]}")
             log.info(vars(self))
             # Re-raise everything
             raise
+
+    def collect_models(self, models):
+        """Adds this model and its related models to `models`"""
+        if self.saving_flag:
+            return
+        self.saving_flag = True
+
+        try:
+            models.append(self)
+            for rel_type, value in self.properties(rels=True, props=False):
+                if isinstance(value, Model):
+                    value.collect_models(models)
         finally:
             self.saving_flag = False
@@ -1,17 +1,166 @@
-from ocd_backend.shared_access import SharedAccess
-from sqlalchemy import create_engine, Sequence
+import os
+import threading
+from collections import OrderedDict, defaultdict, deque
+
+import redis
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.pool import StaticPool
 
 from ocd_backend import settings
 from ocd_backend.log import get_source_logger
+from ocd_backend.shared_access import advisory_xact_lock
 from ocd_backend.models.definitions import Ori
 from ocd_backend.models.misc import Uri
-from ocd_backend.models.postgres_models import Source, Resource
+from ocd_backend.models.postgres_models import Source
 
 log = get_source_logger('postgres_database')
 
+# Key space of the advisory locks that serialize the creation of Resources for the same IRI
+ORI_ID_LOCK_NAMESPACE = 1
+
+
+class OriIdCache:
+    """
+    A bounded least recently used cache of ORI ids by IRI. An IRI keeps its ORI id once it has
+    been assigned, so entries never have to be invalidated. When `redis_client` is passed, ids
+    that are not in memory are looked up in Redis as well, so workers share what they resolved.
+    """
+
+    def __init__(self, max_size, redis_client=None, redis_ttl=None):
+        self.max_size = max_size
+        self.redis_client = redis_client
+        self.redis_ttl = redis_ttl
+        self.ori_ids = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.taken_counters = {'hits': 0, 'redis_hits': 0, 'misses': 0}
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'size': len(self.ori_ids),
+            'max_size': self.max_size,
+        }
+
+    def take_counters(self):
+        """Returns the hits and misses since the previous call, so they can be added to those of a run"""
+        with self.lock:
+            counters = {'hits': self.hits, 'redis_hits': self.redis_hits, 'misses': self.misses}
+            taken = {name: value - self.taken_counters[name] for name, value in counters.items()}
+            self.taken_counters = counters
+        return taken
+
+    @staticmethod
+    def run_counters_key(source_run_identifier):
+        """The key of the counters of all workers for a source run in the result backend"""
+        return f'{source_run_identifier}_ori_id_cache'
+
+    @staticmethod
+    def _redis_key(iri):
+        return f'ori_id_{iri}'
+
+    def get_many(self, iris):
+        """Returns the cached ORI ids of `iris` by IRI"""
+        found = {}
+        with self.lock:
+            for iri in iris:
+                try:
+                    self.ori_ids.move_to_end(iri)
+                    found[iri] = self.ori_ids[iri]
+                except KeyError:
+                    pass
+            self.hits += len(found)
+
+        missing = [iri for iri in iris if iri not in found]
+        if missing and self.redis_client:
+            try:
+                values = self.redis_client.mget([self._redis_key(iri) for iri in missing])
+            except redis.RedisError as e:
+                log.warning(f'Unable to use the shared ORI id cache: {e}')
+                values = []
+
+            shared = {iri: int(value) for iri, value in zip(missing, values) if value is not None}
+            self._add(shared)
+            found.update(shared)
+            with self.lock:
+                self.redis_hits += len(shared)
+
+        with self.lock:
+            self.misses += len(iris) - len(found)
+        return found
+
+    def set_many(self, ori_ids):
+        self._add(ori_ids)
+        if ori_ids and self.redis_client:
+            try:
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for iri, ori_id in ori_ids.items():
+                    pipeline.set(self._redis_key(iri), ori_id, ex=self.redis_ttl)
+                pipeline.execute()
+            except redis.RedisError as e:
+                log.warning(f'Unable to use the shared ORI id cache: {e}')
+
+    def _add(self, ori_ids):
+        with self.lock:
+            for iri, ori_id in ori_ids.items():
+                self.ori_ids[iri] = ori_id
+                self.ori_ids.move_to_end(iri)
+            while len(self.ori_ids) > self.max_size:
+                self.ori_ids.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.ori_ids.clear()
+
+
+class OriIdBlocks:
+    """
+    Hands out ORI ids from blocks that are reserved from `ori_id_seq`. The sequence is incremented
+    by the block size, so each `nextval` reserves the ids up to the next value for this process.
+    Ids of blocks that are not used up before the process ends are skipped.
+    """
+
+    def __init__(self):
+        self.block_size = None
+        self.blocks = deque()
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def allocate(self, session, count):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Blocks reserved before a fork would be handed out by both processes
+                self.blocks.clear()
+                self.pid = os.getpid()
+
+            if self.block_size is None:
+                self.block_size = session.execute(text(
+                    "SELECT increment_by FROM pg_sequences WHERE sequencename = 'ori_id_seq'"
+                )).scalar() or 1
+
+            available = sum(len(block) for block in self.blocks)
+            if available < count:
+                new_blocks = -(-(count - available) // self.block_size)
+                result = session.execute(text("SELECT nextval('ori_id_seq') FROM generate_series(1, :count)"),
+                                         {'count': new_blocks})
+                self.blocks.extend(range(start, start + self.block_size) for start, in result)
+
+            ori_ids = []
+            while len(ori_ids) < count:
+                block = self.blocks.popleft()
+                needed = count - len(ori_ids)
+                ori_ids.extend(block[:needed])
+                if len(block) > needed:
+                    self.blocks.appendleft(block[needed:])
+            return ori_ids
+
+
 class PostgresDatabase:
     connection_string = 'postgresql://%s:%s@%s/%s' % (
                                 settings.POSTGRES_USERNAME,
@@ -21,6 +170,16 @@ class PostgresDatabase:
     engine = create_engine(connection_string, poolclass=StaticPool)
     Session = sessionmaker(bind=engine)
 
+    # Shared by all instances in the worker process
+    ori_id_cache = OriIdCache(
+        settings.ORI_ID_CACHE_SIZE,
+        redis_client=redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=2,
+                                       decode_responses=True) if settings.ORI_ID_CACHE_REDIS else None,
+        redis_ttl=settings.ORI_ID_CACHE_REDIS_TTL,
+    )
+
+    ori_id_blocks = OriIdBlocks()
+
     def __init__(self, serializer):
         self.serializer = serializer
 
@@ -29,238 +188,164 @@ class PostgresDatabase:
         Retrieves a Resource-based ORI identifier from the database. If no corresponding Resource exists,
         a new one is created.
         """
+        return Uri(Ori, self.get_ori_ids([iri])[iri])
 
-        session = self.Session()
-        try:
-            resource = session.query(Resource).join(Source).filter(Source.iri == iri).first()
-            if not resource:
-                raise NoResultFound
-            return Uri(Ori, resource.ori_id)
-        except MultipleResultsFound:
-            raise MultipleResultsFound(f'Multiple resources found for IRI {iri}')
-        except NoResultFound:
-            return self.generate_ori_identifier(iri=iri)
-        finally:
-            session.close()
+    def resolve_ori_identifiers(self, model_objects):
+        """
+        Sets the ORI identifier of all `model_objects` that do not have one yet, usually all models of
+        a `Model.traverse()` graph, with a single lookup for all of their IRIs.
+        """
+        models_by_iri = defaultdict(list)
+        for model_object in model_objects:
+            if model_object.values.get('ori_identifier'):
+                continue
+            iri = getattr(model_object, 'source_iri', None) or self.serializer.label(model_object)
+            models_by_iri[iri].append(model_object)
+
+        if not models_by_iri:
+            return
 
-    def generate_ori_identifier(self, iri):
+        for iri, ori_id in self.get_ori_ids(list(models_by_iri)).items():
+            for model_object in models_by_iri[iri]:
+                model_object.ori_identifier = Uri(Ori, ori_id)
+
+    def get_ori_ids(self, iris):
         """
-        Generates a Resource with an ORI identifier and adds the IRI as a Source if it does not already exist.
-        To avoid race conditions where multiple Source records are created for the same iri, use a lock.
+        Returns the ORI ids of the Resources of `iris` by IRI. Resources and Sources are created for the
+        IRIs that do not have one yet.
         """
-  
-        SharedAccess.acquire_lock(iri)
+        ori_ids = self.ori_id_cache.get_many(iris)
+        uncached = [iri for iri in iris if iri not in ori_ids]
+        if uncached:
+            resolved = self._get_ori_ids(uncached)
+            self.ori_id_cache.set_many(resolved)
+            ori_ids.update(resolved)
+        return ori_ids
 
+    def _get_ori_ids(self, iris):
         session = self.Session()
-
         try:
-            # If the resource already exists, return existing ori_id
-            resource = session.query(Source).filter(Source.iri == iri).one().resource
-            return Uri(Ori, resource.ori_id)
-        except NoResultFound:
-            # If the resource does not exist, create resource (and possibly source)
-            try:
-                source = session.query(Source).filter(Source.iri == iri).one()
-            except NoResultFound:
-                source = Source(iri=iri)
-            except MultipleResultsFound as e:
-                log.info(f"MultipleResultsFound for {iri} when getting source")
-                raise e
-
-            new_id = session.execute(Sequence('ori_id_seq'))
-            new_identifier = Uri(Ori, new_id)
-            resource = Resource(ori_id=new_id, iri=new_identifier, sources=[source])
-            session.add(resource)
+            ori_ids = self._select_ori_ids(session, iris)
+            missing = sorted(set(iris) - set(ori_ids))
+            if not missing:
+                return ori_ids
+
+            # Another worker may be creating the same IRIs. The advisory locks are held until the end of
+            # the transaction, after which its Sources are visible to the query below.
+            advisory_xact_lock(session, ORI_ID_LOCK_NAMESPACE, missing)
+
+            ori_ids.update(self._select_ori_ids(session, missing))
+            missing = [iri for iri in missing if iri not in ori_ids]
+            if missing:
+                new_ids = self.allocate_ori_ids(session, len(missing))
+                session.execute(text(
+                    'WITH new_resource AS ('
+                    '    INSERT INTO resource (ori_id, iri) '
+                    '    SELECT * FROM unnest(CAST(:ori_ids AS bigint[]), CAST(:ori_iris AS text[]))'
+                    ') '
+                    'INSERT INTO source (id, iri, resource_ori_id, created_at, updated_at) '
+                    "SELECT nextval('source_id_seq'), iri, ori_id, now(), now() "
+                    'FROM unnest(CAST(:iris AS text[]), CAST(:ori_ids AS bigint[])) AS new_source (iri, ori_id)'
+                ), {
+                    'iris': missing,
+                    'ori_ids': new_ids,
+                    'ori_iris': [Uri(Ori, new_id) for new_id in new_ids],
+                })
+                ori_ids.update(zip(missing, new_ids))
+
             session.commit()
-            session.flush()
-            return new_identifier
-        except MultipleResultsFound as e:
-            log.info(f"MultipleResultsFound for {iri} when getting resource")
-            raise e
+            return ori_ids
         finally:
             session.close()
-            SharedAccess.release_lock(iri)
 
+    @staticmethod
+    def _select_ori_ids(session, iris):
+        """Returns the ORI ids of the existing Resources of `iris` by IRI"""
+        result = session.execute(text(
+            'SELECT DISTINCT ON (iri) iri, resource_ori_id FROM source '
+            'WHERE iri = ANY(CAST(:iris AS text[])) ORDER BY iri, id'
+        ), {'iris': iris})
+        return {iri: ori_id for iri, ori_id in result}
+
+    def allocate_ori_ids(self, session, count):
+        """Returns `count` new ORI ids"""
+        return self.ori_id_blocks.allocate(session, count)
 
     def save(self, model_object):
-        if not model_object.source_iri:
-            # If the item is an Individual, like EventConfirmed, we "save" it by setting an ORI identifier
-            iri = self.serializer.label(model_object)
-            if not model_object.values.get('ori_identifier'):
-                model_object.ori_identifier = self.get_ori_identifier(iri=iri)
-        else:
-            if not model_object.values.get('ori_identifier'):
-                model_object.ori_identifier = self.get_ori_identifier(iri=model_object.source_iri)
-
-            # Handle canonical IRI or ID
-            if (hasattr(model_object, 'canonical_id') and model_object.canonical_id is not None) or \
-                    (hasattr(model_object, 'canonical_iri') and model_object.canonical_iri is not None):
-                try:
-                    self.update_source(model_object)
-                except ValueError as e:
-                    # The 'No matching scenario 2 while updating Source for resource' error occurs now and then
-                    # due to race conditions. A simply retry here solves it.
-                    try:
-                        self.update_source(model_object)
-                    except ValueError as e:
-                        log.warning(f'Unable to update source, failed second time as well: {str(e)}')
-
-
-
-    def update_source(self, model_object):
-        """Updates the canonical IRI or ID field of the Source of the corresponding model object.
-
-        Scenarios:
-        1) Canonical ID and IRI both set on model object:
-            A) Check for Source record with matching ID and IRI set and do nothing
-            B) Check for Source record with only matching ID set and add IRI
-            C) Check for empty Source record and set ID and IRI
-            D) Create new Source record with new ID and IRI
-        2) Only canonical ID set on model object:
-            A) Check for Source record with only matching ID set and do nothing
-            B) Check for empty Source record and set ID
-            C) Check for Source record with matching ID and non-empty IRI set and do nothing
+        self.save_all([model_object])
+
+    def save_all(self, model_objects):
+        """Sets the ORI identifiers of `model_objects` and records their canonical IDs and IRIs"""
+        model_objects = list(model_objects)
+        self.resolve_ori_identifiers(model_objects)
+        self.update_sources(model_objects)
+
+    def update_sources(self, model_objects):
+        """Records the canonical ID and IRI of `model_objects` in the Sources of their Resources.
+
+        A single upsert on (resource, IRI, canonical ID) is done for all models:
+        1) When a Source with the canonical ID exists, its canonical IRI is set if the model has one
+        2) Otherwise the Source without canonical ID and IRI, created with the Resource, gets them
+        3) Otherwise a new Source with the canonical ID and IRI is created
         """
+        canonical_iris = {}
+        for model_object in model_objects:
+            source_iri = getattr(model_object, 'source_iri', None)
+            canonical_id = getattr(model_object, 'canonical_id', None)
+            canonical_iri = getattr(model_object, 'canonical_iri', None)
+            if not source_iri or canonical_id is None:
+                if canonical_iri is not None:
+                    log.warning(f'Source for Resource {model_object.ori_identifier} with IRI {source_iri} '
+                                f'can not be updated with a canonical IRI only')
+                continue
 
-        session = self.Session()
-        resource = session.query(Resource).get(model_object.get_short_identifier())
+            # A model can occur more than once in a graph, it may be updated only once
+            key = (int(model_object.get_short_identifier()), source_iri, str(canonical_id))
+            if canonical_iri is not None or key not in canonical_iris:
+                canonical_iris[key] = canonical_iri
 
-        # Scenario 1
-        if (hasattr(model_object, 'canonical_id') and model_object.canonical_id is not None) and \
-                (hasattr(model_object, 'canonical_iri') and model_object.canonical_iri is not None):
+        if not canonical_iris:
+            return
 
-            # Scenario 1A
-            try:
-                source = session.query(Source).filter(Source.resource_ori_id == resource.ori_id,
-                                                      Source.iri == model_object.source_iri,
-                                                      Source.canonical_id == str(model_object.canonical_id),
-                                                      Source.canonical_iri == model_object.canonical_iri).one()
-                # Nothing needs to be updated
-                session.close()
-                return
-            except MultipleResultsFound:
-                raise ValueError('Multiple 1A/ID+IRI Source records found for resource %s with IRI %s' %
-                                 (model_object.ori_identifier, model_object.source_iri))
-            except NoResultFound:
-                # Continue to next scenario
-                pass
-
-            # Scenario 1B
-            try:
-                source = session.query(Source).filter(Source.resource_ori_id == resource.ori_id,
-                                                      Source.iri == model_object.source_iri,
-                                                      Source.canonical_id == str(model_object.canonical_id),
-                                                      Source.canonical_iri == None).one()
-                source.canonical_iri = model_object.canonical_iri
-                session.commit()
-                session.close()
-                return
-            except MultipleResultsFound:
-                raise ValueError('Multiple 1B/ID+X Source records found for resource %s with IRI %s' %
-                                 (model_object.ori_identifier, model_object.source_iri))
-            except NoResultFound:
-                # Continue to next scenario
-                pass
-
-            # Scenario 1C
-            try:
-                source = session.query(Source).filter(Source.resource_ori_id == resource.ori_id,
-                                                      Source.iri == model_object.source_iri,
-                                                      Source.canonical_id == None,
-                                                      Source.canonical_iri == None).one()
-                source.canonical_id = str(model_object.canonical_id)
-                source.canonical_iri = model_object.canonical_iri
-                session.commit()
-                session.close()
-                return
-            except MultipleResultsFound:
-                raise ValueError('Multiple 1C/X+X Source records found for resource %s with IRI %s' %
-                                 (model_object.ori_identifier, model_object.source_iri))
-            except NoResultFound:
-                # Continue to next scenario
-                pass
-
-            # Scenario 1D
-            # To avoid race conditions where multiple Source records are created for the same iri, use a lock.
-            SharedAccess.acquire_lock(model_object.source_iri)
-            try:
-                source = Source(resource=resource,
-                                iri=model_object.source_iri,
-                                canonical_id=str(model_object.canonical_id),
-                                canonical_iri=model_object.canonical_iri)
-                session.add(source)
-                session.commit()
-                session.close()
-                return
-            except Exception as e:
-                session.close()
-                log.error(f'Error creating Source record: {str(e)}: {model_object.ori_identifier} - {model_object.source_iri}')
-                # raise ValueError('No matching scenario 1 while updating Source for resource %s with IRI %s' %
-                #                  (model_object.ori_identifier, model_object.source_iri))
-            finally:
-                SharedAccess.release_lock(model_object.source_iri)
-
-        # Scenario 2
-        elif (hasattr(model_object, 'canonical_id') and model_object.canonical_id is not None) and not \
-                (hasattr(model_object, 'canonical_iri') and model_object.canonical_iri is not None):
-
-            # Scenario 2A
-            try:
-                source = session.query(Source).filter(Source.resource_ori_id == resource.ori_id,
-                                                      Source.iri == model_object.source_iri,
-                                                      Source.canonical_id == str(model_object.canonical_id),
-                                                      Source.canonical_iri == None).with_for_update().one()
-                # Nothing needs to be updated
-                return
-            except MultipleResultsFound:
-                raise ValueError('Multiple 2A/ID+X Source records found for resource %s with IRI %s' %
-                                 (model_object.ori_identifier, model_object.source_iri))
-            except NoResultFound:
-                # Continue to next scenario
-                pass
-            finally:
-                session.close()
-
-            # Scenario 2B
-            try:
-                source = session.query(Source).filter(Source.resource_ori_id == resource.ori_id,
-                                                      Source.iri == model_object.source_iri,
-                                                      Source.canonical_id == None,
-                                                      Source.canonical_iri == None).with_for_update().one()
-                source.canonical_id = str(model_object.canonical_id)
-                session.commit()
-                return
-            except MultipleResultsFound:
-                raise ValueError('Multiple 2B/X+X Source records found for resource %s with IRI %s' %
-                                 (model_object.ori_identifier, model_object.source_iri))
-            except NoResultFound:
-                # Continue to next scenario
-                pass
-            finally:
-                session.close()
-
-            # Scenario 2C
-            try:
-                source = session.query(Source).filter(Source.resource_ori_id == resource.ori_id,
-                                                      Source.iri == model_object.source_iri,
-                                                      Source.canonical_id == str(model_object.canonical_id),
-                                                      Source.canonical_iri != None).with_for_update().one()
-                # Nothing needs to be updated
-                return
-            except MultipleResultsFound:
-                # TODO - Decide how to handle this
-                return
-            except NoResultFound:
-                raise ValueError('No matching scenario 2 while updating Source for resource %s with IRI %s' %
-                                 (model_object.ori_identifier, model_object.source_iri))
-            finally:
-                session.close()
-
-        else:
+        # Rows are written in the order of the conflict key, so concurrent upserts of overlapping
+        # graphs lock them in the same order instead of deadlocking
+        rows = sorted(canonical_iris.items())
 
+        session = self.Session()
+        try:
+            session.execute(text(
+                'WITH target (resource_ori_id, iri, canonical_id, canonical_iri) AS ('
+                '    SELECT * FROM unnest(CAST(:ori_ids AS bigint[]), CAST(:iris AS text[]), '
+                '                         CAST(:canonical_ids AS text[]), CAST(:canonical_iris AS text[]))'
+                '), filled AS ('
+                '    UPDATE source SET canonical_id = target.canonical_id, canonical_iri = target.canonical_iri, '
+                '                      updated_at = now() '
+                '    FROM target '
+                '    WHERE source.resource_ori_id = target.resource_ori_id AND source.iri = target.iri '
+                '    AND source.canonical_id IS NULL AND source.canonical_iri IS NULL '
+                '    AND NOT EXISTS (SELECT 1 FROM source existing '
+                '                    WHERE existing.resource_ori_id = target.resource_ori_id '
+                '                    AND existing.iri = target.iri AND existing.canonical_id = target.canonical_id) '
+                '    RETURNING source.resource_ori_id, source.iri, source.canonical_id'
+                ') '
+                'INSERT INTO source (id, resource_ori_id, iri, canonical_id, canonical_iri, created_at, updated_at) '
+                "SELECT nextval('source_id_seq'), target.*, now(), now() FROM target "
+                'WHERE NOT EXISTS (SELECT 1 FROM filled '
+                '                  WHERE filled.resource_ori_id = target.resource_ori_id '
+                '                  AND filled.iri = target.iri AND filled.canonical_id = target.canonical_id) '
+                'ON CONFLICT (resource_ori_id, iri, canonical_id) DO UPDATE '
+                'SET canonical_iri = EXCLUDED.canonical_iri, updated_at = now() '
+                'WHERE EXCLUDED.canonical_iri IS NOT NULL '
+                'AND source.canonical_iri IS DISTINCT FROM EXCLUDED.canonical_iri'
+            ), {
+                'ori_ids': [ori_id for (ori_id, _, _), _ in rows],
+                'iris': [iri for (_, iri, _), _ in rows],
+                'canonical_ids': [canonical_id for (_, _, canonical_id), _ in rows],
+                'canonical_iris': [canonical_iri for _, canonical_iri in rows],
+            })
+            session.commit()
+        finally:
             session.close()
-            raise ValueError('update_source for Resource %s with IRI %s must be called with either canonical ID+IRI '
-                             'or canonical ID only' % (model_object.ori_identifier, model_object.source_iri))
 
     def get_supplier(self, ori_id):
         """
@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Sequence, String, ForeignKey, DateTime, SmallInteger, BigInteger, Float, JSON, func, \
-    CheckConstraint, text, Boolean
+    CheckConstraint, text, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -31,6 +31,15 @@ class ItemHash(Base):
     id = Column(BigInteger, Sequence('source_id_seq'), primary_key=True, index=True)
     item_id = Column(String, nullable=False, index=True, unique=True)
     item_hash = Column(String, nullable=False)
+    # Used to load the hashes of a source at once. Rows created before these columns
+    # were added are filled in when they are looked up.
+    provider = Column(String, nullable=True)
+    site_name = Column(String, nullable=True)
+    item_type = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index('ix_item_hash_provider_site_name_item_type', 'provider', 'site_name', 'item_type'),
+    )
 
 class Source(Base):
     __tablename__ = 'source'
@@ -46,11 +55,16 @@ class Source(Base):
 
     resource = relationship("Resource", back_populates="sources")
 
+    __table_args__ = (
+        Index('ix_source_resource_ori_id_iri_canonical_id', 'resource_ori_id', 'iri', 'canonical_id', unique=True),
+    )
+
 
 class Resource(Base):
     __tablename__ = 'resource'
 
-    ori_id = Column(BigInteger, Sequence('ori_id_seq'), primary_key=True, index=True)
+    # ORI ids are reserved in blocks, see OriIdBlocks
+    ori_id = Column(BigInteger, Sequence('ori_id_seq', increment=1000), primary_key=True, index=True)
     iri = Column(String)
 
     sources = relationship("Source", back_populates="resource")
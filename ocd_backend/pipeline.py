@@ -1,5 +1,7 @@
+import json
 from copy import deepcopy
 from datetime import datetime
+from time import monotonic, sleep
 from uuid import uuid4
 
 from celery import chain, group
@@ -11,17 +13,51 @@ from ocd_backend.es import elasticsearch as es
 from ocd_backend.exceptions import ConfigurationError
 from ocd_backend.hash_for_item import DUMMY_ITEM_HASH
 from ocd_backend.log import get_source_logger
-from ocd_backend.utils.retry_utils import retry_task
+from ocd_backend.utils.retry_utils import retry_task, will_retry
 from ocd_backend.utils.misc import load_object, propagate_chain_get
-from ocd_backend.settings import RETRY_MAX_RETRIES
+from ocd_backend.settings import RETRY_MAX_RETRIES, PIPELINE_BACKPRESSURE_POLL_INTERVAL, \
+    PIPELINE_BACKPRESSURE_STALL_TIMEOUT, PIPELINE_CHAIN_REGISTRATION_BATCH_SIZE, PIPELINE_CHECKPOINT_TTL
+from ocd_backend.transformers import batch_transformer
 
 log = get_source_logger('pipeline')
 
-@celery_app.task(bind=True, max_retries=RETRY_MAX_RETRIES)
-@retry_task
-def setup_pipeline(self, source_definition, source_run_uuid):
-    log.debug(f'[{source_definition["key"]}] Starting pipeline for source: {source_definition.get("id")} with run uuid {source_run_uuid}')
 
+def wait_for_in_flight_chains(run_identifier_chains, high_water_mark, low_water_mark, source_key):
+    """
+    Blocks the extractor while the number of unfinished chains for a run exceeds
+    `high_water_mark`, until it has dropped to `low_water_mark`. The `_chains` set
+    maintained by `BaseCleanup` is used as the in-flight counter.
+    """
+    in_flight = celery_app.backend.get_set_cardinality(run_identifier_chains)
+    if in_flight <= high_water_mark:
+        return
+
+    log.info(f'[{source_key}] {in_flight} chains in flight, pausing extractor until {low_water_mark} are left')
+
+    lowest = in_flight
+    last_progress = monotonic()
+    while in_flight > low_water_mark:
+        sleep(PIPELINE_BACKPRESSURE_POLL_INTERVAL)
+        in_flight = celery_app.backend.get_set_cardinality(run_identifier_chains)
+
+        if in_flight < lowest:
+            lowest = in_flight
+            last_progress = monotonic()
+        elif monotonic() - last_progress > PIPELINE_BACKPRESSURE_STALL_TIMEOUT:
+            log.warning(f'[{source_key}] No chains finished in the last {PIPELINE_BACKPRESSURE_STALL_TIMEOUT} '
+                        f'seconds, resuming extractor with {in_flight} chains in flight')
+            return
+
+    log.info(f'[{source_key}] {in_flight} chains in flight, resuming extractor')
+
+
+def setup_index(source_definition):
+    """
+    Makes sure the index alias for the source exists and determines the index the run
+    should load into.
+
+    :return: a (current_index_name, new_index_name, index_alias) tuple
+    """
     # index_name is an alias of the current version of the index
     index_alias = '{prefix}_{index_name}'.format(
         prefix=source_definition.get('es_prefix', settings.DEFAULT_INDEX_PREFIX),
@@ -55,10 +91,44 @@ def setup_pipeline(self, source_definition, source_run_uuid):
             now=datetime.utcnow().strftime('%Y%m%d%H%M%S')
         )
 
+    return current_index_name, new_index_name, index_alias
+
+
+def source_run_identifier(source_run_uuid):
+    return 'pipeline_{}'.format(source_run_uuid)
+
+
+def run_identifier(task_id):
+    return 'pipeline_{}'.format(task_id)
+
+
+def start_source_run(source_definitions, source_run_uuid):
+    """
+    Starts a pipeline for each of `source_definitions` in the source run `source_run_uuid`.
+    All runs are registered before the first one starts, so the source run is not reported
+    as finished while some of its pipelines are still waiting in the queue.
+    """
+    task_ids = [uuid4().hex for _ in source_definitions]
+    celery_app.backend.start_runs(source_run_identifier(source_run_uuid),
+                                  [run_identifier(task_id) for task_id in task_ids])
+
+    for source_definition, task_id in zip(source_definitions, task_ids):
+        setup_pipeline.apply_async((source_definition, source_run_uuid), task_id=task_id)
+
+
+@celery_app.task(bind=True, max_retries=RETRY_MAX_RETRIES)
+@retry_task
+def setup_pipeline(self, source_definition, source_run_uuid):
+    log.debug(f'[{source_definition["key"]}] Starting pipeline for source: {source_definition.get("id")} with run uuid {source_run_uuid}')
+
+    current_index_name, new_index_name, index_alias = setup_index(source_definition)
+
     # Parameters that are passed to each task in the chain
     params = {
-        'source_run_identifier': 'pipeline_{}'.format(source_run_uuid),
-        'run_identifier': 'pipeline_{}'.format(uuid4().hex),
+        'source_run_identifier': source_run_identifier(source_run_uuid),
+        # The run identifier is kept over retries of this task, so the run stays registered
+        # in its source run until the last attempt
+        'run_identifier': run_identifier(self.request.id or uuid4().hex),
         'current_index_name': current_index_name,
         'new_index_name': new_index_name,
         'index_alias': index_alias,
@@ -66,7 +136,6 @@ def setup_pipeline(self, source_definition, source_run_uuid):
 
     log.debug(f'[{source_definition["key"]}] Starting run with identifier {params["run_identifier"]}')
 
-    celery_app.backend.set(params['run_identifier'], 'running')
     run_identifier_chains = '{}_chains'.format(params['run_identifier'])
 
     pipeline = source_definition
@@ -98,63 +167,136 @@ def setup_pipeline(self, source_definition, source_run_uuid):
         pipeline_definition['finalizer'])
 
 
-    result = None
-    try:
-        # The first extractor should be a generator instead of a task
-        for item in pipeline_extractor(source_definition=pipeline_definition).run():
-            if len(item) == 5:
-                hash_for_item = item[-1]
-                item = item[:-1]
-            else:
-                hash_for_item = None
-            step_chain = list()
+    # When pipeline_batch_size is set, multiple extracted items travel through a
+    # single chain. The transformer, enrichers and loaders then process the whole
+    # batch in one task invocation and run tracking is done per batch.
+    batch_size = int(pipeline_definition.get('pipeline_batch_size', 1))
 
-            params['chain_id'] = uuid4().hex
-            params['start_time'] = datetime.now()
+    # When pipeline_high_water_mark is set, the extractor pauses as soon as more
+    # chains are in flight for this run and resumes at pipeline_low_water_mark.
+    high_water_mark = pipeline_definition.get('pipeline_high_water_mark')
+    if high_water_mark is not None:
+        high_water_mark = int(high_water_mark)
+        low_water_mark = int(pipeline_definition.get('pipeline_low_water_mark', high_water_mark // 2))
 
-            celery_app.backend.add_value_to_set(
-                set_name=run_identifier_chains,
-                value=params['chain_id'])
+    # Chains are registered in the run and source run sets in batches, before they are started
+    pending_chains = []
 
-            celery_app.backend.add_value_to_set(
-                set_name=params['source_run_identifier'],
-                value=params['chain_id'])
+    def start_pending_chains():
+        """Registers the pending chains in a single round trip and starts them"""
+        if not pending_chains:
+            return None
 
-            if hash_for_item != DUMMY_ITEM_HASH:
-                # Transformers
-                if pipeline_transformer:
-                    step_chain.append(pipeline_transformer.s(
-                        *item,
+        celery_app.backend.add_values_to_sets(
+            set_names=[run_identifier_chains, params['source_run_identifier']],
+            values=[chain_id for chain_id, _ in pending_chains])
+
+        for _, step_chain in pending_chains:
+            last_result = step_chain.delay()
+        pending_chains.clear()
+        return last_result
+
+    def build_chain(items):
+        """Builds the ETL chain for a list of (item, hash_for_item) tuples and adds it to the pending chains"""
+        step_chain = list()
+
+        params['chain_id'] = uuid4().hex
+        params['start_time'] = datetime.now()
+
+        items = [(item, hash_for_item) for item, hash_for_item in items if hash_for_item != DUMMY_ITEM_HASH]
+
+        if items:
+            # Transformers
+            if pipeline_transformer:
+                if batch_size > 1:
+                    step_chain.append(batch_transformer.s(
+                        [item for item, _ in items],
+                        transformer=pipeline_definition['transformer'],
                         source_definition=pipeline_definition,
                         **params)
                     )
-
-                # Enrichers
-                for enricher_task in pipeline_enricher:
-                    step_chain.append(enricher_task.s(
+                else:
+                    step_chain.append(pipeline_transformer.s(
+                        *items[0][0],
                         source_definition=pipeline_definition,
-                        **params
-                    )
+                        **params)
                     )
 
-            # Loaders
-            # Multiple loaders to enable to save to different stores
-            initialized_loaders = []
-            for loader in pipeline_loader:
-                initialized_loaders.append(loader.s(
-                    source_definition=pipeline_definition,
-                    **params))
-            step_chain.append(group(initialized_loaders))
-
-            # Finalizer
-            if pipeline_finalizer and hash_for_item != DUMMY_ITEM_HASH:
-                step_chain.append(pipeline_finalizer.s(
+            # Enrichers
+            for enricher_task in pipeline_enricher:
+                step_chain.append(enricher_task.s(
                     source_definition=pipeline_definition,
-                    hash_for_item=hash_for_item,
-                    **params)
+                    **params
                 )
+                )
+
+        # Loaders
+        # Multiple loaders to enable to save to different stores
+        initialized_loaders = []
+        for loader in pipeline_loader:
+            initialized_loaders.append(loader.s(
+                source_definition=pipeline_definition,
+                **params))
+        step_chain.append(group(initialized_loaders))
+
+        # Finalizer
+        if pipeline_finalizer and items:
+            if batch_size > 1:
+                hash_for_item = [hash_for_item for _, hash_for_item in items]
+            else:
+                hash_for_item = items[0][1]
+            step_chain.append(pipeline_finalizer.s(
+                source_definition=pipeline_definition,
+                hash_for_item=hash_for_item,
+                **params)
+            )
+
+        pending_chains.append((params['chain_id'], chain(step_chain)))
 
-            result = chain(step_chain).delay()
+    # The extractor checkpoint is kept per source run, so a retry of this task
+    # continues where the failed attempt stopped
+    checkpoint_key = '{}_{}_checkpoint'.format(params['source_run_identifier'], pipeline_definition['id'])
+
+    celery_app.backend.start_runs(params['source_run_identifier'], [params['run_identifier']])
+
+    result = None
+    try:
+        extractor = pipeline_extractor(source_definition=pipeline_definition)
+        stored_checkpoint = celery_app.backend.get(checkpoint_key)
+        if stored_checkpoint:
+            extractor.resume_checkpoint = json.loads(stored_checkpoint)
+            log.info(f'[{source_definition["key"]}] Resuming extractor from checkpoint {extractor.resume_checkpoint}')
+
+        batch = []
+        # The first extractor should be a generator instead of a task
+        for item in extractor.run():
+            if len(item) == 5:
+                hash_for_item = item[-1]
+                item = item[:-1]
+            else:
+                hash_for_item = None
+
+            batch.append((item, hash_for_item,))
+            if len(batch) >= batch_size:
+                build_chain(batch)
+                batch = []
+
+            if len(pending_chains) >= PIPELINE_CHAIN_REGISTRATION_BATCH_SIZE:
+                if high_water_mark is not None:
+                    wait_for_in_flight_chains(run_identifier_chains, high_water_mark, low_water_mark,
+                                              source_definition['key'])
+                result = start_pending_chains()
+
+                # All items yielded before the current checkpoint have been sent, since
+                # there are no items left in the batch or in the pending chains
+                if extractor.checkpoint:
+                    # Not set through the backend, which expires keys with the results
+                    celery_app.backend.client.set(checkpoint_key, json.dumps(extractor.checkpoint),
+                                                  ex=PIPELINE_CHECKPOINT_TTL)
+
+        if batch:
+            build_chain(batch)
+        result = start_pending_chains() or result
     except KeyboardInterrupt:
         log.warning('KeyboardInterrupt received. Stopping the program.')
         exit()
@@ -164,13 +306,31 @@ def setup_pipeline(self, source_definition, source_run_uuid):
 
         celery_app.backend.set(params['run_identifier'], 'error')
 
+        # A run that fails for good does not keep the source run from finishing
+        if not will_retry(self, e):
+            finish_extraction(pipeline_definition, params)
+
         # Reraise the exception so celery can retry
         raise
 
     celery_app.backend.set(params['run_identifier'], 'done')
+    celery_app.backend.remove(checkpoint_key)
     log.info(f'[{source_definition["key"]}] Finished run with identifier {params["run_identifier"]}')
 
+    finish_extraction(pipeline_definition, params)
+
     if result and source_definition.get('wait_until_finished'):
         # Wait for last task chain to end before continuing
         log.info(f'[{source_definition["key"]}] Waiting for last chain to finish')
         propagate_chain_get(result)
+
+
+def finish_extraction(pipeline_definition, params):
+    """
+    Removes the run from the runs of the source run that are still extracting. When all
+    chains finished before that, none of them has reported the source run as finished,
+    so the cleanup checks it once more.
+    """
+    if pipeline_definition.get('cleanup'):
+        load_object(pipeline_definition['cleanup']).delay(
+            source_definition=pipeline_definition, **dict(params, chain_id=None))
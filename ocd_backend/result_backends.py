@@ -1,4 +1,45 @@
 from celery.backends.redis import RedisBackend
+from kombu.utils.objects import cached_property
+
+# Removes a finished chain from the sets of its run and source run, and decides
+# whether the source run has finished. This runs atomically in Redis, so when chains
+# of a source run finish at the same time exactly one of them reports it as finished.
+# Without a chain id, the extractor of the run has finished and the run is removed
+# from the runs of the source run that are still extracting.
+#
+# KEYS: run identifier, chains of the run, source run identifier, running runs of the
+#       source run, finished marker of the source run
+# ARGV: chain id (empty if no chain finished), ttl of a running run identifier,
+#       ttl of the running runs and the finished marker
+COMPLETE_CHAIN_SCRIPT = """
+if ARGV[1] ~= '' then
+    redis.call('SREM', KEYS[2], ARGV[1])
+    redis.call('SREM', KEYS[3], ARGV[1])
+else
+    redis.call('SREM', KEYS[4], KEYS[1])
+end
+
+local run_result = redis.call('GET', KEYS[1])
+if run_result == 'running' or redis.call('SCARD', KEYS[2]) > 0 then
+    -- If the extractor is still running, extend the lifetime of the identifier
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    if run_result == 'running' then
+        return 0
+    end
+else
+    -- All tasks for an entity (e.g. meetings or committees) have finished
+    redis.call('DEL', KEYS[2])
+end
+
+if redis.call('SCARD', KEYS[4]) == 0 and redis.call('SCARD', KEYS[3]) == 0 then
+    -- All entities of a source have been extracted and all their tasks have finished,
+    -- the marker makes sure the source run is reported once
+    if redis.call('SET', KEYS[5], '1', 'NX', 'EX', ARGV[3]) then
+        return 1
+    end
+end
+return 0
+"""
 
 
 class OCDBackendMixin:
@@ -53,6 +94,41 @@ class OCDBackendMixin:
     def update_ttl(self, key, ttl=300):
         """Extend the TTL of `key` with `ttl` seconds"""
 
+    def add_values_to_sets(self, set_names, values):
+        """Add all `values` to each of `set_names`"""
+        raise NotImplementedError('Subclass should implement `add_values_to_se'
+                                  'ts` method')
+
+    def start_runs(self, source_run_identifier, run_identifiers):
+        """Mark `run_identifiers` as running and register them as runs of
+        `source_run_identifier` that are still extracting"""
+        raise NotImplementedError('Subclass should implement `start_runs` '
+                                  'method')
+
+    def complete_chain(self, run_identifier, source_run_identifier, chain_id, ttl=300):
+        """Mark `chain_id` as finished, or the extraction of `run_identifier`
+        when `chain_id` is None, and return whether the source run has
+        finished. Returns True at most once per `source_run_identifier`."""
+        raise NotImplementedError('Subclass should implement `complete_chain` '
+                                  'method')
+
+    def reset_run_finished(self, source_run_identifier):
+        """Allow `complete_chain` to report `source_run_identifier` as finished
+        again"""
+        raise NotImplementedError('Subclass should implement `reset_run_finish'
+                                  'ed` method')
+
+    def add_counters(self, key, counters, ttl=300):
+        """Add the values of the `counters` dict to the counters stored in
+        `key`"""
+        raise NotImplementedError('Subclass should implement `add_counters` '
+                                  'method')
+
+    def pop_counters(self, key):
+        """Get and remove the counters stored in `key`"""
+        raise NotImplementedError('Subclass should implement `pop_counters` '
+                                  'method')
+
 
 class OCDRedisBackend(RedisBackend, OCDBackendMixin):
     def add_value_to_set(self, set_name, value):
@@ -75,3 +151,60 @@ class OCDRedisBackend(RedisBackend, OCDBackendMixin):
 
     def increment(self, key):
         return self.client.incr(key)
+
+    def add_values_to_sets(self, set_names, values):
+        with self.client.pipeline(transaction=False) as pipe:
+            for set_name in set_names:
+                pipe.sadd(set_name, *values)
+            pipe.execute()
+
+    # Lifetime of the running runs and finished marker of a source run
+    source_run_ttl = 24 * 60 * 60
+
+    @staticmethod
+    def _running_runs(source_run_identifier):
+        return '{}_running'.format(source_run_identifier)
+
+    @staticmethod
+    def _finished_marker(source_run_identifier):
+        return '{}_finished'.format(source_run_identifier)
+
+    @cached_property
+    def _complete_chain_script(self):
+        return self.client.register_script(COMPLETE_CHAIN_SCRIPT)
+
+    def start_runs(self, source_run_identifier, run_identifiers):
+        running_runs = self._running_runs(source_run_identifier)
+        with self.client.pipeline() as pipe:
+            for run_identifier in run_identifiers:
+                pipe.set(run_identifier, 'running')
+            pipe.sadd(running_runs, *run_identifiers)
+            pipe.expire(running_runs, self.source_run_ttl)
+            pipe.execute()
+
+    def complete_chain(self, run_identifier, source_run_identifier, chain_id, ttl=300):
+        keys = [
+            run_identifier,
+            '{}_chains'.format(run_identifier),
+            source_run_identifier,
+            self._running_runs(source_run_identifier),
+            self._finished_marker(source_run_identifier),
+        ]
+        return self._complete_chain_script(keys=keys, args=[chain_id or '', ttl, self.source_run_ttl]) == 1
+
+    def reset_run_finished(self, source_run_identifier):
+        self.client.delete(self._finished_marker(source_run_identifier))
+
+    def add_counters(self, key, counters, ttl=300):
+        with self.client.pipeline(transaction=False) as pipe:
+            for name, value in counters.items():
+                pipe.hincrby(key, name, value)
+            pipe.expire(key, ttl)
+            pipe.execute()
+
+    def pop_counters(self, key):
+        with self.client.pipeline() as pipe:
+            pipe.hgetall(key)
+            pipe.delete(key)
+            counters, _ = pipe.execute()
+        return {name.decode(): int(value) for name, value in counters.items()}
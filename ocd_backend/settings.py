@@ -13,10 +13,17 @@ from pythonjsonlogger import jsonlogger
 
 from version import __version__, __version_info__
 
+from ocd_backend.utils import task_serializer
+
 register('ocd_serializer', pickle.dumps, pickle.loads,
          content_encoding='binary',
          content_type='application/x-pickle2')
 
+# Pickle with zstd compression of large messages, see ocd_backend.utils.task_serializer
+register('ocd_zstd', task_serializer.dumps, task_serializer.loads,
+         content_encoding='binary',
+         content_type=task_serializer.CONTENT_TYPE)
+
 APP_VERSION = __version__
 MAJOR_VERSION = __version_info__[0]
 MINOR_VERSION = __version_info__[1]
@@ -42,14 +49,16 @@ TIMEZONE = 'Europe/Amsterdam'
 transformers_exchange = Exchange('transformers', type='direct')
 enrichers_exchange = Exchange('enrichers', type='direct')
 loaders_exchange = Exchange('loaders', type='direct')
+pipeline_exchange = Exchange('pipeline', type='direct')
 
 CELERY_CONFIG = {
     'broker_url': REDIS_URL,
-    'accept_content': ['ocd_serializer'],
-    'task_serializer': 'ocd_serializer',
-    'result_serializer': 'ocd_serializer',
+    # ocd_serializer (pickle) is still accepted for messages queued before switching to ocd_zstd
+    'accept_content': ['ocd_zstd', 'ocd_serializer'],
+    'task_serializer': 'ocd_zstd',
+    'result_serializer': 'ocd_zstd',
     'result_backend': 'ocd_backend.result_backends:OCDRedisBackend+%s' % REDIS_URL,
-    'result_compression': 'gzip',
+    # Large results are already compressed by ocd_zstd
     'worker_hijack_root_logger': False,
     # ACKS_LATE prevents two tasks triggered at the same time to hang
     # https://wiredcraft.com/blog/3-gotchas-for-celery/
@@ -80,9 +89,11 @@ CELERY_CONFIG = {
             'routing_key': 'loaders',
             'priority': 0,
         },
+        # setup_pipeline has its own worker, since the extractor may wait for the loaders
+        # to finish chains before it continues
         'ocd_backend.pipeline.*': {
-            'queue': 'loaders',
-            'routing_key': 'loaders',
+            'queue': 'pipeline',
+            'routing_key': 'pipeline',
             'priority': 0,
         },
     },
@@ -90,6 +101,7 @@ CELERY_CONFIG = {
         Queue('transformers', transformers_exchange, routing_key='transformers'),
         Queue('enrichers', enrichers_exchange, routing_key='enrichers'),
         Queue('loaders', loaders_exchange, routing_key='loaders'),
+        Queue('pipeline', pipeline_exchange, routing_key='pipeline'),
     ),
     'CELERY_TASK_DEFAULT_QUEUE': 'transformers',
     'CELERY_TASK_DEFAULT_EXCHANGE': 'transformers',
@@ -232,10 +244,30 @@ ELASTICSEARCH_PORT = os.getenv('ELASTICSEARCH_SERVICE_PORT', 9200)
 # The path of the directory used to store static files
 DATA_DIR_PATH = os.path.join(PROJECT_PATH, 'data')
 
+# Large document texts are passed from the text enricher to the loaders through files in
+# CLAIM_CHECK_PATH instead of through the broker, see ocd_backend.utils.claim_check.
+# The backend and loader containers must share this directory.
+CLAIM_CHECK_ENABLED = os.getenv('CLAIM_CHECK_ENABLED', 'true').lower() == 'true'
+CLAIM_CHECK_PATH = os.path.join(DATA_DIR_PATH, 'claim_check')
+# Minimum number of characters of a text property before it is claim checked
+CLAIM_CHECK_MIN_SIZE = 16 * 1024
+# Claim checks that were not used for this number of seconds are removed after a run
+CLAIM_CHECK_MAX_AGE = 7 * 24 * 60 * 60
+
+# When enabled, the raw responses of suppliers are stored in RESPONSE_ARCHIVE_PATH, so a
+# source can be run again from the archive with `extract start --replay`, see
+# ocd_backend.utils.response_archive. Sources can enable it with `archive_responses`.
+RESPONSE_ARCHIVE_ENABLED = os.getenv('RESPONSE_ARCHIVE_ENABLED', 'false').lower() == 'true'
+RESPONSE_ARCHIVE_PATH = os.path.join(DATA_DIR_PATH, 'response_archive')
+
 # The path of the directory used to store temporary files
 TEMP_DIR_PATH = '/tmp'
 tempfile.tempdir = TEMP_DIR_PATH
 
+# Downloaded files are kept in memory up to DOWNLOAD_SPOOL_MAX_SIZE bytes, larger files
+# are written to TEMP_DIR_PATH
+DOWNLOAD_SPOOL_MAX_SIZE = 1024 * 1024
+
 # The path of the JSON file containing the sources config
 SOURCES_CONFIG_FILE = os.path.join(ROOT_PATH, 'sources/*')
 
@@ -253,9 +285,45 @@ RESOLVER_BASE_URL = os.getenv('RESOLVER_BASE_URL', 'https://api.openraadsinforma
 # The User-Agent that is used when retrieving data from external sources
 USER_AGENT = 'Open Raadsinformatie/%s.%s (+http://www.openraadsinformatie.nl/)' % (MAJOR_VERSION, MINOR_VERSION)
 
+# The parsed Notubiz /organisations document is shared by the extractors through Redis.
+# After NOTUBIZ_ORGANIZATIONS_CACHE_TTL seconds it is revalidated with a conditional
+# request, expired copies are kept for NOTUBIZ_ORGANIZATIONS_CACHE_MAX_AGE seconds.
+NOTUBIZ_ORGANIZATIONS_CACHE_TTL = 6 * 60 * 60
+NOTUBIZ_ORGANIZATIONS_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Fields by item type that are left out of the fingerprint used to detect changed items,
+# because they are large or change without the item changing. Sources can set their own
+# with `hash_excluded_fields`.
+HASH_EXCLUDED_FIELDS = {
+    'person': ['Picture'],
+}
+
+# Default budgets of the shared rate limiter in ocd_backend.utils.rate_limiter, in calls
+# per second. Sources set their own with `rate_limit` (per site) and `supplier_rate_limit`
+# (shared by all sites of the supplier). After a throttling response all calls to the
+# supplier pause for RATE_LIMIT_BACKOFF seconds, doubled for each consecutive failure.
+# After other faults only the calls to the site pause.
+RATE_LIMIT_DEFAULT = {'rate': 1, 'burst': 1}
+RATE_LIMIT_SUPPLIER_DEFAULT = {'rate': 10, 'burst': 10}
+RATE_LIMIT_BACKOFF = 1
+RATE_LIMIT_MAX_BACKOFF = 60
+
+# Every worker process keeps the ORI ids of up to ORI_ID_CACHE_SIZE IRIs in memory. When
+# ORI_ID_CACHE_REDIS is enabled, the workers share the ids they resolved through Redis.
+ORI_ID_CACHE_SIZE = 100000
+ORI_ID_CACHE_REDIS = os.getenv('ORI_ID_CACHE_REDIS', 'false').lower() == 'true'
+ORI_ID_CACHE_REDIS_TTL = 30 * 24 * 60 * 60
+
 # The endpoint for the iBabs API
 IBABS_WSDL = 'https://wcf.ibabs.eu/api/Public.svc?singleWsdl'
 
+# Downloaded WSDL and XSD documents are kept in WSDL_CACHE_PATH and checked for a new
+# version after WSDL_CACHE_TIMEOUT seconds
+WSDL_CACHE_PATH = os.path.join(DATA_DIR_PATH, 'wsdl_cache')
+WSDL_CACHE_TIMEOUT = 24 * 60 * 60
+# Seconds a worker waits for the iBabs WSDL when it starts, see ocd_backend.app.preload_wsdl
+WSDL_PRELOAD_TIMEOUT = 10
+
 # The endpoint for the CompanyWebcast API
 CWC_WSDL = 'https://services.companywebcast.com/meta/1.2/metaservice.svc?singleWsdl'
 
@@ -266,6 +334,24 @@ AUTORETRY_RETRY_BACKOFF = 30
 RETRY_MAX_RETRIES = 6 # 9 RVD temporarily set lower to speed up overall reindexing
 AUTORETRY_RETRY_BACKOFF_MAX = 15360
 
+# Backpressure for setup_pipeline, enabled per source with `pipeline_high_water_mark`
+# (and optionally `pipeline_low_water_mark`). While paused, the number of unfinished
+# chains is polled every PIPELINE_BACKPRESSURE_POLL_INTERVAL seconds. If that number
+# has not dropped for PIPELINE_BACKPRESSURE_STALL_TIMEOUT seconds the extractor resumes
+# anyway, so stuck chains can not deadlock the pipeline. setup_pipeline runs in its own
+# `pipeline` queue, so it does not occupy the loaders worker it is waiting for.
+PIPELINE_BACKPRESSURE_POLL_INTERVAL = 2
+PIPELINE_BACKPRESSURE_STALL_TIMEOUT = 300
+
+# setup_pipeline registers and starts chains in batches of this size, so the chain ids
+# are added to Redis in one round trip per batch
+PIPELINE_CHAIN_REGISTRATION_BATCH_SIZE = 20
+
+# Lifetime of the extractor checkpoint of a run in seconds. It must outlive all retries
+# of setup_pipeline: 9 retries with the backoff above add up to 30660 seconds, on top of
+# the time each attempt spends extracting.
+PIPELINE_CHECKPOINT_TTL = 2 * 24 * 60 * 60
+
 # Postgres settings
 POSTGRES_HOST = '{}:{}'.format(os.getenv('POSTGRES_SERVICE_HOST', 'postgres'), os.getenv('POSTGRES_SERVICE_PORT', 5432))
 POSTGRES_DATABASE = os.getenv('POSTGRES_DATABASE', 'ori')
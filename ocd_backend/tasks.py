@@ -4,10 +4,11 @@ import re
 from ocd_backend import settings
 from ocd_backend.app import celery_app
 from ocd_backend.es import elasticsearch as es
+from ocd_backend.hash_for_item import set_processed
 from ocd_backend.log import get_source_logger
-from ocd_backend.models.postgres_database import PostgresDatabase
-from ocd_backend.models.postgres_models import ItemHash
+from ocd_backend.models.postgres_database import OriIdCache, PostgresDatabase
 from ocd_backend.models.serializers import PostgresSerializer
+from ocd_backend.utils import claim_check
 from ocd_backend.utils.indexed_file import IndexedFile
 from ocd_backend.utils.misc import iterate
 from ocd_backend.settings import AUTORETRY_EXCEPTIONS, RETRY_MAX_RETRIES, AUTORETRY_RETRY_BACKOFF, AUTORETRY_RETRY_BACKOFF_MAX
@@ -20,30 +21,29 @@ class BaseCleanup(celery_app.Task):
     ignore_result = True
 
     def start(self, *args, **kwargs):
-        source_run_identifier = kwargs.get('source_run_identifier')
-        run_identifier = kwargs.get('run_identifier')
-        run_identifier_chains = '{}_chains'.format(run_identifier)
-        self._remove_chain(source_run_identifier, kwargs.get('chain_id'))
-        self._remove_chain(run_identifier_chains, kwargs.get('chain_id'))
-
-        run_result = self.backend.get(run_identifier)
-        if isinstance(run_result, bytes):
-            run_result = run_result.decode()
-        if self.backend.get_set_cardinality(run_identifier_chains) < 1 and run_result != 'running':
-            # All tasks for an entity (e.g. meetings or committees) have finished
-            self.backend.remove(run_identifier_chains)
-        else:
-            # If the extractor is still running, extend the lifetime of the
-            # identifier
-            self.backend.update_ttl(run_identifier, settings.CELERY_CONFIG
-                                    .get('CELERY_TASK_RESULT_EXPIRES', 1800))
+        source_run_finished = self.backend.complete_chain(
+            kwargs.get('run_identifier'),
+            kwargs.get('source_run_identifier'),
+            kwargs.get('chain_id'),
+            settings.CELERY_CONFIG.get('CELERY_TASK_RESULT_EXPIRES', 1800))
 
-        if self.backend.get_set_cardinality(source_run_identifier) < 1 and run_result != 'running':
+        if source_run_finished:
             # All tasks for a source (i.e. all meetings, committees etc.) have finished
-            self.run_finished(**kwargs)
-
-    def _remove_chain(self, run_identifier, value):
-        self.backend.remove_value_from_set(run_identifier, value)
+            try:
+                self.run_finished(**kwargs)
+            except Exception:
+                # Allow a retry of this task to report the finished run again
+                self.backend.reset_run_finished(kwargs.get('source_run_identifier'))
+                raise
+
+            self.log_ori_id_cache_counters(**kwargs)
+
+    def log_ori_id_cache_counters(self, source_run_identifier=None, **kwargs):
+        counters = self.backend.pop_counters(OriIdCache.run_counters_key(source_run_identifier))
+        if counters:
+            log.info(f'[{kwargs["source_definition"]["key"]}] ORI id cache of run {source_run_identifier}: '
+                     f'{counters.get("hits", 0)} hits, {counters.get("redis_hits", 0)} hits in Redis and '
+                     f'{counters.get("misses", 0)} misses')
 
     def run_finished(self, run_identifier, **kwargs):
         raise NotImplementedError('Cleanup is highly dependent on what you use '
@@ -89,6 +89,8 @@ class CleanupElasticsearch(BaseCleanup):
         if current_index_name != new_index_name:
             es.indices.delete(index=current_index_name)
 
+        claim_check.purge_expired()
+
         self.signal_processing_finished(**kwargs)
 
         return result
@@ -141,26 +143,24 @@ class Finalizer(celery_app.Task):
         self.session = database.Session()
 
     def start(self, *args, **kwargs):
-        self.hash_for_item = kwargs['hash_for_item']
+        # When the pipeline runs in batch mode a list of hashes is passed
+        hashes_for_items = kwargs['hash_for_item']
+        if not isinstance(hashes_for_items, list):
+            hashes_for_items = [hashes_for_items]
 
-        if not self.hash_for_item:
-            return
+        for hash_for_item in hashes_for_items:
+            if not hash_for_item:
+                continue
 
-        self.set_processed()
+            # An item can carry the hash of the item it belongs to, like the vote of a meeting
+            if isinstance(hash_for_item, list):
+                self.start(hash_for_item=hash_for_item)
+                continue
 
-    def set_processed(self):
-        old_item = self.session.query(ItemHash).filter(ItemHash.item_id == self.hash_for_item.hash_key).first()
+            self.set_processed(hash_for_item)
 
-        if old_item:
-            if old_item.item_hash != self.hash_for_item.hash_value: 
-                old_item.item_hash = self.hash_for_item.hash_value
-                self.session.commit()
-                self.session.flush()
-        else:
-            new_item = ItemHash(item_id=self.hash_for_item.hash_key, item_hash=self.hash_for_item.hash_value)
-            self.session.add(new_item)
-            self.session.commit()
-            self.session.flush()
+    def set_processed(self, hash_for_item):
+        set_processed(self.session, hash_for_item)
 
 
 @celery_app.task(bind=True, base=CleanupElasticsearch, autoretry_for=AUTORETRY_EXCEPTIONS,
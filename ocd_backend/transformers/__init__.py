@@ -5,10 +5,22 @@ from lxml import etree
 from ocd_backend.app import celery_app
 from ocd_backend.exceptions import NoDeserializerAvailable
 from ocd_backend.mixins import OCDBackendTaskFailureMixin
+from ocd_backend.models.postgres_database import OriIdCache, PostgresDatabase
+from ocd_backend.settings import AUTORETRY_EXCEPTIONS, RETRY_MAX_RETRIES, AUTORETRY_RETRY_BACKOFF, AUTORETRY_RETRY_BACKOFF_MAX
+from ocd_backend.utils.misc import load_object
 
 
 class BaseTransformer(OCDBackendTaskFailureMixin, celery_app.Task):
 
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        # The ORI id cache counters of all workers are added up per source run, and logged
+        # by the cleanup when the run has finished
+        counters = PostgresDatabase.ori_id_cache.take_counters()
+        source_run_identifier = kwargs.get('source_run_identifier')
+        if source_run_identifier and any(counters.values()):
+            self.backend.add_counters(OriIdCache.run_counters_key(source_run_identifier), counters,
+                                      self.backend.source_run_ttl)
+
     @staticmethod
     def deserialize_item(content_type, raw_item):
         if content_type == 'application/json':
@@ -19,3 +31,22 @@ class BaseTransformer(OCDBackendTaskFailureMixin, celery_app.Task):
             return etree.HTML(raw_item)
         else:
             raise NoDeserializerAvailable('Item with content_type %s' % content_type)
+
+
+@celery_app.task(bind=True, base=BaseTransformer, autoretry_for=AUTORETRY_EXCEPTIONS,
+                 retry_backoff=AUTORETRY_RETRY_BACKOFF, max_retries=RETRY_MAX_RETRIES, retry_backoff_max=AUTORETRY_RETRY_BACKOFF_MAX)
+def batch_transformer(self, items, transformer, **kwargs):
+    """
+    Transforms a batch of extracted items in a single task invocation. Each item is
+    passed to the configured `transformer` task, which is executed in-process instead
+    of being sent to the broker. Used when `pipeline_batch_size` is set for a source.
+    """
+    self.source_definition = kwargs['source_definition']
+    transformer_task = load_object(transformer)
+
+    models = []
+    for item in items:
+        model = transformer_task(*item, **kwargs)
+        if model is not None:
+            models.append(model)
+    return models
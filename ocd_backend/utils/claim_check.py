@@ -0,0 +1,127 @@
+"""
+Claim-check storage for the extracted text of documents.
+
+After the text enricher has run, a MediaObject carries the full text of the document
+in `text`, `md_text` and `text_pages`. Instead of sending these fields through the
+broker to the loaders, `check_in` writes them to `CLAIM_CHECK_PATH` and replaces them
+by a small `ClaimCheck` reference. The loader calls `check_out` to put the text back
+just before the Elasticsearch body is built.
+
+Files are named after the hash of their contents, so identical texts are stored once
+and a retried task finds the file it wrote before. Files that were not used for
+`CLAIM_CHECK_MAX_AGE` seconds are removed by `purge_expired`.
+"""
+import json
+import os
+import time
+from hashlib import blake2b
+
+from ocd_backend.log import get_source_logger
+from ocd_backend.utils.misc import write_file_atomically
+from ocd_backend.settings import CLAIM_CHECK_ENABLED, CLAIM_CHECK_PATH, CLAIM_CHECK_MIN_SIZE, CLAIM_CHECK_MAX_AGE
+
+log = get_source_logger('claim_check')
+
+# Model properties that are replaced by a claim check when they are large
+CLAIM_CHECK_PROPERTIES = ['text', 'md_text', 'text_pages']
+
+
+class ClaimCheck:
+    """Reference to a property value that is stored in the claim-check storage"""
+    __slots__ = ['key']
+
+    def __init__(self, key):
+        self.key = key
+
+    def __getstate__(self):
+        return self.key
+
+    def __setstate__(self, state):
+        self.key = state
+
+    def __repr__(self):
+        return f'<ClaimCheck {self.key}>'
+
+
+def _path(key):
+    return os.path.join(CLAIM_CHECK_PATH, key[:2], f'{key}.json')
+
+
+def store(value):
+    """Stores `value` as JSON and returns the key"""
+    data = json.dumps(value, ensure_ascii=False).encode('utf-8', errors='surrogatepass')
+    key = blake2b(data, digest_size=20).hexdigest()
+    path = _path(key)
+
+    if os.path.exists(path):
+        # Mark as used, so it is not purged while this item is in flight
+        os.utime(path)
+        return key
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A loader never reads a partially written file
+    write_file_atomically(path, data)
+    return key
+
+
+def retrieve(key):
+    with open(_path(key), 'rb') as f:
+        return json.loads(f.read().decode('utf-8', errors='surrogatepass'))
+
+
+def check_in(model):
+    """Replaces the large text properties of `model` by claim checks"""
+    if not CLAIM_CHECK_ENABLED:
+        return
+
+    for name in CLAIM_CHECK_PROPERTIES:
+        value = model.values.get(name)
+        if not value or isinstance(value, ClaimCheck):
+            continue
+
+        if isinstance(value, str):
+            size = len(value)
+        elif name == 'text_pages':
+            size = sum(len(page.get('text') or '') for page in value)
+        else:
+            size = sum(len(page or '') for page in value)
+
+        if size >= CLAIM_CHECK_MIN_SIZE:
+            model.values[name] = ClaimCheck(store(value))
+
+
+def check_out(model):
+    """Replaces the claim checks in the properties of `model` by their stored values"""
+    for name in CLAIM_CHECK_PROPERTIES:
+        value = model.values.get(name)
+        if not isinstance(value, ClaimCheck):
+            continue
+
+        try:
+            model.values[name] = retrieve(value.key)
+        except FileNotFoundError:
+            log.warning(f'Claim check {value.key} for property {name} of {model.source_iri} '
+                        f'not found, indexing without it')
+            del model.values[name]
+
+
+def purge_expired():
+    """Removes the stored values that were not used for CLAIM_CHECK_MAX_AGE seconds"""
+    if not os.path.isdir(CLAIM_CHECK_PATH):
+        return
+
+    expire_before = time.time() - CLAIM_CHECK_MAX_AGE
+    removed = 0
+    for directory, _, file_names in os.walk(CLAIM_CHECK_PATH):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            try:
+                if os.path.getmtime(path) < expire_before:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                # Removed by another worker in the meantime
+                pass
+
+    if removed:
+        log.info(f'Removed {removed} expired claim checks')
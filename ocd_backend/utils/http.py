@@ -1,4 +1,5 @@
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 
 import requests
 import urllib3
@@ -7,7 +8,8 @@ from urllib3.util.retry import Retry
 
 from ocd_backend.exceptions import NotFound
 from ocd_backend.log import get_source_logger
-from ocd_backend.settings import USER_AGENT
+from ocd_backend.settings import USER_AGENT, DOWNLOAD_SPOOL_MAX_SIZE
+from ocd_backend.utils import response_archive
 
 log = get_source_logger('http')
 
@@ -40,6 +42,17 @@ class FileResource:
         self.media_file.seek(0, 0)
         return self.data
 
+    def to_path(self):
+        """
+        Writes the media file to a file on disk and returns its path, for callers that
+        need a real file. The file is not removed, the caller is responsible for it.
+        """
+        temporary_file = NamedTemporaryFile(delete=False)
+        with temporary_file:
+            shutil.copyfileobj(self.media_file, temporary_file)
+        self.media_file.seek(0, 0)
+        return temporary_file.name
+
 
 class HttpRequestMixin:
     """A mixin that can be used by extractors that use HTTP as a method
@@ -78,6 +91,8 @@ class HttpRequestMixin:
             http_adapter = HTTPAdapter(max_retries=http_retry)
             session.mount('https://', http_adapter)
 
+            response_archive.mount(session, source_definition)
+
             self._http_session = session
 
         return self._http_session
@@ -97,9 +112,9 @@ class HttpRequestMixin:
         http_resp = self.http_session.get(url, stream=True, timeout=(3, tm), verify=False)
         http_resp.raise_for_status()
 
-        # Create a temporary file to store the media item, write the file
-        # to disk if it is larger than 1 MB.
-        media_file = NamedTemporaryFile(delete=True)
+        # Create a temporary file to store the media item, which is kept in memory
+        # until it is larger than DOWNLOAD_SPOOL_MAX_SIZE and then written to disk
+        media_file = SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_SIZE)
 
         # When a partial fetch is requested, request up to two MB
         partial_target_size = 1024 * 1024 * 2
@@ -4,10 +4,12 @@ import importlib
 import re
 import json
 import codecs
-from hashlib import sha1
+import os
+from hashlib import blake2b, sha1
 from string import Formatter
 from urllib.parse import urlparse
 from functools import reduce
+from uuid import uuid4
 
 import pytz
 import iso8601
@@ -216,6 +218,11 @@ class DatetimeJSONEncoder(json.JSONEncoder):
 
 
 json_encoder = DatetimeJSONEncoder()
+# Encodes equal objects to equal strings, regardless of the order of their keys
+canonical_json_encoder = DatetimeJSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+# Prefix of fingerprints, hash values without it were made by an earlier version
+FINGERPRINT_VERSION = 'b2'
 
 class HashUtils:
     def create_hash_key(self, provider, site_name, item_type, id):
@@ -224,6 +231,19 @@ class HashUtils:
         h.update(hash_key.encode('ascii', 'replace'))
         return h.hexdigest()
 
+    def fingerprint(self, obj, excluded_fields=None):
+        """
+        Returns a versioned fingerprint of `obj` that does not depend on the order of
+        keys. The top level `excluded_fields` of a dict are left out.
+        """
+        if excluded_fields and isinstance(obj, dict):
+            obj = {key: value for key, value in obj.items() if key not in excluded_fields}
+        h = blake2b(canonical_json_encoder.encode(obj).encode('utf-8', 'surrogatepass'), digest_size=20)
+        return '%s:%s' % (FINGERPRINT_VERSION, h.hexdigest())
+
+    def is_current_fingerprint(self, hash_value):
+        return hash_value.startswith(FINGERPRINT_VERSION + ':')
+
 hash_utils = HashUtils()
 
 _punct_re = re.compile(r'[\t\r\n !"#$%&\'()*\-/<=>?@\[\\\]^_`{|},.]+')
@@ -358,3 +378,22 @@ def is_valid_date(s):
     except ParserError as e:
         result = False
     return result
+
+
+def write_file_atomically(path, data):
+    """
+    Writes `data` to `path` through a temporary file that is renamed, so readers never see a
+    partially written file. Every call uses its own temporary file, so threads and processes
+    that write the same path at the same time do not interfere: the last rename wins.
+    """
+    temporary_path = f'{path}.{uuid4().hex}.tmp'
+    try:
+        with open(temporary_path, 'xb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
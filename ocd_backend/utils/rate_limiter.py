@@ -0,0 +1,144 @@
+"""
+A rate limiter that is shared by all Celery workers.
+
+Each budget is a token bucket in Redis that is refilled with `rate` tokens per second
+up to `burst` tokens. A call takes a token from every bucket of the limiter, usually
+one for the supplier (shared by all sites of e.g. iBabs) and one for the site, and
+waits until all of them have a token available.
+
+When the remote service throttles, `backoff` empties all buckets, so all workers
+pause. Other faults only concern the site, so only the bucket of the site is emptied
+and the other sites of the supplier keep their pace. Consecutive failures double the
+pause up to `RATE_LIMIT_MAX_BACKOFF` seconds.
+"""
+import threading
+from time import sleep
+
+import redis
+
+from ocd_backend.log import get_source_logger
+from ocd_backend.settings import REDIS_HOST, REDIS_PORT, RATE_LIMIT_DEFAULT, RATE_LIMIT_SUPPLIER_DEFAULT, \
+    RATE_LIMIT_BACKOFF, RATE_LIMIT_MAX_BACKOFF
+
+log = get_source_logger('rate_limiter')
+
+# Refills the buckets and takes a token from each of them if all have one available.
+# Returns the number of seconds to wait before trying again, 0 if the tokens were taken.
+# The Redis server time is used, so the clocks of the workers do not need to be in sync.
+#
+# KEYS: the buckets
+# ARGV: the rate and burst of each bucket, followed by the backoff in seconds.
+#       With a backoff, no token is taken and the buckets are emptied instead.
+TOKEN_BUCKET_SCRIPT = """
+-- Effects replication is the default since Redis 5, this is for older servers
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local backoff = tonumber(ARGV[#KEYS * 2 + 1])
+
+local available = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if backoff > 0 then
+        tokens = math.min(tokens, -backoff * rate)
+    end
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    available[i] = tokens
+end
+
+for i, key in ipairs(KEYS) do
+    local tokens = available[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HMSET', key, 'tokens', tostring(tokens), 'updated', tostring(now))
+    -- A bucket that is full again does not need to be kept
+    redis.call('EXPIRE', key, math.ceil((tonumber(ARGV[i * 2]) - tokens) / tonumber(ARGV[i * 2 - 1])) + 1)
+end
+
+-- Numbers returned by a script are truncated to integers
+return tostring(wait)
+"""
+
+
+class RateLimiter:
+    redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=2, decode_responses=True)
+    token_bucket_script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def __init__(self, budgets):
+        """
+        :param budgets: list of (name, budget) tuples, where budget is a dict with the
+            `rate` in calls per second and the `burst` size of the bucket. The last budget
+            is the most specific one, like the one of a site.
+        """
+        self.keys = []
+        self.rates = []
+        self.args = []
+        for name, budget in budgets:
+            rate = float(budget['rate'])
+            burst = float(budget.get('burst', max(rate, 1)))
+            self.keys.append(f'ori_rate_limit_{name}')
+            self.rates.append(rate)
+            self.args += [rate, burst]
+
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_source(cls, source_definition, site):
+        """
+        Returns a limiter with the `supplier_rate_limit` budget of the supplier and the
+        `rate_limit` budget of `site`, as set in the source definition
+        """
+        supplier = source_definition.get('supplier', 'default')
+        return cls([
+            (supplier, source_definition.get('supplier_rate_limit', RATE_LIMIT_SUPPLIER_DEFAULT)),
+            (f'{supplier}_{site}', source_definition.get('rate_limit', RATE_LIMIT_DEFAULT)),
+        ])
+
+    def run_script(self, keys, args, backoff=0):
+        try:
+            return float(self.token_bucket_script(keys=keys, args=args + [backoff]))
+        except redis.RedisError as e:
+            # Without Redis the budget can not be shared, so stay within the budget of this worker
+            log.warning(f'Unable to use the shared rate limiter: {e}')
+            return None
+
+    def acquire(self):
+        """Blocks until a call is allowed by all budgets"""
+        while True:
+            wait = self.run_script(self.keys, self.args)
+            if wait is None:
+                sleep(1 / min(self.rates))
+                return
+            if wait <= 0:
+                return
+            sleep(wait)
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+
+    def backoff(self, seconds=None, throttled=False):
+        """
+        Pauses calls for `seconds` or an exponentially increasing time. When the remote
+        service `throttled`, all budgets are paused, otherwise only the last one.
+        """
+        with self.lock:
+            self.failures += 1
+            if not seconds:
+                seconds = min(RATE_LIMIT_MAX_BACKOFF, RATE_LIMIT_BACKOFF * 2 ** (self.failures - 1))
+
+        keys, args = (self.keys, self.args) if throttled else (self.keys[-1:], self.args[-2:])
+        log.info(f'Backing off {", ".join(keys)} for {seconds} seconds')
+        self.run_script(keys, args, backoff=seconds)
@@ -0,0 +1,149 @@
+"""
+Archive of the raw responses of suppliers, used to run a pipeline again without
+network I/O.
+
+When archiving is enabled for a source, `mount` wraps the adapters of a requests
+session, which is also the session used by the zeep transport of iBabs. Every response
+is then stored in `RESPONSE_ARCHIVE_PATH`: the body is compressed and named after the
+hash of its contents, so identical payloads are stored once, and an index entry named
+after the request (method, URL and body) refers to it.
+
+A source that is run with `replay` set to '1' is served from the archive only. A request
+that was not archived raises `ResponseNotArchived` instead of going to the network, so a
+replay never fetches anything. Requests must be the same as in the archived run, so use
+the same `start_date` and `end_date` when the source selects a date interval.
+"""
+import gzip
+import json
+import os
+from hashlib import blake2b
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from ocd_backend.exceptions import ResponseNotArchived
+from ocd_backend.log import get_source_logger
+from ocd_backend.utils.misc import write_file_atomically
+from ocd_backend.settings import RESPONSE_ARCHIVE_ENABLED, RESPONSE_ARCHIVE_PATH
+
+log = get_source_logger('response_archive')
+
+# Throttling and temporary server errors are not archived, a replay would repeat them
+NOT_ARCHIVED_STATUS_CODES = (429, 502, 503, 504)
+
+
+def is_replay(source_definition):
+    return str(source_definition.get('replay', '0')) == '1'
+
+
+def is_enabled(source_definition):
+    return is_replay(source_definition) or source_definition.get('archive_responses', RESPONSE_ARCHIVE_ENABLED)
+
+
+def _path(kind, key, extension):
+    return os.path.join(RESPONSE_ARCHIVE_PATH, kind, key[:2], f'{key}.{extension}')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A replay never reads a partially written file
+    write_file_atomically(path, data)
+
+
+def request_key(method, url, body=None):
+    """Returns the key of the index entry of a request"""
+    if body is None:
+        body = b''
+    elif isinstance(body, str):
+        body = body.encode('utf-8')
+
+    h = blake2b(digest_size=20)
+    h.update(f'{method.upper()} {url}\n'.encode('utf-8'))
+    h.update(body)
+    return h.hexdigest()
+
+
+def store(key, status_code, headers, content):
+    """Stores a response under the request `key`"""
+    content_key = blake2b(content, digest_size=20).hexdigest()
+    content_path = _path('content', content_key, 'gz')
+    if not os.path.exists(content_path):
+        _write(content_path, gzip.compress(content))
+
+    entry = {
+        'status_code': status_code,
+        'headers': dict(headers),
+        'content': content_key,
+    }
+    _write(_path('index', key, 'json'), json.dumps(entry).encode('utf-8'))
+
+
+def retrieve(key):
+    """Returns the (status_code, headers, content) of the response archived under `key`"""
+    try:
+        with open(_path('index', key, 'json'), 'rb') as f:
+            entry = json.loads(f.read())
+    except FileNotFoundError:
+        raise ResponseNotArchived(key)
+
+    with gzip.open(_path('content', entry['content'], 'gz'), 'rb') as f:
+        content = f.read()
+    return entry['status_code'], entry['headers'], content
+
+
+class ArchiveAdapter(BaseAdapter):
+    """
+    A transport adapter that archives the responses of the adapter it wraps, or serves
+    them from the archive when `replay` is set
+    """
+
+    def __init__(self, adapter, replay=False):
+        super(ArchiveAdapter, self).__init__()
+        self.adapter = adapter
+        self.replay = replay
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.url, request.body)
+
+        if self.replay:
+            try:
+                status_code, headers, content = retrieve(key)
+            except ResponseNotArchived:
+                raise ResponseNotArchived(f'No archived response for {request.method} {request.url}')
+            return self.build_response(request, status_code, headers, content)
+
+        response = self.adapter.send(request, **kwargs)
+        if response.status_code not in NOT_ARCHIVED_STATUS_CODES:
+            # Reads a streamed response, it is kept in memory for the caller
+            store(key, response.status_code, response.headers, response.content)
+        return response
+
+    @staticmethod
+    def build_response(request, status_code, headers, content):
+        response = Response()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        # The archived content is decoded already
+        response.headers.pop('Content-Encoding', None)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = content
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def mount(session, source_definition):
+    """Archives the responses of `session`, or replays them, when enabled for the source"""
+    if not source_definition or not is_enabled(source_definition):
+        return
+
+    replay = is_replay(source_definition)
+    for prefix in ('http://', 'https://'):
+        adapter = session.get_adapter(prefix)
+        if not isinstance(adapter, ArchiveAdapter):
+            session.mount(prefix, ArchiveAdapter(adapter, replay=replay))
@@ -46,6 +46,12 @@ def retry_task(fun):
 
     return handle_retry
 
+
+def will_retry(task, error):
+    """Returns whether `retry_task` schedules another attempt of `task` after `error`"""
+    return isinstance(error, tuple(AUTORETRY_EXCEPTIONS)) and is_retryable_error(error) and \
+        task.request.retries < task.max_retries
+
 def is_retryable_error(error, url = None, retries_sofar = None):
     error_string = str(error)
     retryable = True
@@ -0,0 +1,21 @@
+from ocd_backend.extractors import BaseExtractor
+from tests.ocd_backend.extractors import ExtractorTestCase
+
+
+class CheckpointTestCase(ExtractorTestCase):
+    def setUp(self):
+        super(CheckpointTestCase, self).setUp()
+        self.source_definition['key'] = 'test'
+        self.extractor = BaseExtractor(self.source_definition)
+
+    def test_checkpoint_follows_units(self):
+        checkpoints = []
+        for unit in self.extractor.checkpointed(['a', 'b', 'c']):
+            checkpoints.append((unit, self.extractor.checkpoint['unit']))
+
+        self.assertEqual(checkpoints, [('a', 0), ('b', 1), ('c', 2)])
+
+    def test_resume_skips_completed_units(self):
+        self.extractor.resume_checkpoint = {'unit': 2}
+
+        self.assertEqual(list(self.extractor.checkpointed(['a', 'b', 'c', 'd'])), ['c', 'd'])
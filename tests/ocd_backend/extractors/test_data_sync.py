@@ -0,0 +1,96 @@
+from unittest import mock
+
+from ocd_backend.extractors.data_sync import DataSyncBaseExtractor
+from tests.ocd_backend.extractors import ExtractorTestCase
+
+
+class ChildExtractor:
+    def __init__(self, source_id, ids):
+        self.source_definition = {'id': source_id}
+        self.ids = ids
+        self.extracted = 0
+
+    def run(self):
+        for item_id in self.ids:
+            self.extracted += 1
+            yield 'application/json', {'id': item_id, 'source': self.source_definition['id']}
+
+
+class SortedDataSyncExtractor(DataSyncBaseExtractor):
+    sorted_inputs = True
+
+    def match_key(self, dataset_id, data_item):
+        return data_item[1]['id']
+
+    def select_data_item(self, data_items):
+        return 'application/json', sorted(data_items)
+
+
+class DataSyncTestCase(ExtractorTestCase):
+    def setUp(self):
+        super(DataSyncTestCase, self).setUp()
+        self.source_definition.update({'sources_config': None, 'sources': []})
+
+        with mock.patch('ocd_backend.extractors.data_sync.load_sources_config', return_value=[]):
+            self.extractor = SortedDataSyncExtractor(self.source_definition)
+        self.extractor.extractors = [ChildExtractor('a', [1, 2, 4]), ChildExtractor('b', [2, 3, 4])]
+
+    def test_merge_join(self):
+        self.assertEqual(list(self.extractor.run()), [
+            ('application/json', ['a']),
+            ('application/json', ['a', 'b']),
+            ('application/json', ['b']),
+            ('application/json', ['a', 'b']),
+        ])
+
+    def test_items_are_matched_while_extracting(self):
+        items = self.extractor.run()
+        next(items)
+
+        # The first key is emitted once the second dataset has moved past it
+        self.assertEqual([x.extracted for x in self.extractor.extractors], [2, 1])
+
+    def test_unsorted_input_is_matched_again(self):
+        self.extractor.extractors[1].ids = [3, 2, 4]
+
+        items = list(self.extractor.run())
+
+        # Keys 1 and 2 were yielded before key 2 of dataset b turned out to be out of order,
+        # key 2 without the item of b
+        self.assertEqual(items[:2], [('application/json', ['a']), ('application/json', ['a'])])
+        self.assertEqual(items[2:], [
+            ('application/json', ['a']),
+            ('application/json', ['a', 'b']),
+            ('application/json', ['b']),
+            ('application/json', ['a', 'b']),
+        ])
+
+    def test_duplicate_keys_keep_the_first_item(self):
+        self.extractor.extractors[1].ids = [2, 2, 3]
+        self.extractor.select_data_item = lambda data_items: ('application/json', data_items)
+
+        items = [data_items for _, data_items in self.extractor.run()]
+
+        self.assertEqual(len(items), 4)
+        self.assertEqual(items[1], {'a': ('application/json', {'id': 2, 'source': 'a'}),
+                                    'b': ('application/json', {'id': 2, 'source': 'b'})})
+
+    def test_duplicate_keys_are_merged(self):
+        self.extractor.extractors[1].ids = [2, 2, 3]
+        self.extractor.merge_duplicates = mock.Mock(return_value='merged')
+        self.extractor.select_data_item = lambda data_items: ('application/json', data_items)
+
+        items = [data_items for _, data_items in self.extractor.run()]
+
+        self.extractor.merge_duplicates.assert_called_once_with(
+            'b', 2, ('application/json', {'id': 2, 'source': 'b'}), ('application/json', {'id': 2, 'source': 'b'}))
+        self.assertEqual(items[1]['b'], 'merged')
+
+    def test_hash_join(self):
+        datasets = [('a', [('application/json', {'id': i}) for i in [4, 1, 2]]),
+                    ('b', [('application/json', {'id': i}) for i in [2, 3, 3]])]
+
+        matched = self.extractor.hash_join(datasets)
+
+        self.assertEqual([(key, sorted(data_items)) for key, data_items in matched],
+                         [(1, ['a']), (2, ['a', 'b']), (3, ['b']), (4, ['a'])])
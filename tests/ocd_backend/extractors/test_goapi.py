@@ -0,0 +1,53 @@
+import time
+from datetime import datetime
+from unittest import mock
+
+from ocd_backend.extractors import goapi
+from ocd_backend.extractors.goapi import GemeenteOplossingenDocumentsExtractor
+from tests.ocd_backend.extractors import ExtractorTestCase
+
+
+class GemeenteOplossingenFetchIntervalsTestCase(ExtractorTestCase):
+    def setUp(self):
+        super(GemeenteOplossingenFetchIntervalsTestCase, self).setUp()
+        self.source_definition.update({
+            'key': 'test',
+            'base_url': 'https://gemeente.example.org/api',
+            'start_date': '2020-01-01',
+            'end_date': '2020-12-31',
+            'fetch_workers': 3,
+        })
+        self.extractor = GemeenteOplossingenDocumentsExtractor(self.source_definition)
+
+        patcher = mock.patch.object(goapi, 'RateLimiter')
+        self.rate_limiter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, path):
+        # Later intervals are returned first
+        time.sleep(0.05 if '2020-01' in path else 0.01)
+        return 1, [path]
+
+    def test_intervals_are_yielded_in_date_order(self):
+        with mock.patch.object(self.extractor, '_request', side_effect=self.request):
+            intervals = list(self.extractor.fetch_intervals(self.extractor.documents_path))
+
+        self.assertEqual([start_date for start_date, _, _, _, _ in intervals],
+                         [start_date for start_date, _ in self.extractor.interval_generator()])
+        self.assertEqual([results for _, _, _, _, results in intervals],
+                         [[path] for _, _, path, _, _ in intervals])
+        self.assertEqual(intervals[0][0], datetime(2020, 1, 1))
+
+    def test_checkpoint_follows_yielded_interval(self):
+        with mock.patch.object(self.extractor, '_request', side_effect=self.request):
+            for index, _ in enumerate(self.extractor.fetch_intervals(self.extractor.documents_path)):
+                self.assertEqual(self.extractor.checkpoint, {'unit': index})
+
+    def test_requests_share_the_budget_of_the_host(self):
+        with mock.patch.object(self.extractor, '_request', side_effect=self.request):
+            intervals = list(self.extractor.fetch_intervals(self.extractor.documents_path))
+
+        self.rate_limiter.for_source.assert_called_once_with(self.source_definition, 'gemeente.example.org')
+        rate_limiter = self.rate_limiter.for_source.return_value
+        self.assertEqual(rate_limiter.acquire.call_count, len(intervals))
+        self.assertEqual(rate_limiter.succeeded.call_count, len(intervals))
@@ -0,0 +1,230 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+from requests.exceptions import ConnectionError
+from zeep.exceptions import Fault
+
+from ocd_backend.extractors import BaseExtractor, ibabs
+from ocd_backend.extractors.ibabs import IBabsBaseExtractor, IBabsReportsExtractor, IBabsVotesMeetingsExtractor, \
+    WsdlFileCache
+from ocd_backend.tasks import Finalizer
+from ocd_backend.utils.ibabs import meeting_to_dict
+
+
+class WsdlFileCacheTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = WsdlFileCache(os.path.join(self.directory.name, 'wsdl_cache'), timeout=60)
+
+    def test_add_and_get(self):
+        self.assertIsNone(self.cache.get('https://example.org/service?singleWsdl'))
+
+        self.cache.add('https://example.org/service?singleWsdl', b'<definitions/>')
+
+        self.assertEqual(self.cache.get('https://example.org/service?singleWsdl'), b'<definitions/>')
+        self.assertIsNone(self.cache.get('https://example.org/other?singleWsdl'))
+
+    def test_threads_add_the_same_document(self):
+        barrier = threading.Barrier(8, timeout=5)
+        replace = os.replace
+
+        def replace_together(source, destination):
+            # All threads have written their file before the first one is renamed
+            barrier.wait()
+            replace(source, destination)
+
+        def add(_):
+            self.cache.add('https://example.org/service?singleWsdl', b'<definitions/>')
+
+        with mock.patch('os.replace', replace_together), ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(add, range(8)))
+
+        self.assertEqual(self.cache.get('https://example.org/service?singleWsdl'), b'<definitions/>')
+        self.assertEqual(len(os.listdir(os.path.join(self.directory.name, 'wsdl_cache'))), 1)
+
+    def test_expired_document_is_not_returned(self):
+        self.cache.add('https://example.org/service?singleWsdl', b'<definitions/>')
+        path = self.cache._path('https://example.org/service?singleWsdl')
+        os.utime(path, (0, 0))
+
+        self.assertIsNone(self.cache.get('https://example.org/service?singleWsdl'))
+
+
+class PreloadWsdlTestCase(TestCase):
+    def test_unreachable_wsdl_is_not_fatal(self):
+        with mock.patch.object(ibabs, 'get_wsdl_document', side_effect=ConnectionError('Connection refused')) \
+                as get_wsdl_document:
+            ibabs.preload_wsdl()
+
+        self.assertEqual(get_wsdl_document.call_args[1], {'timeout': ibabs.settings.WSDL_PRELOAD_TIMEOUT})
+
+
+class IBabsReportsExtractorTestCase(TestCase):
+    def setUp(self):
+        source_definition = {
+            'key': 'test',
+            'ibabs_sitename': 'Test',
+            'regex': 'moties',
+            'per_page': 10,
+            'start_date': '2024-01-01',
+            'end_date': '2024-12-31',
+        }
+        with mock.patch.object(IBabsBaseExtractor, '__init__', BaseExtractor.__init__):
+            self.extractor = IBabsReportsExtractor(source_definition)
+        self.extractor.hash_for_item = lambda provider, site_name, item_type, item_id, report_dict: 'hash%d' % item_id
+
+        self.client = self.extractor.client = mock.Mock()
+        self.client.service.GetLists.return_value = [mock.Mock(Key='list', Value='Moties')]
+        self.client.service.GetListReports.return_value = [mock.Mock(Key='report', Value='Moties')]
+
+        # The rows as found in documents that zeep could not parse into a diffgram
+        rows = [{'results': {'id': entry_id, 'registrationdate': '2024-05-01T00:00:00'}} for entry_id in range(5)]
+        data_set = mock.Mock(ListName='Moties', ReportName='Moties')
+        data_set.Data = mock.Mock(spec=['_value_1'])
+        data_set.Data._value_1._value_1 = rows
+        self.client.service.GetListReportDataSet.return_value = data_set
+        self.client.service.GetListEntry.side_effect = self.get_list_entry
+
+        patcher = mock.patch.object(ibabs, 'list_entry_response_to_dict', lambda entry: entry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def get_list_entry(Sitename, ListId, EntryId):
+        # Earlier entries take longer, so the entries are retrieved out of order
+        time.sleep(0.01 * (5 - EntryId))
+        if EntryId == 2:
+            raise Fault('Entry can not be retrieved')
+        return {'Values': {'Nummer': str(EntryId)}}
+
+    def test_list_entries_are_added_in_order(self):
+        reports = [json.loads(item[1]) for item in self.extractor.run()]
+
+        self.assertEqual([report['id'] for report in reports], [0, 1, 2, 3, 4])
+        self.assertEqual([report['_Extra'] for report in reports], [
+            {'Values': {'Nummer': '0'}},
+            {'Values': {'Nummer': '1'}},
+            # An entry that can not be retrieved does not stop the others
+            {},
+            {'Values': {'Nummer': '3'}},
+            {'Values': {'Nummer': '4'}},
+        ])
+
+    def test_error_after_the_list_entries_is_raised(self):
+        self.extractor.hash_for_item = mock.Mock(side_effect=['hash0', ConnectionError('Connection aborted')])
+
+        items = self.extractor.run()
+        self.assertEqual(next(items)[-1], 'hash0')
+        with self.assertRaises(ConnectionError):
+            next(items)
+
+
+class IBabsVotesMeetingsExtractorTestCase(TestCase):
+    def setUp(self):
+        source_definition = {
+            'key': 'test',
+            'ibabs_sitename': 'Test',
+        }
+        with mock.patch.object(IBabsBaseExtractor, '__init__', BaseExtractor.__init__):
+            self.extractor = IBabsVotesMeetingsExtractor(source_definition)
+        self.extractor.interval_generator = lambda: [('2024-01-01', '2024-02-01')]
+        self.extractor.hash_for_item = self.hash_for_item
+        self.unchanged_entries = set()
+
+        # Meeting id and the list entries of each of its meeting items
+        self.meetings = {
+            1: [['1a', '1b']],
+            2: [['2a']],
+        }
+        self.client = self.extractor.client = mock.Mock()
+        self.client.service.GetMeetingtypes.return_value = mock.Mock(
+            Meetingtypes=[[mock.Mock(Id='raad', Description='Raad')]])
+        self.client.service.GetMeetingsByDateRange.side_effect = lambda **kwargs: mock.Mock(Meetings=[[
+            SimpleNamespace(Id=meeting_id, MeetingtypeId='raad', MeetingDate=meeting_id)
+            for meeting_id in self.meetings
+        ]])
+        self.client.service.GetMeetingWithOptions.side_effect = lambda MeetingId, **kwargs: mock.Mock(
+            Meeting=SimpleNamespace(Id=MeetingId, MeetingItems=[
+                {'ListEntries': [{'EntryId': entry_id} for entry_id in entries]} for entries in self.meetings[MeetingId]
+            ] or None))
+        self.client.service.GetListEntryVotes.return_value = mock.Mock(ListEntryVotes=None)
+
+        self.set_processed = mock.Mock()
+        for target, value in [
+            ('meeting_to_dict', lambda meeting: dict(vars(meeting))),
+            ('set_processed', self.set_processed),
+        ]:
+            patcher = mock.patch.object(ibabs, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def hash_for_item(self, provider, site_name, item_type, item_id, report_dict):
+        if item_type == 'voting_meeting':
+            return 'meeting%d' % item_id
+        entry_id = report_dict['entry']['EntryId']
+        if entry_id in self.unchanged_entries:
+            return False
+        return 'vote%s' % entry_id
+
+    def test_meeting_watermark_is_finalized_with_the_last_vote(self):
+        hashes = [item[-1] for item in self.extractor.run()]
+
+        self.assertEqual(hashes, ['vote1a', ['vote1b', 'meeting1'], ['vote2a', 'meeting2']])
+        # Stored by the finalizer, not by the extractor
+        self.set_processed.assert_not_called()
+
+    def test_meeting_watermark_moves_to_the_last_changed_vote(self):
+        self.unchanged_entries = {'1b'}
+
+        hashes = [item[-1] for item in self.extractor.run()]
+
+        self.assertEqual(hashes, [['vote1a', 'meeting1'], ['vote2a', 'meeting2']])
+        self.set_processed.assert_not_called()
+
+    def test_meeting_without_changed_votes_is_stored_directly(self):
+        self.unchanged_entries = {'1a', '1b'}
+        self.meetings[3] = []
+
+        hashes = [item[-1] for item in self.extractor.run()]
+
+        self.assertEqual(hashes, [['vote2a', 'meeting2']])
+        self.assertEqual(self.set_processed.call_args_list, [
+            mock.call(self.extractor.session, 'meeting1'),
+            mock.call(self.extractor.session, 'meeting3'),
+        ])
+
+    def test_meeting_fingerprint_covers_the_vote_totals(self):
+        def meeting(votes_in_favour):
+            list_entry = SimpleNamespace(EntryId=1, EntryTitle='Motie', ListCanVote=True, ListId=2, ListName='Moties',
+                                         VoteResult=True, VotesAgainst=3, VotesInFavour=votes_in_favour)
+            meeting_item = SimpleNamespace(Id=4, Features=None, Title='Moties', Explanation=None, Confidential=False,
+                                           ListEntries=[[list_entry]], Documents=None)
+            return SimpleNamespace(Id=5, MeetingtypeId=6, MeetingDate=None, StartTime=None, EndTime=None,
+                                   Location=None, Chairman=None, Invitees=None, Attendees=None, Explanation=None,
+                                   PublishDate=None, MeetingItems=[[meeting_item]], Documents=None, Webcast=None)
+
+        def fingerprint(votes_in_favour):
+            return self.extractor._make_hash(meeting_to_dict(meeting(votes_in_favour)), 'voting_meeting')
+
+        self.assertEqual(fingerprint(10), fingerprint(10))
+        # The votes per member are not part of the meeting, only the totals of each list entry
+        self.assertNotEqual(fingerprint(10), fingerprint(11))
+
+
+class FinalizerTestCase(TestCase):
+    def test_nested_hashes_are_stored(self):
+        finalizer = Finalizer.__new__(Finalizer)
+        finalizer.set_processed = mock.Mock()
+
+        # A batch with the hash of a vote and the meeting it belongs to
+        finalizer.start(hash_for_item=['vote1', ['vote2', 'meeting1'], None])
+
+        self.assertEqual(finalizer.set_processed.call_args_list,
+                         [mock.call('vote1'), mock.call('vote2'), mock.call('meeting1')])
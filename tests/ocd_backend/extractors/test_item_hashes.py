@@ -0,0 +1,128 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from ocd_backend.extractors import BaseExtractor
+from ocd_backend.models.postgres_models import ItemHash
+from ocd_backend.utils.misc import hash_utils
+from tests.ocd_backend.extractors import ExtractorTestCase
+
+
+class ItemHashTestCase(ExtractorTestCase):
+    def setUp(self):
+        super(ItemHashTestCase, self).setUp()
+        self.source_definition['key'] = 'test'
+        self.extractor = BaseExtractor(self.source_definition)
+
+        # An in-memory item_hash table instead of the Postgres one
+        engine = create_engine('sqlite://')
+        ItemHash.__table__.create(engine)
+        self.extractor.session = Session(engine)
+        self.addCleanup(self.extractor.session.close)
+
+        self.statements = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda connection, cursor, statement, *args: self.statements.append(statement))
+
+    def add_item_hash(self, row_id, item_id, item_hash, provider=None, site_name=None, item_type=None):
+        self.extractor.session.add(ItemHash(id=row_id, item_id=item_id, item_hash=item_hash, provider=provider,
+                                            site_name=site_name, item_type=item_type))
+
+    def stored_hash(self, hash_key):
+        return self.extractor.session.query(ItemHash.item_hash).filter(ItemHash.item_id == hash_key).scalar()
+
+
+class StoredItemHashesTestCase(ItemHashTestCase):
+    def setUp(self):
+        super(StoredItemHashesTestCase, self).setUp()
+
+        for row_id, (provider, site_name, item_type, item_id) in enumerate([
+            ('ibabs', 'Test', 'meeting', 1),
+            ('ibabs', 'Test', 'meeting', 2),
+            ('ibabs', 'Other', 'meeting', 3),
+            ('ibabs', 'Test', 'report', 4),
+            ('notubiz', 'Test', 'meeting', 5),
+        ]):
+            self.add_item_hash(row_id, hash_utils.create_hash_key(provider, site_name, item_type, item_id),
+                               'hash%d' % item_id, provider, site_name, item_type)
+        # Stored before the scope columns were added
+        self.add_item_hash(5, hash_utils.create_hash_key('ibabs', 'Test', 'meeting', 6), 'hash6')
+        self.extractor.session.commit()
+
+    def test_preload_is_scoped_by_source_and_item_type(self):
+        stored_item_hashes = self.extractor.stored_item_hashes('ibabs', 'Test', 'meeting')
+
+        self.assertEqual(stored_item_hashes, {
+            hash_utils.create_hash_key('ibabs', 'Test', 'meeting', 1): 'hash1',
+            hash_utils.create_hash_key('ibabs', 'Test', 'meeting', 2): 'hash2',
+        })
+
+    def test_preload_runs_once_per_scope(self):
+        stored_item_hashes = self.extractor.stored_item_hashes('ibabs', 'Test', 'meeting')
+        self.add_item_hash(6, hash_utils.create_hash_key('ibabs', 'Test', 'meeting', 7), 'hash7', 'ibabs', 'Test',
+                           'meeting')
+        self.extractor.session.commit()
+
+        self.assertIs(self.extractor.stored_item_hashes('ibabs', 'Test', 'meeting'), stored_item_hashes)
+        self.assertEqual(self.extractor.stored_item_hashes('ibabs', 'Test', 'report'),
+                         {hash_utils.create_hash_key('ibabs', 'Test', 'report', 4): 'hash4'})
+
+    def test_new_items_are_not_looked_up(self):
+        self.extractor.stored_item_hashes('ibabs', 'Test', 'meeting')
+        self.extractor.unscoped_item_hashes()
+        self.statements.clear()
+
+        for item_id in range(10, 20):
+            self.assertTrue(self.extractor.hash_for_item('ibabs', 'Test', 'meeting', item_id, {'id': item_id}))
+
+        self.assertEqual(self.statements, [])
+
+    def test_unscoped_rows_are_loaded_once(self):
+        hash_key = hash_utils.create_hash_key('ibabs', 'Test', 'meeting', 6)
+        self.assertEqual(self.extractor.unscoped_item_hashes(), {hash_key: 'hash6'})
+
+        self.assertTrue(self.extractor.hash_for_item('ibabs', 'Test', 'meeting', 6, {'id': 6}))
+        self.assertTrue(self.extractor.hash_for_item('ibabs', 'Test', 'meeting', 7, {'id': 7}))
+
+        # Loaded once per run, and the row that was found gets its scope
+        self.assertEqual(len([statement for statement in self.statements if 'IS NULL' in statement]), 1)
+        self.assertEqual(self.extractor.session.query(ItemHash.provider, ItemHash.site_name, ItemHash.item_type)
+                         .filter(ItemHash.item_id == hash_key).one(), ('ibabs', 'Test', 'meeting'))
+        self.assertEqual(self.extractor.unscoped_item_hashes(), {})
+
+
+class LegacyHashTestCase(ItemHashTestCase):
+    person = {'Id': 1, 'Name': 'Jan', 'Picture': 'aGVsbG8='}
+
+    def setUp(self):
+        super(LegacyHashTestCase, self).setUp()
+        self.hash_key = hash_utils.create_hash_key('ibabs', 'Test', 'person', 1)
+
+    def store(self, item_hash):
+        self.add_item_hash(1, self.hash_key, item_hash, 'ibabs', 'Test', 'person')
+        self.extractor.session.commit()
+
+    def hash_for_item(self, person):
+        return self.extractor.hash_for_item('ibabs', 'Test', 'person', 1, person)
+
+    def test_unchanged_legacy_hash_is_replaced(self):
+        self.store(self.extractor._make_legacy_hash(self.person))
+
+        self.assertFalse(self.hash_for_item(self.person))
+        self.assertEqual(self.stored_hash(self.hash_key), self.extractor._make_hash(self.person, 'person'))
+        self.assertTrue(self.stored_hash(self.hash_key).startswith('b2:'))
+
+    def test_changed_legacy_hash_is_processed(self):
+        legacy_hash = self.extractor._make_legacy_hash(self.person)
+        self.store(legacy_hash)
+
+        hash_for_item = self.hash_for_item(dict(self.person, Name='Piet'))
+
+        self.assertEqual(hash_for_item.hash_value, self.extractor._make_hash(dict(self.person, Name='Piet'), 'person'))
+        # Stored by the finalizer once the item has been processed
+        self.assertEqual(self.stored_hash(self.hash_key), legacy_hash)
+
+    def test_excluded_field_does_not_change_the_item(self):
+        self.store(self.extractor._make_hash(self.person, 'person'))
+
+        self.assertFalse(self.hash_for_item(dict(self.person, Picture='d29ybGQ=')))
+        self.assertTrue(self.hash_for_item(dict(self.person, Name='Piet')))
@@ -0,0 +1,217 @@
+import json
+import time
+from unittest import mock
+
+from requests.exceptions import ConnectionError
+
+from ocd_backend.extractors import notubiz
+from ocd_backend.extractors.notubiz import NotubizCommitteesExtractor, NotubizMeetingsExtractor
+from ocd_backend.hash_for_item import DUMMY_ITEM_HASH
+from tests.ocd_backend.extractors import ExtractorTestCase
+
+ORGANISATIONS = {
+    'organisations': {
+        'organisation': [{
+            '@attributes': {'id': 987},
+            'logo': 'https://api.notubiz.nl/logo.png',
+            'settings': {'folder': {'fields': {'field': [
+                {'@attributes': {'id': 12}, 'label': 'Locatie'},
+            ]}}},
+        }],
+    },
+}
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+class NotubizOrganizationsCacheTestCase(ExtractorTestCase):
+    def setUp(self):
+        super(NotubizOrganizationsCacheTestCase, self).setUp()
+        self.source_definition['key'] = 'test'
+        self.source_definition['notubiz_organization_id'] = 987
+
+        notubiz._organizations_cache.clear()
+        patcher = mock.patch.object(notubiz, 'redis_client', FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.response = mock.Mock(status_code=200, ok=True, headers={'ETag': '"v1"'})
+        self.response.json.return_value = ORGANISATIONS
+        self.session = mock.Mock()
+        self.session.get.return_value = self.response
+
+    def create_extractor(self):
+        with mock.patch.object(NotubizCommitteesExtractor, '_http_session', self.session):
+            return NotubizCommitteesExtractor(self.source_definition)
+
+    def test_organizations_are_shared(self):
+        self.assertEqual(self.create_extractor().organizations[987]['attributes'], {12: 'Locatie'})
+
+        # A new worker process only has the copy in Redis
+        notubiz._organizations_cache.clear()
+        extractor = self.create_extractor()
+
+        self.assertEqual(self.session.get.call_count, 1)
+        self.assertEqual(extractor.organizations[987], {
+            'logo': 'https://api.notubiz.nl/logo.png',
+            'attributes': {12: 'Locatie'},
+        })
+
+    def test_expired_organizations_are_revalidated(self):
+        self.create_extractor()
+        for key, value in notubiz.redis_client.values.items():
+            cached = json.loads(value)
+            cached['expires'] = 0
+            notubiz.redis_client.values[key] = json.dumps(cached)
+        notubiz._organizations_cache.clear()
+
+        self.response.status_code = 304
+        self.response.json.side_effect = AssertionError('Not modified response has no body')
+        extractor = self.create_extractor()
+
+        self.assertEqual(self.session.get.call_args[1]['headers'], {'If-None-Match': '"v1"'})
+        self.assertEqual(extractor.organizations[987]['attributes'], {12: 'Locatie'})
+
+
+class NotubizMeetingsExtractorTestCase(ExtractorTestCase):
+    def setUp(self):
+        super(NotubizMeetingsExtractorTestCase, self).setUp()
+        self.source_definition.update({
+            'key': 'test',
+            'notubiz_organization_id': 987,
+            'doc_type': 'events',
+            'start_date': '2024-01-01',
+            'end_date': '2024-12-31',
+        })
+
+        notubiz._organizations_cache.clear()
+        patcher = mock.patch.object(notubiz, 'redis_client', FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        organizations_response = mock.Mock(status_code=200, ok=True, headers={})
+        organizations_response.json.return_value = ORGANISATIONS
+        self.session = mock.Mock()
+        self.session.get.return_value = organizations_response
+        with mock.patch.object(NotubizMeetingsExtractor, '_http_session', self.session):
+            self.extractor = NotubizMeetingsExtractor(self.source_definition)
+
+        # Meetings and module items by URL, as returned by fetch_json
+        self.documents = {}
+        self.extractor.fetch_json = mock.Mock(side_effect=self.fetch_json)
+        # Meetings that were processed before, by id
+        self.stored_meetings = {}
+        self.extractor.meeting_hash_for_item = mock.Mock(side_effect=self.meeting_hash_for_item)
+
+    def fetch_json(self, url, path, key):
+        document = self.documents[url]
+        if isinstance(document, Exception):
+            raise document
+        return document
+
+    def meeting_hash_for_item(self, meeting_id, last_modified):
+        if self.stored_meetings.get(meeting_id) == last_modified:
+            return None
+        return 'hash%d' % meeting_id
+
+    def add_meeting(self, meeting_id, last_modified, module_items=0):
+        meeting_url = 'https://api.notubiz.nl/events/meetings/%d?format=json&version=1.17.0' % meeting_id
+        module_item_urls = ['api.notubiz.nl/modules/%d/%d' % (meeting_id, i) for i in range(module_items)]
+        self.documents[meeting_url] = {
+            'id': meeting_id,
+            'last_modified': last_modified,
+            'attributes': [],
+            'agenda_items': [{'module_items': [{'self': url} for url in module_item_urls]}],
+        }
+        for url in module_item_urls:
+            self.documents['https://%s?format=json&version=1.17.0' % url] = {'url': url}
+        return {'id': meeting_id, 'permission_group': 'public'}
+
+    def set_listing(self, listing):
+        events_response = mock.Mock()
+        events_response.json.return_value = {'events': listing, 'pagination': {'has_more_pages': False}}
+        self.extractor.http_session.get = mock.Mock(return_value=events_response)
+
+    def run_extractor(self, listing):
+        self.set_listing(listing)
+        return list(self.extractor.run())
+
+    def fetched_keys(self):
+        return [call[0][2] for call in self.extractor.fetch_json.call_args_list]
+
+    def test_unchanged_meeting_skips_module_items(self):
+        self.stored_meetings[1] = '2024-05-01 10:00:00'
+
+        items = self.run_extractor([self.add_meeting(1, '2024-05-01 10:00:00', module_items=3)])
+
+        # The meeting is retrieved to see whether it changed, its module items are not
+        self.assertEqual(self.fetched_keys(), ['meeting'])
+        self.assertEqual([item[-1] for item in items], [DUMMY_ITEM_HASH])
+
+    def test_changed_meeting_retrieves_module_items(self):
+        self.stored_meetings[1] = '2024-05-01 10:00:00'
+
+        items = self.run_extractor([self.add_meeting(1, '2024-06-01 10:00:00', module_items=3)])
+
+        self.assertEqual(self.fetched_keys(), ['meeting', 'item', 'item', 'item'])
+        self.assertEqual(len(json.loads(items[0][1])['agenda_items'][0]['module_item_contents']), 3)
+
+    def test_unchanged_meeting_in_listing_is_not_retrieved(self):
+        self.stored_meetings[1] = '2024-05-01 10:00:00'
+        item = self.add_meeting(1, '2024-05-01 10:00:00', module_items=3)
+        item['last_modified'] = '2024-05-01 10:00:00'
+
+        self.run_extractor([item])
+
+        self.extractor.fetch_json.assert_not_called()
+
+    def extract_until_error(self, listing):
+        """Returns the hashes of the items that were yielded before the extractor raised"""
+        self.set_listing(listing)
+
+        hashes = []
+        with self.assertRaises(ConnectionError):
+            for item in self.extractor.run():
+                hashes.append(item[-1])
+        return hashes
+
+    def test_meetings_are_yielded_in_listing_order(self):
+        listing = [self.add_meeting(meeting_id, '2024-05-01 10:00:00', module_items=2) for meeting_id in (1, 2, 3)]
+
+        def fetch_json(url, path, key):
+            # The first meeting and its module items are retrieved last
+            if '/meetings/1?' in url or '/modules/1/' in url:
+                time.sleep(0.05)
+            return self.fetch_json(url, path, key)
+        self.extractor.fetch_json.side_effect = fetch_json
+
+        items = self.run_extractor(listing)
+
+        self.assertEqual([item[-1] for item in items], ['hash1', 'hash2', 'hash3'])
+        for item in items:
+            meeting = json.loads(item[1])
+            self.assertEqual([content['url'] for content in meeting['agenda_items'][0]['module_item_contents']],
+                             ['api.notubiz.nl/modules/%d/%d' % (meeting['id'], i) for i in range(2)])
+
+    def test_meeting_error_is_raised_after_preceding_meetings(self):
+        listing = [self.add_meeting(meeting_id, '2024-05-01 10:00:00') for meeting_id in (1, 2, 3)]
+        self.documents['https://api.notubiz.nl/events/meetings/2?format=json&version=1.17.0'] = \
+            ConnectionError('Connection aborted')
+
+        self.assertEqual(self.extract_until_error(listing), ['hash1'])
+
+    def test_module_item_error_is_raised(self):
+        listing = [self.add_meeting(meeting_id, '2024-05-01 10:00:00', module_items=1) for meeting_id in (1, 2)]
+        self.documents['https://api.notubiz.nl/modules/2/0?format=json&version=1.17.0'] = \
+            ConnectionError('Connection aborted')
+
+        self.assertEqual(self.extract_until_error(listing), ['hash1'])
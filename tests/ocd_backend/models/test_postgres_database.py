@@ -1,4 +1,163 @@
 import datetime
-from unittest import TestCase
+from unittest import TestCase, mock
 
-from ocd_backend.models.postgres_database import PostgresDatabase
+from ocd_backend.models.definitions import Ori
+from ocd_backend.models.misc import Uri
+from ocd_backend.models.postgres_database import OriIdBlocks, OriIdCache, PostgresDatabase
+
+
+class OriIdCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = OriIdCache(max_size=2)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(self.cache.get_many(['a']), {'a': 1})
+
+        self.cache.set_many({'c': 3})
+
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+        self.assertEqual(self.cache.info(), {'hits': 3, 'redis_hits': 0, 'misses': 1, 'size': 2, 'max_size': 2})
+
+    def test_counters_are_taken_once(self):
+        self.cache.set_many({'a': 1})
+        self.cache.get_many(['a', 'b'])
+        self.assertEqual(self.cache.take_counters(), {'hits': 1, 'redis_hits': 0, 'misses': 1})
+
+        self.cache.get_many(['a'])
+        self.assertEqual(self.cache.take_counters(), {'hits': 1, 'redis_hits': 0, 'misses': 0})
+        self.assertEqual(self.cache.info()['hits'], 2)
+
+    def test_only_misses_are_resolved(self):
+        database = PostgresDatabase(serializer=None)
+        with mock.patch.object(PostgresDatabase, 'ori_id_cache', self.cache), \
+                mock.patch.object(database, '_get_ori_ids', return_value={'b': 2}) as get_ori_ids:
+            self.cache.set_many({'a': 1})
+
+            self.assertEqual(database.get_ori_ids(['a', 'b']), {'a': 1, 'b': 2})
+            get_ori_ids.assert_called_once_with(['b'])
+
+            self.assertEqual(database.get_ori_ids(['b']), {'b': 2})
+            self.assertEqual(get_ori_ids.call_count, 1)
+
+
+class FakeModel:
+    def __init__(self, source_iri, ori_identifier=None):
+        self.source_iri = source_iri
+        self.values = {'ori_identifier': ori_identifier} if ori_identifier else {}
+
+
+class OriIdResolutionTestCase(TestCase):
+    def setUp(self):
+        self.database = PostgresDatabase(serializer=None)
+        self.session = mock.Mock()
+        self.session.execute.side_effect = self.execute
+        self.database.Session = lambda: self.session
+        self.database.allocate_ori_ids = lambda session, count: list(range(100, 100 + count))
+
+        # ORI ids of the IRIs with a Source in the database
+        self.existing = {'a': 1, 'b': 2}
+        # IRIs created by another worker while the advisory locks are being acquired
+        self.created_concurrently = {}
+        self.inserts = []
+
+        patcher = mock.patch.object(PostgresDatabase, 'ori_id_cache', OriIdCache(max_size=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def execute(self, statement, params):
+        if 'pg_advisory_xact_lock' in str(statement):
+            self.existing.update(self.created_concurrently)
+        elif 'INSERT' in str(statement):
+            self.inserts.append(params)
+        else:
+            return [(iri, self.existing[iri]) for iri in params['iris'] if iri in self.existing]
+
+    def test_duplicate_iris_are_resolved_once(self):
+        models = [FakeModel('a'), FakeModel('new'), FakeModel('a'), FakeModel('b', ori_identifier='resolved')]
+
+        with mock.patch.object(self.database, 'get_ori_ids', wraps=self.database.get_ori_ids) as get_ori_ids:
+            self.database.resolve_ori_identifiers(models)
+
+        get_ori_ids.assert_called_once_with(['a', 'new'])
+        self.assertEqual([model.ori_identifier for model in models[:3]],
+                         [Uri(Ori, 1), Uri(Ori, 100), Uri(Ori, 1)])
+        self.assertFalse(hasattr(models[3], 'ori_identifier'))
+
+    def test_only_new_iris_are_created(self):
+        self.assertEqual(self.database.get_ori_ids(['b', 'new2', 'a', 'new1']),
+                         {'a': 1, 'b': 2, 'new1': 100, 'new2': 101})
+
+        # One insert for the new IRIs, in sorted order
+        self.assertEqual(len(self.inserts), 1)
+        self.assertEqual(self.inserts[0]['iris'], ['new1', 'new2'])
+        self.assertEqual(self.inserts[0]['ori_ids'], [100, 101])
+        self.assertEqual(self.inserts[0]['ori_iris'], [Uri(Ori, 100), Uri(Ori, 101)])
+        self.session.commit.assert_called_once_with()
+
+    def test_iris_created_by_another_worker_are_not_created_again(self):
+        self.created_concurrently = {'new1': 50}
+
+        self.assertEqual(self.database.get_ori_ids(['a', 'new1', 'new2']), {'a': 1, 'new1': 50, 'new2': 100})
+        self.assertEqual(self.inserts[0]['iris'], ['new2'])
+
+    def test_existing_iris_are_not_locked(self):
+        self.assertEqual(self.database.get_ori_ids(['a', 'b']), {'a': 1, 'b': 2})
+
+        self.assertEqual(self.session.execute.call_count, 1)
+        self.assertEqual(self.inserts, [])
+
+
+class UpdateSourcesTestCase(TestCase):
+    def setUp(self):
+        self.database = PostgresDatabase(serializer=None)
+        self.session = mock.Mock()
+        self.database.Session = lambda: self.session
+
+    @staticmethod
+    def model(ori_id, source_iri, canonical_id, canonical_iri=None):
+        return mock.Mock(source_iri=source_iri, canonical_id=canonical_id, canonical_iri=canonical_iri,
+                         **{'get_short_identifier.return_value': str(ori_id)})
+
+    def test_rows_are_upserted_in_conflict_key_order(self):
+        self.database.update_sources([
+            self.model(2, 'b', 1, 'canonical_b'),
+            self.model(1, 'b', 2),
+            self.model(1, 'a', 3, 'canonical_a'),
+            self.model(2, 'a', 1),
+            # A model that occurs twice in the graph
+            self.model(1, 'b', 2),
+        ])
+
+        params = self.session.execute.call_args[0][1]
+        self.assertEqual(list(zip(params['ori_ids'], params['iris'], params['canonical_ids'])),
+                         [(1, 'a', '3'), (1, 'b', '2'), (2, 'a', '1'), (2, 'b', '1')])
+        self.assertEqual(params['canonical_iris'], ['canonical_a', None, None, 'canonical_b'])
+        self.session.commit.assert_called_once_with()
+
+
+class OriIdBlocksTestCase(TestCase):
+    def setUp(self):
+        self.blocks = OriIdBlocks()
+        self.session = mock.Mock()
+        self.session.execute.side_effect = self.execute
+        self.next_value = 1
+
+    def execute(self, statement, params=None):
+        result = mock.MagicMock()
+        if 'increment_by' in str(statement):
+            result.scalar.return_value = 10
+            return result
+
+        starts = list(range(self.next_value, self.next_value + params['count'] * 10, 10))
+        self.next_value += params['count'] * 10
+        result.__iter__.return_value = [(start,) for start in starts]
+        return result
+
+    def test_ids_are_handed_out_from_blocks(self):
+        self.assertEqual(self.blocks.allocate(self.session, 4), [1, 2, 3, 4])
+        self.assertEqual(self.blocks.allocate(self.session, 14), list(range(5, 19)))
+        self.assertEqual(self.blocks.allocate(self.session, 2), [19, 20])
+
+        # The block size is read once, and one query reserved the two blocks that were needed
+        self.assertEqual(self.session.execute.call_count, 3)
@@ -0,0 +1,23 @@
+from unittest import TestCase, mock
+
+from ocd_backend import app
+from ocd_backend.extractors import ibabs
+
+
+class PreloadWsdlTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ibabs, 'preload_wsdl')
+        self.preload_wsdl = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pipeline_worker_preloads_the_wsdl(self):
+        app.preload_wsdl(options={'queues': ['pipeline']})
+        app.preload_wsdl(options={'queues': None})
+
+        self.assertEqual(self.preload_wsdl.call_count, 2)
+
+    def test_other_workers_do_not_preload_the_wsdl(self):
+        app.preload_wsdl(options={'queues': ['loaders']})
+        app.preload_wsdl(options={'queues': 'transformers,enrichers'})
+
+        self.preload_wsdl.assert_not_called()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import time
+from unittest import TestCase, mock, skipUnless
+
+from click.testing import CliRunner
+
+from ocd_backend import local_pipeline
+
+# manage.py imports the PDF parsers, which need system libraries
+try:
+    import manage
+except ImportError:
+    manage = None
+
+
+def transform(content_type, data, url, cached_path, source_definition, **kwargs):
+    time.sleep(0.01)
+    return data.upper()
+
+
+def load(result, source_definition, **kwargs):
+    with open(os.path.join(source_definition['output_path'], 'loaded_%s' % result), 'w'):
+        pass
+
+
+def finalize(source_definition, hash_for_item, **kwargs):
+    with open(os.path.join(source_definition['output_path'], 'finalized_%s' % hash_for_item), 'w'):
+        pass
+
+
+class FakeExtractor:
+    # Number of items yielded minus the number of items that were finished, at each yield
+    ahead = []
+
+    def __init__(self, source_definition):
+        self.source_definition = source_definition
+
+    def run(self):
+        for i in range(20):
+            finished = len([name for name in os.listdir(self.source_definition['output_path'])
+                            if name.startswith('finalized_')])
+            self.ahead.append(i - finished)
+            yield 'text/plain', 'item%d' % i, 'url', 'path', 'hash%d' % i
+
+
+class FakeCleanup:
+    finished_runs = []
+
+    @classmethod
+    def run_finished(cls, source_definition, run_identifier, **kwargs):
+        cls.finished_runs.append(run_identifier)
+
+
+class LocalPipelineTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        FakeExtractor.ahead = []
+        FakeCleanup.finished_runs = []
+
+        self.source_definition = {
+            'id': 'test_definition',
+            'key': 'test',
+            'extractor': f'{__name__}.FakeExtractor',
+            'transformer': f'{__name__}.transform',
+            'loader': f'{__name__}.load',
+            'finalizer': f'{__name__}.finalize',
+            'cleanup': f'{__name__}.FakeCleanup',
+            'output_path': self.directory.name,
+        }
+
+    def test_run_local_pipeline(self):
+        with mock.patch.object(local_pipeline, 'setup_index', return_value=('current', 'new', 'alias')):
+            statistics = local_pipeline.run_local_pipeline(self.source_definition, workers=2, queue_size=3)
+
+        output = set(os.listdir(self.directory.name))
+        self.assertEqual(output, {'loaded_ITEM%d' % i for i in range(20)} | {'finalized_hash%d' % i for i in range(20)})
+        self.assertEqual(statistics.items['transformer'], 20)
+        self.assertEqual(statistics.items['finalizer'], 20)
+        self.assertEqual(statistics.failed, 0)
+
+        # The extractor never gets further ahead of the workers than the queue allows
+        self.assertLessEqual(max(FakeExtractor.ahead), 3)
+        self.assertEqual(len(FakeCleanup.finished_runs), 1)
+
+    @skipUnless(manage, 'manage.py can not be imported')
+    def test_run_local_command(self):
+        sources = {'test': self.source_definition}
+        with mock.patch.object(manage, 'load_sources_config', return_value=sources), \
+                mock.patch.object(local_pipeline, 'setup_index', return_value=('current', 'new', 'alias')):
+            result = CliRunner().invoke(manage.extract_run_local, ['test', '--workers', '2'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Failed items: 0', result.output)
+        self.assertEqual(len(os.listdir(self.directory.name)), 40)
+        self.assertEqual(len(FakeCleanup.finished_runs), 1)
@@ -0,0 +1,189 @@
+from unittest import TestCase, mock
+
+from celery.exceptions import Retry
+
+from ocd_backend import pipeline
+from ocd_backend.hash_for_item import HashForItem
+
+
+class FakeExtractor:
+    items = []
+    error = None
+
+    def __init__(self, source_definition):
+        self.source_definition = source_definition
+        self.checkpoint = {}
+        self.resume_checkpoint = {}
+
+    def run(self):
+        for index, item in enumerate(self.items):
+            yield item
+            self.checkpoint = {'items': index + 1}
+        if self.error:
+            raise self.error
+
+
+class PipelineTestCase(TestCase):
+    def setUp(self):
+        self.source_definition = {
+            'id': 'test_definition',
+            'key': 'test',
+            'extractor': 'extractor',
+            'transformer': 'transformer',
+            'loader': 'loader',
+            'finalizer': 'finalizer',
+            'cleanup': 'cleanup',
+        }
+        FakeExtractor.error = None
+        self.tasks = {
+            'extractor': FakeExtractor,
+            'transformer': mock.Mock(name='transformer'),
+            'loader': mock.Mock(name='loader'),
+            'finalizer': mock.Mock(name='finalizer'),
+            'cleanup': mock.Mock(name='cleanup'),
+        }
+
+        self.backend = mock.Mock()
+        self.backend.get.return_value = None
+        self.backend.get_set_cardinality.return_value = 0
+
+        for target, value in [
+            ('celery_app', mock.Mock(backend=self.backend)),
+            ('load_object', self.tasks.get),
+            ('setup_index', mock.Mock(return_value=('current', 'new', 'alias'))),
+            ('chain', mock.Mock(name='chain')),
+            ('group', mock.Mock(name='group')),
+            ('batch_transformer', mock.Mock(name='batch_transformer')),
+        ]:
+            patcher = mock.patch.object(pipeline, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def extracted_items(count):
+        items = []
+        for i in range(count):
+            hash_for_item = HashForItem(f'key{i}', f'value{i}', 'notubiz', 'test', 'meeting', i)
+            items.append(('application/json', '{"id": %d}' % i, f'url{i}', f'path{i}', hash_for_item))
+        return items
+
+    def run_pipeline(self, items, **source_definition):
+        FakeExtractor.items = items
+        self.source_definition.update(source_definition)
+        pipeline.setup_pipeline(self.source_definition, 'run')
+
+    def test_batch_is_sent_in_one_chain(self):
+        items = self.extracted_items(5)
+        self.run_pipeline(items, pipeline_batch_size=3)
+
+        # Two chains: one with 3 items and one with the remaining 2
+        self.assertEqual(pipeline.chain.call_count, 2)
+        transformed_batches = [call[0][0] for call in pipeline.batch_transformer.s.call_args_list]
+        self.assertEqual(transformed_batches, [
+            [item[:-1] for item in items[:3]],
+            [item[:-1] for item in items[3:]],
+        ])
+        self.tasks['transformer'].s.assert_not_called()
+
+        finalized_hashes = [call[1]['hash_for_item'] for call in self.tasks['finalizer'].s.call_args_list]
+        self.assertEqual(finalized_hashes, [
+            [item[-1] for item in items[:3]],
+            [item[-1] for item in items[3:]],
+        ])
+
+    def test_without_batch_size_every_item_has_a_chain(self):
+        items = self.extracted_items(2)
+        self.run_pipeline(items)
+
+        self.assertEqual(pipeline.chain.call_count, 2)
+        pipeline.batch_transformer.s.assert_not_called()
+        self.assertEqual([call[1]['hash_for_item'] for call in self.tasks['finalizer'].s.call_args_list],
+                         [item[-1] for item in items])
+
+    def test_checkpoint_outlives_retries(self):
+        self.run_pipeline(self.extracted_items(pipeline.PIPELINE_CHAIN_REGISTRATION_BATCH_SIZE))
+
+        self.backend.client.set.assert_called_once_with(
+            'pipeline_run_test_definition_checkpoint', '{"items": 19}', ex=pipeline.PIPELINE_CHECKPOINT_TTL)
+        self.assertGreater(pipeline.PIPELINE_CHECKPOINT_TTL, 30660)
+        self.backend.remove.assert_called_once_with('pipeline_run_test_definition_checkpoint')
+
+    def test_finished_extraction_is_reported_to_the_cleanup(self):
+        self.run_pipeline(self.extracted_items(1))
+
+        self.backend.start_runs.assert_called_once_with('pipeline_run', [mock.ANY])
+        cleanup_kwargs = self.tasks['cleanup'].delay.call_args[1]
+        self.assertIsNone(cleanup_kwargs['chain_id'])
+        self.assertEqual(cleanup_kwargs['run_identifier'], self.backend.start_runs.call_args[0][1][0])
+
+    def test_failed_run_is_reported_when_it_is_not_retried(self):
+        FakeExtractor.error = ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            self.run_pipeline(self.extracted_items(1))
+
+        self.backend.set.assert_any_call(mock.ANY, 'error')
+        self.assertIsNone(self.tasks['cleanup'].delay.call_args[1]['chain_id'])
+
+    def test_retried_run_keeps_running(self):
+        FakeExtractor.error = ConnectionError('failed')
+
+        with self.assertRaises(Retry):
+            self.run_pipeline(self.extracted_items(1))
+
+        # The retry continues the run, so the source run may not finish yet
+        self.tasks['cleanup'].delay.assert_not_called()
+
+    def test_start_source_run_registers_all_runs_first(self):
+        calls = mock.Mock()
+        with mock.patch.object(pipeline.setup_pipeline, 'apply_async', calls.apply_async):
+            self.backend.start_runs = calls.start_runs
+            pipeline.start_source_run([{'id': 'meetings'}, {'id': 'committees'}], 'run')
+
+        self.assertEqual([name for name, _, _ in calls.mock_calls], ['start_runs', 'apply_async', 'apply_async'])
+        run_identifiers = calls.start_runs.call_args[0][1]
+        task_ids = [call[1]['task_id'] for call in calls.apply_async.call_args_list]
+        self.assertEqual(run_identifiers, [pipeline.run_identifier(task_id) for task_id in task_ids])
+
+
+class BackpressureTestCase(TestCase):
+    def setUp(self):
+        self.backend = mock.Mock()
+        patcher = mock.patch.object(pipeline, 'celery_app', mock.Mock(backend=self.backend))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.now = 0
+        for target, value in [('sleep', self.sleep), ('monotonic', lambda: self.now)]:
+            patcher = mock.patch.object(pipeline, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def test_pauses_until_low_water_mark(self):
+        self.backend.get_set_cardinality.side_effect = [50, 45, 30, 24, 0]
+
+        pipeline.wait_for_in_flight_chains('run_chains', 40, 25, 'test')
+
+        # Resumed at 24, without waiting for the last poll
+        self.assertEqual(self.backend.get_set_cardinality.call_count, 4)
+
+    def test_does_not_pause_below_high_water_mark(self):
+        self.backend.get_set_cardinality.return_value = 40
+
+        pipeline.wait_for_in_flight_chains('run_chains', 40, 25, 'test')
+
+        self.assertEqual(self.now, 0)
+
+    def test_resumes_when_no_chains_finish(self):
+        self.backend.get_set_cardinality.return_value = 50
+
+        pipeline.wait_for_in_flight_chains('run_chains', 40, 25, 'test')
+
+        self.assertGreater(self.now, pipeline.PIPELINE_BACKPRESSURE_STALL_TIMEOUT)
+
+    def test_setup_pipeline_does_not_run_in_the_loaders_queue(self):
+        routes = pipeline.settings.CELERY_CONFIG['task_routes']
+        self.assertNotEqual(routes['ocd_backend.pipeline.*']['queue'], routes['ocd_backend.loaders.*']['queue'])
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+import fakeredis
+
+from ocd_backend.app import celery_app
+from ocd_backend.result_backends import OCDRedisBackend
+
+
+class CompleteChainTestCase(TestCase):
+    def setUp(self):
+        self.backend = OCDRedisBackend(app=celery_app, url='redis://localhost:6379/0')
+        self.backend.client = fakeredis.FakeStrictRedis()
+
+    def start_chains(self, run_identifier, chain_ids):
+        self.backend.add_values_to_sets(['{}_chains'.format(run_identifier), 'source_run'], chain_ids)
+
+    def finish_extraction(self, run_identifier):
+        self.backend.set(run_identifier, 'done')
+        return self.backend.complete_chain(run_identifier, 'source_run', None)
+
+    def test_source_run_finishes_once_after_all_entity_runs(self):
+        self.backend.start_runs('source_run', ['meetings', 'committees'])
+
+        self.start_chains('meetings', ['meeting1', 'meeting2'])
+        self.assertFalse(self.finish_extraction('meetings'))
+        self.assertFalse(self.backend.complete_chain('meetings', 'source_run', 'meeting1'))
+        # All chains of the source run have finished, but the committees are still being extracted
+        self.assertFalse(self.backend.complete_chain('meetings', 'source_run', 'meeting2'))
+
+        self.start_chains('committees', ['committee1'])
+        self.assertFalse(self.finish_extraction('committees'))
+        self.assertTrue(self.backend.complete_chain('committees', 'source_run', 'committee1'))
+
+        # Late calls, like a redelivered cleanup, do not report the source run again
+        self.assertFalse(self.finish_extraction('meetings'))
+        self.assertFalse(self.backend.complete_chain('committees', 'source_run', 'committee1'))
+
+    def test_finished_by_the_last_extraction(self):
+        self.backend.start_runs('source_run', ['meetings', 'committees'])
+
+        self.start_chains('meetings', ['meeting1'])
+        self.start_chains('committees', ['committee1'])
+        self.assertFalse(self.backend.complete_chain('meetings', 'source_run', 'meeting1'))
+        self.assertFalse(self.backend.complete_chain('committees', 'source_run', 'committee1'))
+
+        self.assertFalse(self.finish_extraction('meetings'))
+        self.assertTrue(self.finish_extraction('committees'))
+        self.assertFalse(self.backend.client.exists('meetings_chains', 'committees_chains'))
+
+    def test_reset_run_finished(self):
+        self.backend.start_runs('source_run', ['meetings'])
+        self.assertTrue(self.finish_extraction('meetings'))
+
+        self.backend.reset_run_finished('source_run')
+
+        self.assertTrue(self.finish_extraction('meetings'))
+
+
+class CountersTestCase(TestCase):
+    def setUp(self):
+        self.backend = OCDRedisBackend(app=celery_app, url='redis://localhost:6379/0')
+        self.backend.client = fakeredis.FakeStrictRedis()
+
+    def test_counters_of_workers_are_added_up(self):
+        self.backend.add_counters('counters', {'hits': 3, 'misses': 1}, ttl=60)
+        self.backend.add_counters('counters', {'hits': 2, 'redis_hits': 4}, ttl=60)
+        self.assertGreater(self.backend.client.ttl('counters'), 0)
+
+        self.assertEqual(self.backend.pop_counters('counters'), {'hits': 5, 'redis_hits': 4, 'misses': 1})
+        self.assertEqual(self.backend.pop_counters('counters'), {})
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+
+from ocd_backend.models import MediaObject
+from ocd_backend.utils import claim_check
+
+
+class ClaimCheckTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(claim_check, 'CLAIM_CHECK_PATH', self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+        self.media_object = MediaObject('1', source='test', supplier='notubiz', collection='attachment')
+        self.media_object.name = 'Raadsvoorstel'
+        self.media_object.text = ['page %d ' % i * 5000 for i in range(3)]
+        self.media_object.md_text = ['# page %d ' % i * 5000 for i in range(3)]
+        self.media_object.text_pages = [{'text': text, 'page_number': i} for i, text in
+                                        enumerate(self.media_object.text, start=1)]
+
+    def test_check_in_and_out(self):
+        original_values = dict(self.media_object.values)
+
+        claim_check.check_in(self.media_object)
+
+        for name in claim_check.CLAIM_CHECK_PROPERTIES:
+            self.assertIsInstance(self.media_object.values[name], claim_check.ClaimCheck)
+        self.assertEqual(self.media_object.name, 'Raadsvoorstel')
+
+        claim_check.check_out(self.media_object)
+
+        self.assertEqual(self.media_object.values, original_values)
+
+    def test_small_text_is_not_checked_in(self):
+        self.media_object.text = ['short']
+
+        claim_check.check_in(self.media_object)
+
+        self.assertEqual(self.media_object.text, ['short'])
+
+    def test_threads_store_the_same_value(self):
+        barrier = threading.Barrier(8, timeout=5)
+        replace = os.replace
+
+        def replace_together(source, destination):
+            # All threads have written their file before the first one is renamed
+            barrier.wait()
+            replace(source, destination)
+
+        def store(_):
+            return claim_check.store(self.media_object.text)
+
+        with mock.patch('os.replace', replace_together), ThreadPoolExecutor(max_workers=8) as executor:
+            keys = set(executor.map(store, range(8)))
+
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(claim_check.retrieve(keys.pop()), self.media_object.text)
+        stored_files = [name for _, _, names in os.walk(self.directory.name) for name in names]
+        self.assertEqual(len(stored_files), 1)
+
+    def test_purge_expired(self):
+        claim_check.check_in(self.media_object)
+        key = self.media_object.values['text'].key
+        path = claim_check._path(key)
+        os.utime(path, (0, 0))
+
+        claim_check.purge_expired()
+
+        self.assertFalse(os.path.exists(path))
+        claim_check.check_out(self.media_object)
+        self.assertNotIn('text', self.media_object.values)
@@ -0,0 +1,31 @@
+import os
+from unittest import TestCase, mock
+
+from ocd_backend.utils.http import HttpRequestSimple
+
+
+class DownloadUrlTestCase(TestCase):
+    def setUp(self):
+        self.response = mock.Mock(headers={'content-type': 'application/json'})
+        self.response.iter_content.return_value = [b'{"gremia": []}']
+
+        self.http = HttpRequestSimple()
+        self.http._http_session = mock.Mock()
+        self.http._http_session.get.return_value = self.response
+
+    def test_small_response_is_kept_in_memory(self):
+        resource = self.http.download_url('https://api.notubiz.nl/organisations/987/gremia')
+
+        self.assertFalse(resource.media_file._rolled)
+        self.assertEqual(resource.file_size, 14)
+        self.assertEqual(resource.read(), b'{"gremia": []}')
+
+    def test_to_path(self):
+        resource = self.http.download_url('https://api.notubiz.nl/documents/1')
+
+        path = resource.to_path()
+        self.addCleanup(os.remove, path)
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'{"gremia": []}')
+        self.assertEqual(resource.read(), b'{"gremia": []}')
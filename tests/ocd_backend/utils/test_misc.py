@@ -3,6 +3,7 @@ from unittest import TestCase
 from ocd_backend.utils.misc import slugify
 from ocd_backend.utils.misc import iterate
 from ocd_backend.utils.misc import compare_insensitive
+from ocd_backend.utils.misc import hash_utils
 
 
 class SlugifyTestCase(TestCase):
@@ -66,3 +67,25 @@ class CompareInsensitiveTestCase(TestCase):
 
     def test_does_not_contain(self):
         self.assertFalse(compare_insensitive('AB', 'ABC'))
+
+
+class FingerprintTestCase(TestCase):
+    def test_key_order_does_not_matter(self):
+        self.assertEqual(
+            hash_utils.fingerprint({'a': 1, 'b': {'c': 2, 'd': [3, 4]}}),
+            hash_utils.fingerprint({'b': {'d': [3, 4], 'c': 2}, 'a': 1})
+        )
+        self.assertNotEqual(
+            hash_utils.fingerprint({'b': {'d': [4, 3], 'c': 2}, 'a': 1}),
+            hash_utils.fingerprint({'a': 1, 'b': {'c': 2, 'd': [3, 4]}})
+        )
+
+    def test_excluded_fields(self):
+        self.assertEqual(
+            hash_utils.fingerprint({'Name': 'Jan', 'Picture': 'aGVsbG8='}, ['Picture']),
+            hash_utils.fingerprint({'Name': 'Jan', 'Picture': 'd29ybGQ='}, ['Picture'])
+        )
+
+    def test_version(self):
+        self.assertTrue(hash_utils.is_current_fingerprint(hash_utils.fingerprint('2024-01-01 12:00:00')))
+        self.assertFalse(hash_utils.is_current_fingerprint('0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33'))
@@ -0,0 +1,148 @@
+import time
+from unittest import TestCase, mock
+
+import fakeredis
+from requests.exceptions import ConnectionError
+
+from ocd_backend.extractors.ibabs import RateLimitedTransport
+from ocd_backend.utils import rate_limiter
+from ocd_backend.utils.rate_limiter import RateLimiter, TOKEN_BUCKET_SCRIPT
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        client = fakeredis.FakeStrictRedis(decode_responses=True)
+        self.now = 1000.0
+        self.sleeps = []
+        for target, attribute, value in [
+            (RateLimiter, 'token_bucket_script', client.register_script(TOKEN_BUCKET_SCRIPT)),
+            (rate_limiter, 'sleep', self.sleep),
+            # The script uses the Redis server time
+            (time, 'time', lambda: self.now),
+        ]:
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        # Like a real sleep, this takes at least the resolution of the Redis clock
+        self.now += max(seconds, 0.000001)
+
+    def limiter(self, site, supplier_budget=None, site_budget=None):
+        return RateLimiter.for_source({
+            'supplier': 'ibabs',
+            'supplier_rate_limit': supplier_budget or {'rate': 100, 'burst': 100},
+            'rate_limit': site_budget or {'rate': 100, 'burst': 100},
+        }, site)
+
+    def test_burst(self):
+        limiter = self.limiter('amsterdam', site_budget={'rate': 1, 'burst': 3})
+
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+
+        limiter.acquire()
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertAlmostEqual(self.sleeps[0], 1, places=3)
+
+    def test_refill(self):
+        limiter = self.limiter('amsterdam', site_budget={'rate': 2, 'burst': 4})
+        for _ in range(4):
+            limiter.acquire()
+
+        self.now += 1
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+
+        limiter.acquire()
+        self.assertAlmostEqual(sum(self.sleeps), 0.5, places=3)
+
+    def test_supplier_budget_is_shared_by_sites(self):
+        supplier_budget = {'rate': 1, 'burst': 2}
+        amsterdam = self.limiter('amsterdam', supplier_budget=supplier_budget)
+        utrecht = self.limiter('utrecht', supplier_budget=supplier_budget)
+
+        amsterdam.acquire()
+        amsterdam.acquire()
+        utrecht.acquire()
+
+        self.assertAlmostEqual(sum(self.sleeps), 1, places=3)
+
+    def test_fault_pauses_only_the_site(self):
+        amsterdam = self.limiter('amsterdam')
+        utrecht = self.limiter('utrecht')
+
+        amsterdam.backoff()
+        utrecht.acquire()
+        self.assertEqual(self.sleeps, [])
+
+        amsterdam.acquire()
+        self.assertGreaterEqual(sum(self.sleeps), rate_limiter.RATE_LIMIT_BACKOFF)
+
+    def test_throttling_pauses_all_sites(self):
+        amsterdam = self.limiter('amsterdam')
+        utrecht = self.limiter('utrecht')
+
+        amsterdam.backoff(5, throttled=True)
+        utrecht.acquire()
+
+        self.assertGreaterEqual(sum(self.sleeps), 5)
+
+    def test_consecutive_failures_double_the_pause(self):
+        limiter = self.limiter('amsterdam')
+
+        for _ in range(3):
+            limiter.backoff()
+            limiter.acquire()
+        limiter.succeeded()
+        limiter.backoff()
+        limiter.acquire()
+
+        backoff = rate_limiter.RATE_LIMIT_BACKOFF
+        expected = [backoff, backoff * 2, backoff * 4, backoff]
+        # Leaving out the rounding errors of the clock
+        self.assertEqual([round(seconds) for seconds in self.sleeps if seconds > 0.1], expected)
+
+
+class RateLimitedTransportTestCase(TestCase):
+    def setUp(self):
+        self.rate_limiter = mock.Mock()
+        self.transport = RateLimitedTransport(self.rate_limiter)
+        patcher = mock.patch('zeep.transports.Transport.post')
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_response(self, status_code, headers=None):
+        self.post.return_value = mock.Mock(status_code=status_code, headers=headers or {})
+        return self.transport.post('https://wcf.ibabs.eu/api/Public.svc', '<soap/>', {})
+
+    def test_success(self):
+        self.post_response(200)
+
+        self.rate_limiter.acquire.assert_called_once_with()
+        self.rate_limiter.succeeded.assert_called_once_with()
+        self.rate_limiter.backoff.assert_not_called()
+
+    def test_fault_backs_off_the_site(self):
+        self.post_response(500)
+
+        self.rate_limiter.backoff.assert_called_once_with()
+
+    def test_throttling_backs_off_all_sites(self):
+        self.post_response(429, {'Retry-After': '30'})
+        self.rate_limiter.backoff.assert_called_once_with(30, throttled=True)
+
+        self.rate_limiter.backoff.reset_mock()
+        self.post_response(503)
+        self.rate_limiter.backoff.assert_called_once_with(None, throttled=True)
+
+    def test_connection_error_backs_off_the_site(self):
+        self.post.side_effect = ConnectionError('Connection aborted')
+
+        with self.assertRaises(ConnectionError):
+            self.transport.post('https://wcf.ibabs.eu/api/Public.svc', '<soap/>', {})
+
+        self.rate_limiter.backoff.assert_called_once_with()
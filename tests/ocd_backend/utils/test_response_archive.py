@@ -0,0 +1,88 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+
+from requests import Response, Session
+
+from ocd_backend.exceptions import ResponseNotArchived
+from ocd_backend.utils import response_archive
+
+
+class ResponseArchiveTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(response_archive, 'RESPONSE_ARCHIVE_PATH', self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+        self.adapter = mock.Mock()
+        self.adapter.send.side_effect = self.send
+
+    @staticmethod
+    def send(request, **kwargs):
+        response = Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        response._content = b'{"meeting": "%s"}' % request.url.encode('utf-8')
+        response.url = request.url
+        return response
+
+    def create_session(self, source_definition):
+        session = Session()
+        session.mount('https://', self.adapter)
+        response_archive.mount(session, source_definition)
+        return session
+
+    def test_replay(self):
+        session = self.create_session({'archive_responses': True})
+        session.get('https://api.notubiz.nl/events/1')
+        session.post('https://wcf.ibabs.eu/api/Public.svc', data='<Envelope/>')
+
+        session = self.create_session({'replay': '1'})
+        self.adapter.send.side_effect = AssertionError('A replay does not use the network')
+
+        response = session.get('https://api.notubiz.nl/events/1')
+        self.assertEqual(response.json(), {'meeting': 'https://api.notubiz.nl/events/1'})
+        self.assertEqual(response.encoding, 'utf-8')
+        self.assertEqual(session.post('https://wcf.ibabs.eu/api/Public.svc', data='<Envelope/>').status_code, 200)
+
+        with self.assertRaises(ResponseNotArchived):
+            session.post('https://wcf.ibabs.eu/api/Public.svc', data='<Envelope>other</Envelope>')
+
+    def test_identical_content_is_stored_once(self):
+        self.adapter.send.side_effect = None
+        self.adapter.send.return_value = self.send(mock.Mock(url='https://api.notubiz.nl/events'))
+
+        session = self.create_session({'archive_responses': True})
+        session.get('https://api.notubiz.nl/events?page=1')
+        session.get('https://api.notubiz.nl/events?page=2')
+
+        stored_files = [name for _, _, names in os.walk(os.path.join(self.directory.name, 'content'))
+                        for name in names]
+        self.assertEqual(len(stored_files), 1)
+
+    def test_threads_store_the_same_response(self):
+        barrier = threading.Barrier(8, timeout=5)
+        replace = os.replace
+
+        def replace_together(source, destination):
+            # All threads have written their file before the first one is renamed
+            barrier.wait()
+            replace(source, destination)
+
+        def store(_):
+            response_archive.store('key', 200, {}, b'{"meeting": 1}')
+
+        with mock.patch('os.replace', replace_together), ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(store, range(8)))
+
+        self.assertEqual(response_archive.retrieve('key'), (200, {}, b'{"meeting": 1}'))
+        stored_files = [name for _, _, names in os.walk(self.directory.name) for name in names]
+        self.assertEqual(len(stored_files), 2)
+
+    def test_disabled(self):
+        session = self.create_session({})
+        self.assertIs(session.get_adapter('https://api.notubiz.nl'), self.adapter)
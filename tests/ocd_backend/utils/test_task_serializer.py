@@ -0,0 +1,85 @@
+import os
+import json
+import pickle
+from datetime import datetime
+from unittest import TestCase
+
+from ocd_backend.hash_for_item import HashForItem
+from ocd_backend.models import Organization
+from ocd_backend.models.misc import Url
+from ocd_backend.transformers.database import database_item
+from ocd_backend.utils import task_serializer
+
+
+class TaskSerializerTestCase(TestCase):
+    def setUp(self):
+        self.PWD = os.path.dirname(__file__)
+        database_item.get_supplier = lambda ori_id: 'allmanak' if ori_id == 35138 else 'notubiz'
+
+        with open(os.path.join(self.PWD, '../test_dumps/database_extracted_meeting.json'), 'r') as f:
+            self.extracted_resource, self.extracted_subresources = json.loads(f.read())
+        self.meeting = self.meetings(1)[0]
+
+    def meetings(self, count):
+        """Returns `count` separately transformed copies of the fixture meeting"""
+        args = ('object', (self.extracted_resource, self.extracted_subresources), '612019', 'source_item_dummy')
+        kwargs = {'source_definition': {'key': 'groningen'}}
+        return [database_item.apply(args, kwargs).get() for _ in range(count)]
+
+    def test_model_graph_roundtrip(self):
+        restored = task_serializer.loads(task_serializer.dumps((self.meeting,)))
+
+        self.assertIsInstance(restored, tuple)
+        originals = list(self.meeting.traverse())
+        restored_models = list(restored[0].traverse())
+        self.assertEqual(len(restored_models), len(originals))
+        for original, model in zip(originals, restored_models):
+            self.assertIs(type(model), type(original))
+            self.assertEqual(model.source_iri, original.source_iri)
+            self.assertEqual(model.values.keys(), original.values.keys())
+            self.assertEqual(model.__dict__.keys(), original.__dict__.keys())
+
+    def test_shared_models_are_written_once(self):
+        organization = Organization('1', source='test', supplier='allmanak', collection='municipality')
+        first = Organization('2', source='test', supplier='notubiz', collection='committee')
+        second = Organization('3', source='test', supplier='notubiz', collection='committee')
+        first.subOrganizationOf = organization
+        second.subOrganizationOf = organization
+        organization.has_part = [first, second]
+
+        restored_first, restored_second = task_serializer.loads(task_serializer.dumps([first, second]))
+
+        self.assertIs(restored_first.subOrganizationOf, restored_second.subOrganizationOf)
+        self.assertIs(restored_first.subOrganizationOf.has_part[0], restored_first)
+
+    def test_other_types(self):
+        value = {
+            'start_time': datetime(2024, 5, 1, 12, 30),
+            'url': Url('https://api.notubiz.nl/'),
+            'hash_for_item': HashForItem('key', 'value', 'notubiz', 281, 'meeting', 1),
+            'items': ('application/json', '{}', None, 'notubiz/', 1.5, True),
+        }
+
+        restored = task_serializer.loads(task_serializer.dumps(value))
+
+        self.assertEqual(restored['start_time'], value['start_time'])
+        self.assertIsInstance(restored['url'], Url)
+        self.assertEqual(restored['hash_for_item'].hash_key, 'key')
+        self.assertEqual(restored['items'], value['items'])
+
+    def test_small_frames_are_plain_pickle(self):
+        organization = Organization('1', source='test', supplier='allmanak', collection='municipality')
+
+        data = task_serializer.dumps(organization)
+
+        self.assertEqual(data[:1], task_serializer.FRAME_PLAIN)
+        self.assertEqual(data[1:], pickle.dumps(organization, protocol=task_serializer.PICKLE_PROTOCOL))
+
+    def test_large_frames_are_smaller_than_pickle(self):
+        meetings = self.meetings(30)
+
+        data = task_serializer.dumps(meetings)
+
+        self.assertEqual(data[:1], task_serializer.FRAME_ZSTD)
+        self.assertLess(len(data), len(pickle.dumps(meetings)) / 4)
+        self.assertEqual(len(task_serializer.loads(data)), 30)